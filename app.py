@@ -1,12 +1,41 @@
 import os
 import json
+import logging
+import logging.handlers
+import queue
+import random
+import atexit
 import base64
+import contextvars
+import cProfile
+import csv
+import glob
+import gzip
+import hashlib
+import html
+import io
+import pstats
 import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+from urllib.parse import urlencode, urlsplit
 
 import pymysql
 import requests
-from flask import Flask, request, jsonify, Response
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from flask import Flask, request, jsonify, Response, g, stream_with_context
+from pymysql.constants import SERVER_STATUS
 
 # timezone BR
 try:
@@ -26,18 +55,171 @@ DB_USER = os.getenv("DB_USER", "")
 DB_PASS = os.getenv("DB_PASS", "")
 DB_NAME = os.getenv("DB_NAME", "develop_1_lic")
 
+# Pool de conexões (por worker do gunicorn; Procfile: 2 workers x 4 threads)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # seg. esperando conexão livre
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))          # seg. de vida máxima da conexão
+DB_POOL_PING_APOS = int(os.getenv("DB_POOL_PING_APOS", "30"))        # seg. ociosa antes de validar com ping
+DB_POOL_ESPERA_ALERTA = float(os.getenv("DB_POOL_ESPERA_ALERTA", "0.5"))
+
+# Réplica de leitura (opcional; vazio = tudo no primário). Usuário/senha/porta herdam de DB_*
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST", "")
+DB_REPLICA_PORT = int(os.getenv("DB_REPLICA_PORT", str(DB_PORT)))
+DB_REPLICA_USER = os.getenv("DB_REPLICA_USER", DB_USER)
+DB_REPLICA_PASS = os.getenv("DB_REPLICA_PASS", DB_PASS)
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))
+DB_REPLICA_POOL_TIMEOUT = float(os.getenv("DB_REPLICA_POOL_TIMEOUT", "2"))    # esgotado: lê no primário
+DB_REPLICA_ATRASO_MAX_SEG = float(os.getenv("DB_REPLICA_ATRASO_MAX_SEG", "30"))  # acima disso: lê no primário
+DB_REPLICA_CHECAGEM_SEG = float(os.getenv("DB_REPLICA_CHECAGEM_SEG", "10"))
+
 # TecnoSpeed (consulta /api/v1/pix/{id})
 TECNOSPEED_BASE = os.getenv("TECNOSPEED_BASE", "https://pix.tecnospeed.com.br")
 
 # Webhook auth (se vazio, não valida)
 WEBHOOK_AUTH = os.getenv("WEBHOOK_AUTH", "")
 
+# Processamento assíncrono do webhook (requer sql/001_pix_webhook_eventos_processamento.sql)
+# 1 = a rota só grava o evento e responde 202; workers em background processam
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_POLL_SEG = float(os.getenv("WEBHOOK_POLL_SEG", "5"))
+WEBHOOK_MAX_TENTATIVAS = int(os.getenv("WEBHOOK_MAX_TENTATIVAS", "5"))
+WEBHOOK_RESERVA_EXPIRA_SEG = int(os.getenv("WEBHOOK_RESERVA_EXPIRA_SEG", "300"))
+
+# Renovação antecipada de tokens (thread por processo; GET_LOCK por iddadospix entre workers/nós)
+TOKEN_RENOVADOR = os.getenv("TOKEN_RENOVADOR", "1") == "1"
+TOKEN_RENOVAR_ANTES_SEG = int(os.getenv("TOKEN_RENOVAR_ANTES_SEG", "600"))      # renova quem expira em até N seg.
+TOKEN_RENOVADOR_JITTER_SEG = int(os.getenv("TOKEN_RENOVADOR_JITTER_SEG", "300"))  # espalha renovações/varreduras
+TOKEN_RENOVADOR_INTERVALO_SEG = float(os.getenv("TOKEN_RENOVADOR_INTERVALO_SEG", "60"))
+TOKEN_RENOVADOR_PARALELO = int(os.getenv("TOKEN_RENOVADOR_PARALELO", "2"))
+TOKEN_RENOVADOR_LOTE = int(os.getenv("TOKEN_RENOVADOR_LOTE", "200"))
+
+# Pool MySQL das rotinas de background (separado de DB_POOL_SIZE, que fica só para as requisições)
+# padrão: workers de eventos + renovações paralelas + loops (reserva, despachante, feed/arquivador)
+DB_POOL_BACKGROUND_SIZE = int(os.getenv(
+    "DB_POOL_BACKGROUND_SIZE", str(WEBHOOK_WORKERS + TOKEN_RENOVADOR_PARALELO + 3)
+))
+
+# Idempotência: pix_ids já liquidados lembrados por worker (LRU)
+IDEMPOTENCIA_LRU_MAX = int(os.getenv("IDEMPOTENCIA_LRU_MAX", "20000"))
+
+# Coalescência de webhooks simultâneos do mesmo pix_id
+PIX_COALESCER_ESPERA_SEG = float(os.getenv("PIX_COALESCER_ESPERA_SEG", "30"))   # seguidor no mesmo processo
+PIX_TRAVA_GLOBAL = os.getenv("PIX_TRAVA_GLOBAL", "1") == "1"                    # GET_LOCK entre workers/nós
+PIX_TRAVA_ESPERA_SEG = int(os.getenv("PIX_TRAVA_ESPERA_SEG", "10"))
+
+# Monitor /ui
+UI_LIMITE = int(os.getenv("UI_LIMITE", "50"))
+UI_CACHE_TTL = float(os.getenv("UI_CACHE_TTL", "5"))   # seg.; 0 desliga
+UI_CACHE_MAX = int(os.getenv("UI_CACHE_MAX", "200"))
+
+# Logs (JSON por linha, gravados por uma thread de background)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_CORPO = int(os.getenv("LOG_MAX_CORPO", "2000"))          # caracteres de payload/resposta por linha
+LOG_AMOSTRA_CORPO = float(os.getenv("LOG_AMOSTRA_CORPO", "0.05"))  # fração de corpos logados em INFO (DEBUG: todos)
+LOG_FILA_MAX = int(os.getenv("LOG_FILA_MAX", "10000"))           # cheia: descarta em vez de bloquear
+
+# Métricas (/metrics, formato Prometheus; agregadas entre workers via arquivos em METRICS_DIR)
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "pix-metricas"))
+METRICS_FLUSH_SEG = float(os.getenv("METRICS_FLUSH_SEG", "5"))
+METRICS_EXPIRA_SEG = float(os.getenv("METRICS_EXPIRA_SEG", "60"))   # ignora snapshot de worker morto
+
+# Resiliência: disjuntor por upstream, prazo por requisição e descarte de carga
+DISJUNTOR_FALHAS = int(os.getenv("DISJUNTOR_FALHAS", "5"))              # falhas seguidas p/ abrir
+DISJUNTOR_ABERTO_SEG = float(os.getenv("DISJUNTOR_ABERTO_SEG", "30"))   # aberto antes de testar de novo
+DISJUNTOR_TIMEOUT_MIN = float(os.getenv("DISJUNTOR_TIMEOUT_MIN", "2"))  # piso do timeout adaptativo (teto: HTTP_READ_TIMEOUT)
+WEBHOOK_PRAZO_SEG = float(os.getenv("WEBHOOK_PRAZO_SEG", "20"))         # orçamento total da requisição (0 = sem prazo)
+WEBHOOK_MAX_EM_ANDAMENTO = int(os.getenv("WEBHOOK_MAX_EM_ANDAMENTO", "3"))  # pipelines simultâneos por processo (0 = sem limite)
+
+# Tenant: índice codigoempresa -> ESQUEMA e cache de contatos da empresa (cadastro)
+TENANT_ESQUEMAS_TTL = float(os.getenv("TENANT_ESQUEMAS_TTL", "600"))
+TENANT_CONTATOS_TTL = float(os.getenv("TENANT_CONTATOS_TTL", "300"))   # 0 desliga
+TENANT_CONTATOS_MAX = int(os.getenv("TENANT_CONTATOS_MAX", "5000"))
+
+# Verificação de índices/planos (verificar_banco.py); na subida só loga o que faltar
+VERIFICAR_BANCO_NA_SUBIDA = os.getenv("VERIFICAR_BANCO_NA_SUBIDA", "1") == "1"
+
+# Exportação em streaming (/export/recebidos, /export/eventos); vazio = desabilitada
+EXPORT_AUTH = os.getenv("EXPORT_AUTH", "")
+EXPORT_LOTE = int(os.getenv("EXPORT_LOTE", "1000"))                    # linhas por fetchmany/chunk
+EXPORT_NET_WRITE_TIMEOUT = int(os.getenv("EXPORT_NET_WRITE_TIMEOUT", "600"))  # cliente lento não derruba o cursor
+
+# Feed de liquidações (/feed/recebidos long-poll e /feed/recebidos/stream SSE); auth = EXPORT_AUTH
+# Requer sql/006_pix_recebidos_liquidacoes.sql: o upsert registra cada liquidação e o cursor é id_liquidacao
+FEED_RECEBIDOS = os.getenv("FEED_RECEBIDOS", "0") == "1"
+FEED_LACUNA_SEG = float(os.getenv("FEED_LACUNA_SEG", "60"))         # espera por id_liquidacao ainda não commitado
+FEED_POLL_SEG = float(os.getenv("FEED_POLL_SEG", "1"))              # busca de novos por processo (com assinantes)
+FEED_BUFFER = int(os.getenv("FEED_BUFFER", "2000"))                 # últimas liquidações em memória
+FEED_LOTE = int(os.getenv("FEED_LOTE", "500"))
+FEED_ESPERA_MAX = float(os.getenv("FEED_ESPERA_MAX", "25"))         # long-poll
+FEED_HEARTBEAT_SEG = float(os.getenv("FEED_HEARTBEAT_SEG", "15"))   # SSE
+FEED_MAX_ASSINANTES = int(os.getenv("FEED_MAX_ASSINANTES", "2"))    # WSGI: cada assinante prende uma thread
+FEED_MAX_ASSINANTES_ASYNC = int(os.getenv("FEED_MAX_ASSINANTES_ASYNC", "1000"))  # motor ASGI
+
+# Perfil de requisições: header X-Perfil = PERFIL_AUTH (e X-Perfil-Modo: wall|cpu), amostragem
+# e captura automática das lentas; relatórios em /admin/perfis (Authorization = PERFIL_AUTH)
+# Tudo desligado por padrão: sem header/amostra/PERFIL_LENTO_MS nenhuma requisição monta linha do tempo.
+# Captura das lentas: PERFIL_LENTO_MS=2000 (toda requisição passa a anotar SQL/HTTP/etapas, até
+# PERFIL_MAX_EVENTOS, e só as acima do limiar são gravadas em PERFIL_DIR)
+PERFIL_AUTH = os.getenv("PERFIL_AUTH", "")                          # vazio: sem header nem /admin/perfis
+PERFIL_AMOSTRA = float(os.getenv("PERFIL_AMOSTRA", "0"))           # fração de requisições com cProfile
+PERFIL_MODO = os.getenv("PERFIL_MODO", "wall")                     # modo da amostragem: wall ou cpu
+PERFIL_LENTO_MS = float(os.getenv("PERFIL_LENTO_MS", "0"))         # acima disso guarda a linha do tempo (0 = desliga)
+PERFIL_MAX = int(os.getenv("PERFIL_MAX", "100"))                   # relatórios guardados (anel, entre workers)
+PERFIL_DIR = os.getenv("PERFIL_DIR", os.path.join(tempfile.gettempdir(), "pix-perfis"))
+PERFIL_MAX_EVENTOS = int(os.getenv("PERFIL_MAX_EVENTOS", "500"))   # entradas na linha do tempo por requisição
+PERFIL_SQL_MAX = int(os.getenv("PERFIL_SQL_MAX", "300"))           # caracteres de SQL por entrada
+PERFIL_TOP = int(os.getenv("PERFIL_TOP", "40"))                    # funções no relatório do cProfile
+
+# Ingestão em lote (/webhook/pix-pago/lote)
+WEBHOOK_LOTE_MAX = int(os.getenv("WEBHOOK_LOTE_MAX", "5000"))
+WEBHOOK_LOTE_PARALELO = int(os.getenv("WEBHOOK_LOTE_PARALELO", "4"))
+# sem WEBHOOK_ASYNC o lote é processado na requisição: no máximo tantos pix_id distintos
+# (acima disso 413; lotes grandes pedem WEBHOOK_ASYNC=1, que só enfileira e responde 202)
+WEBHOOK_LOTE_SINCRONO_MAX = int(os.getenv("WEBHOOK_LOTE_SINCRONO_MAX", "100"))
+
+# Eventos brutos (pix_webhook_eventos): compactação e arquivamento (requer sql/005_pix_webhook_eventos_compacto.sql)
+# 1 = headers/payload gravados comprimidos (headers_z/json_z) e só os headers de EVENTOS_HEADERS ("*" = todos)
+EVENTOS_COMPACTO = os.getenv("EVENTOS_COMPACTO", "0") == "1"
+EVENTOS_HEADERS = {
+    h.strip().lower()
+    for h in os.getenv("EVENTOS_HEADERS", "Content-Type,Content-Length,User-Agent,X-Forwarded-For,X-Real-Ip,X-Request-Id").split(",")
+    if h.strip()
+}
+EVENTOS_RETENCAO_DIAS = int(os.getenv("EVENTOS_RETENCAO_DIAS", "30"))      # mais antigos vão p/ arquivo (0 = nunca)
+EVENTOS_ARQUIVO_DIR = os.getenv("EVENTOS_ARQUIVO_DIR", "arquivo_eventos")  # gzip NDJSON por dia + indice.sqlite
+EVENTOS_ARQUIVO_LOTE = int(os.getenv("EVENTOS_ARQUIVO_LOTE", "500"))        # linhas por DELETE
+EVENTOS_ARQUIVO_PAUSA_SEG = float(os.getenv("EVENTOS_ARQUIVO_PAUSA_SEG", "0.2"))  # entre lotes (folga p/ réplica/locks)
+EVENTOS_ARQUIVAR_EMBUTIDO = os.getenv("EVENTOS_ARQUIVAR_EMBUTIDO", "0") == "1"   # senão: python arquivar_eventos.py
+EVENTOS_ARQUIVAR_INTERVALO_SEG = float(os.getenv("EVENTOS_ARQUIVAR_INTERVALO_SEG", "3600"))
+
 # PlugzAPI (WhatsApp)
 PLUGZ_API_URL = os.getenv(
     "PLUGZ_API_URL",
     "https://api.plugzapi.com.br/instances/3EB1B4D6B8DE105D283A26D356DD90A9/token/4CD2BC99B9D4070109BC16EA/send-text"
 )
 PLUGZ_CLIENT_TOKEN = os.getenv("PLUGZ_CLIENT_TOKEN", "Fc0dd5429e2674e2e9cea2c0b5b29d000S")
+WHATSAPP_MAX_PARALELO = int(os.getenv("WHATSAPP_MAX_PARALELO", "5"))   # envios simultâneos por processo
+
+# Outbox do WhatsApp (requer sql/003_pix_whatsapp_outbox.sql)
+# 1 = o pipeline só grava a mensagem em pix_whatsapp_outbox (mesma transação do upsert);
+#     o envio fica com o despachante (python despachante.py ou WHATSAPP_DESPACHANTE_EMBUTIDO=1)
+WHATSAPP_OUTBOX = os.getenv("WHATSAPP_OUTBOX", "0") == "1"
+WHATSAPP_DESPACHANTE_EMBUTIDO = os.getenv("WHATSAPP_DESPACHANTE_EMBUTIDO", "0") == "1"
+WHATSAPP_LOTE = int(os.getenv("WHATSAPP_LOTE", "50"))                  # mensagens reservadas por vez
+WHATSAPP_RPS = float(os.getenv("WHATSAPP_RPS", "5"))                   # por instância PlugzAPI (0 = sem limite)
+WHATSAPP_RAJADA = int(os.getenv("WHATSAPP_RAJADA", "5"))
+WHATSAPP_POLL_SEG = float(os.getenv("WHATSAPP_POLL_SEG", "2"))
+WHATSAPP_MAX_TENTATIVAS = int(os.getenv("WHATSAPP_MAX_TENTATIVAS", "8"))
+WHATSAPP_RESERVA_EXPIRA_SEG = int(os.getenv("WHATSAPP_RESERVA_EXPIRA_SEG", "300"))
+
+# HTTP (sessões keep-alive por upstream)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "25"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))                # backoff exponencial base (seg.)
+TECNOSPEED_POOL_SIZE = int(os.getenv("TECNOSPEED_POOL_SIZE", "8"))
+PLUGZ_POOL_SIZE = int(os.getenv("PLUGZ_POOL_SIZE", "8"))
 
 # =========================
 # Tabelas
@@ -47,6 +229,8 @@ TBL_RECEBIDOS = f"{DB_NAME}.pix_recebidos"
 TBL_DADOSPIX = f"{DB_NAME}.dadospix"
 TBL_EVENTOS = f"{DB_NAME}.pix_webhook_eventos"
 TBL_AUTENTICACAO = f"{DB_NAME}.autenticacao"
+TBL_OUTBOX = f"{DB_NAME}.pix_whatsapp_outbox"
+TBL_LIQUIDACOES = f"{DB_NAME}.pix_recebidos_liquidacoes"
 
 
 # =========================
@@ -103,529 +287,4164 @@ def fmt_dt_br(mysql_dt_str):
         return str(mysql_dt_str)
 
 
-# =========================
-# DB
-# =========================
-def db_conn():
-    return pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASS,
-        database=DB_NAME,
-        port=DB_PORT,
-        charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=False,
-    )
+class LimitadorTaxa:
+    """Token bucket thread-safe: no máximo `por_segundo` liberações/s (rajada até `rajada`)."""
+
+    def __init__(self, por_segundo: float, rajada: int = 1):
+        self.por_segundo = float(por_segundo)
+        self.rajada = max(1, rajada)
+        self._fichas = float(self.rajada)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def aguardar(self):
+        if self.por_segundo <= 0:
+            return
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._fichas = min(self.rajada, self._fichas + (agora - self._ultimo) * self.por_segundo)
+                self._ultimo = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                falta = (1 - self._fichas) / self.por_segundo
+            time.sleep(falta)
 
 
 # =========================
-# Vinculo (pix_cobrancas_geradas)
+# HTTP
 # =========================
-def buscar_vinculo_por_pix(cursor, pix_id: str) -> dict:
-    cursor.execute(
-        f"""
-        SELECT
-          id_cobrancas,
-          codigoparasistema,
-          codcadastro,
-          pedidovendaid
-        FROM {TBL_COBRANCAS}
-        WHERE pix_id = %s
-        LIMIT 1
-        """,
-        (pix_id,),
-    )
-    row = cursor.fetchone()
-    return row or {"id_cobrancas": None, "codigoparasistema": None, "codcadastro": None, "pedidovendaid": None}
+class SessaoHTTP(requests.Session):
+    """
+    Session com a política de retry do upstream. O adapter NÃO repete: quem repete é
+    chamar_upstream, dentro do prazo da requisição e passando cada tentativa pelo disjuntor.
+    """
+
+    def __init__(self, metodos_retry, status_retry, retry_leitura: bool):
+        super().__init__()
+        self.metodos_retry = frozenset(metodos_retry)
+        self.status_retry = frozenset(status_retry)
+        self.retry_leitura = retry_leitura
+
+
+def criar_sessao_http(pool_size: int, metodos_retry, status_retry, retry_leitura: bool = True) -> SessaoHTTP:
+    """
+    Sessão keep-alive com pool de conexões (thread-safe para uso compartilhado).
+    Retry (em chamar_upstream) com backoff exponencial + jitter em erro de conexão e nos status_retry.
+    retry_leitura=False: não repete após timeout/erro de leitura (a requisição pode ter sido processada).
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+    sessao = SessaoHTTP(metodos_retry, status_retry, retry_leitura)
+    sessao.mount("https://", adapter)
+    sessao.mount("http://", adapter)
+    return sessao
+
+
+def falha_de_conexao(e: Exception) -> bool:
+    """Erro ao conectar: a requisição certamente não chegou ao upstream (seguro repetir)."""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    motivo = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(motivo, (NewConnectionError, ConnectTimeoutError))
+
+
+# TecnoSpeed: token (client_credentials) e GET são seguros para repetir
+sessao_tecnospeed = criar_sessao_http(TECNOSPEED_POOL_SIZE, ("GET", "POST"), (500, 502, 503, 504))
+
+# PlugzAPI: send-text NÃO é idempotente; só repete quando a mensagem certamente não foi aceita
+# (falha de conexão ou 502/503/504 do gateway), nunca após timeout de leitura
+sessao_plugz = criar_sessao_http(PLUGZ_POOL_SIZE, ("POST",), (502, 503, 504), retry_leitura=False)
 
 
 # =========================
-# Token company (dadospix)
+# Logging
 # =========================
-def buscar_dadospix(cursor, codigoparasistema, codcadastro) -> dict:
-    cursor.execute(
-        f"""
-        SELECT
-          iddadospix,
-          token_company,
-          token_company_expires_at,
-          tecnospeed_client_id,
-          tecnospeed_client_secret
-        FROM {TBL_DADOSPIX}
-        WHERE
-          ( %s IS NULL OR codigoparasistema = %s )
-          AND
-          ( %s IS NULL OR codcadastro = %s )
-        ORDER BY iddadospix DESC
-        LIMIT 1
-        """,
-        (codigoparasistema, codigoparasistema, codcadastro, codcadastro),
-    )
-    return cursor.fetchone() or {}
+# Campos de correlação (pix_id, id_evento, tenant...) da requisição/tarefa atual
+_log_contexto = contextvars.ContextVar("pix_log_contexto", default={})
 
 
-def token_expirado(expires_at) -> bool:
-    if not expires_at:
-        return True
+@contextmanager
+def contexto_log(**campos):
+    """Acrescenta campos de correlação a todas as linhas de log dentro do bloco."""
+    token = _log_contexto.set({**_log_contexto.get(), **{k: v for k, v in campos.items() if v is not None}})
     try:
-        if isinstance(expires_at, str):
-            dt = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
-        else:
-            dt = expires_at
-        # se vier sem tz, assume BR
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=TZ_BR)
-        return (dt - datetime.now(dt.tzinfo)).total_seconds() < 120
-    except Exception:
-        return True
+        yield
+    finally:
+        _log_contexto.reset(token)
 
 
-def renovar_token_company(client_id: str, client_secret: str) -> dict:
-    """
-    POST /oauth2/token
-    Body: grant_type=client_credentials & role=company
-    """
-    url = f"{TECNOSPEED_BASE}/oauth2/token"
-    raw = f"{client_id}:{client_secret}".encode("utf-8")
-    b64 = base64.b64encode(raw).decode("utf-8")
+def acrescentar_contexto_log(**campos):
+    """Como contexto_log, mas vale até o fim da requisição (zerado em before_request)."""
+    _log_contexto.set({**_log_contexto.get(), **{k: v for k, v in campos.items() if v is not None}})
 
-    headers = {
-        "Authorization": f"Basic {b64}",
-        "Content-Type": "application/x-www-form-urlencoded",
-        "Accept": "application/json",
-    }
-    data = {"grant_type": "client_credentials", "role": "company"}
 
-    r = requests.post(url, headers=headers, data=data, timeout=25)
-    if r.status_code not in (200, 201):
-        raise RuntimeError(f"Falha ao renovar token ({r.status_code}): {r.text}")
+def corpo_log(obj) -> str:
+    """Serializa um corpo para log, truncado em LOG_MAX_CORPO."""
+    texto = obj if isinstance(obj, str) else safe_json(obj)
+    if len(texto) > LOG_MAX_CORPO:
+        return texto[:LOG_MAX_CORPO] + f"...(+{len(texto) - LOG_MAX_CORPO})"
+    return texto
 
-    j = r.json() or {}
-    access_token = (j.get("access_token") or "").strip()
-    expires_in = int(j.get("expires_in") or 3600)
 
-    if not access_token:
-        raise RuntimeError(f"Resposta sem access_token: {r.text}")
+def logar_corpo(rotulo: str, obj):
+    """Corpo completo só em DEBUG ou numa amostra de LOG_AMOSTRA_CORPO; senão nem serializa."""
+    if log.isEnabledFor(logging.DEBUG) or (LOG_AMOSTRA_CORPO > 0 and random.random() < LOG_AMOSTRA_CORPO):
+        log.info("%s", rotulo, extra={"corpo": corpo_log(obj)})
 
-    expires_dt = (datetime.now(TZ_BR) + timedelta(seconds=expires_in)).replace(tzinfo=None)
 
-    return {
-        "access_token": access_token,
-        "expires_at": expires_dt.strftime("%Y-%m-%d %H:%M:%S"),
-        "expires_in": expires_in,
-    }
+class _FiltroContexto(logging.Filter):
+    def filter(self, record):
+        record.contexto = _log_contexto.get()
+        return True
 
 
-def garantir_token_company(cursor, codigoparasistema, codcadastro) -> str:
-    dp = buscar_dadospix(cursor, codigoparasistema, codcadastro)
-    if not dp:
-        raise RuntimeError("Não encontrei registro em dadospix para esse vínculo.")
+class _FormatoJson(logging.Formatter):
+    def format(self, record):
+        linha = {
+            "ts": datetime.fromtimestamp(record.created, TZ_BR).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "nivel": record.levelname,
+            "msg": record.getMessage(),
+        }
+        linha.update(getattr(record, "contexto", None) or {})
+        corpo = getattr(record, "corpo", None)
+        if corpo is not None:
+            linha["corpo"] = corpo
+        if record.exc_info:
+            linha["exc"] = self.formatException(record.exc_info)
+        return json.dumps(linha, ensure_ascii=False, default=str)
 
-    token = (dp.get("token_company") or "").strip()
-    expires_at = dp.get("token_company_expires_at")
-    client_id = (dp.get("tecnospeed_client_id") or "").strip()
-    client_secret = (dp.get("tecnospeed_client_secret") or "").strip()
-    iddadospix = dp.get("iddadospix")
 
-    if (not token) or token_expirado(expires_at):
-        novo = renovar_token_company(client_id, client_secret)
-        token = novo["access_token"]
+class _FilaSemBloqueio(logging.handlers.QueueHandler):
+    """Com a fila cheia descarta a linha (e conta) em vez de travar a thread da requisição."""
 
-        cursor.execute(
-            f"""
-            UPDATE {TBL_DADOSPIX}
-            SET token_company=%s,
-                token_company_expires_at=%s
-            WHERE iddadospix=%s
-            """,
-            (token, novo["expires_at"], iddadospix),
-        )
-        print(f"[INFO] Token company renovado (iddadospix={iddadospix}) expira em {novo['expires_at']}")
+    descartadas = 0
 
-    return token
+    def prepare(self, record):
+        # a formatação fica na thread de background; aqui só resolve a mensagem
+        record.msg = record.getMessage()
+        record.args = None
+        return record
 
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _FilaSemBloqueio.descartadas += 1
 
-# =========================
-# TecnoSpeed: Consultar PIX por ID
-# =========================
-def tecnospeed_consultar_pix_por_id(pix_id: str, token_company: str) -> dict:
-    url = f"{TECNOSPEED_BASE}/api/v1/pix/{pix_id}"
-    headers = {"Authorization": f"Bearer {token_company}", "Accept": "application/json"}
-    r = requests.get(url, headers=headers, timeout=25)
-    if r.status_code != 200:
-        raise RuntimeError(f"Consulta PIX por ID falhou ({r.status_code}): {r.text}")
-    data = r.json() or {}
-    return data if isinstance(data, dict) else {}
+
+def configurar_logging() -> logging.Logger:
+    logger = logging.getLogger("pix")
+    if logger.handlers:
+        return logger
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+    fila = queue.Queue(maxsize=LOG_FILA_MAX)
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(_FormatoJson())
+    listener = logging.handlers.QueueListener(fila, saida, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    if hasattr(os, "register_at_fork"):
+        # gunicorn --preload: a thread do listener não sobrevive ao fork
+        os.register_at_fork(after_in_child=listener.start)
+
+    handler = _FilaSemBloqueio(fila)
+    handler.addFilter(_FiltroContexto())
+    logger.addHandler(handler)
+    return logger
+
+
+log = configurar_logging()
 
 
 # =========================
-# Inserts / Updates
+# Métricas
 # =========================
-def inserir_evento(cursor, event_name: str, pix_id: str, headers_json: dict, json_completo: dict):
-    cursor.execute(
-        f"""
-        INSERT INTO {TBL_EVENTOS}
-          (event_name, pix_id, headers_json, json_completo, recebido_em)
-        VALUES
-          (%s, %s, %s, %s, %s)
-        """,
-        (str(event_name or ""), str(pix_id or ""), safe_json(headers_json), safe_json(json_completo), now_str()),
-    )
+BUCKETS_SEG = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
 
 
-def upsert_pix_recebido(cursor, pix_full: dict, vinculo: dict):
+class Metricas:
+    """
+    Contadores, gauges e histogramas em memória (por processo), com um lock só.
+    Cada worker grava um snapshot em METRICS_DIR/<pid>.json; /metrics soma todos.
     """
-    Regras:
-    - Sempre INSERE com pago=0
-    - Em UPDATE: NÃO ALTERA o campo pago (outro robô cuida disso)
-    Retorna: previous_payment_date (pra decidir envio de WhatsApp sem duplicar)
-    """
-    pix_id = str(pix_full.get("id") or "")
-    surrogate = str(pix_full.get("surrogateKey") or "")
-    status = str(pix_full.get("status") or "")
-    amount = pix_full.get("amount")
-    payment_date = parse_iso_dt_to_br(pix_full.get("paymentDate"))
-    payer_doc = str(pix_full.get("payerCpfCnpj") or "")
-    payer_name = str(pix_full.get("payerName") or "")
-    emv = str(pix_full.get("emv") or "")
-    created_at_api = parse_iso_dt_to_br(pix_full.get("createdAt"))
-
-    codigoparasistema = vinculo.get("codigoparasistema")
-    codcadastro = vinculo.get("codcadastro")
-    id_cobrancas = vinculo.get("id_cobrancas")
 
-    cursor.execute(
-        f"SELECT id_recebido, payment_date FROM {TBL_RECEBIDOS} WHERE pix_id=%s LIMIT 1",
-        (pix_id,),
-    )
-    exists = cursor.fetchone()
-    prev_payment_date = (exists.get("payment_date") if exists else None)
-
-    if exists:
-        cursor.execute(
-            f"""
-            UPDATE {TBL_RECEBIDOS}
-            SET
-              surrogate_key=%s,
-              status=%s,
-              amount=%s,
-              payment_date=%s,
-              payer_cpf_cnpj=%s,
-              payer_name=%s,
-              emv=%s,
-              created_at_api=%s,
-              recebido_em=%s,
-              codigoparasistema=%s,
-              codcadastro=%s,
-              id_cobrancas=%s,
-              json_completo=%s
-            WHERE pix_id=%s
-            """,
-            (
-                surrogate, status, amount, payment_date, payer_doc, payer_name, emv, created_at_api,
-                now_str(), codigoparasistema, codcadastro, id_cobrancas, safe_json(pix_full), pix_id
-            ),
-        )
-    else:
-        cursor.execute(
-            f"""
-            INSERT INTO {TBL_RECEBIDOS}
-              (pix_id, surrogate_key, status, amount, payment_date, payer_cpf_cnpj, payer_name, emv,
-               created_at_api, recebido_em, codigoparasistema, codcadastro, id_cobrancas, pago, json_completo)
-            VALUES
-              (%s,%s,%s,%s,%s,%s,%s,%s,
-               %s,%s,%s,%s,%s,0,%s)
-            """,
-            (
-                pix_id, surrogate, status, amount, payment_date, payer_doc, payer_name, emv,
-                created_at_api, now_str(), codigoparasistema, codcadastro, id_cobrancas, safe_json(pix_full)
-            ),
-        )
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._gauges = {}
+        self._histogramas = {}
+        self.coletores = []  # callables(metricas) rodados antes de cada snapshot (gauges de estado)
 
-    return {"previous_payment_date": prev_payment_date, "payment_date": payment_date}
+    @staticmethod
+    def _chave(nome, labels):
+        return (nome, tuple(sorted(labels.items())))
 
+    def inc(self, nome: str, valor: float = 1, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
 
-# =========================
-# WhatsApp
-# =========================
-def format_br_phone(ddd, fone):
-    d = digits(ddd)
-    n = digits(fone)
-    if not d or not n:
-        return None
-    return f"55{d}{n}"
+    def gauge_add(self, nome: str, delta: float, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            self._gauges[chave] = self._gauges.get(chave, 0) + delta
 
+    def gauge_set(self, nome: str, valor: float, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            self._gauges[chave] = valor
 
-def enviar_whatsapp(phone_e164: str, message: str) -> bool:
-    payload = {"phone": phone_e164, "message": message}
-    headers = {"Content-Type": "application/json", "Client-Token": PLUGZ_CLIENT_TOKEN}
+    def observar(self, nome: str, segundos: float, **labels):
+        chave = self._chave(nome, labels)
+        i = 0
+        while i < len(BUCKETS_SEG) and segundos > BUCKETS_SEG[i]:
+            i += 1
+        with self._lock:
+            h = self._histogramas.get(chave)
+            if h is None:
+                h = self._histogramas[chave] = [[0] * (len(BUCKETS_SEG) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += segundos
+            h[2] += 1
 
-    try:
-        resp = requests.post(PLUGZ_API_URL, headers=headers, json=payload, timeout=25)
-        print(f"✅ Mensagem enviada ao WhatsApp {phone_e164}. Status: {resp.status_code}")
-        print("📟 Resposta da PlugzAPI:", resp.text)
-        return resp.status_code in (200, 201)
-    except Exception as e:
-        print(f"❌ Erro ao enviar WhatsApp ({phone_e164}): {repr(e)}")
-        return False
+    @contextmanager
+    def etapa(self, nome: str):
+        """Mede uma etapa do pipeline: pix_etapa_segundos{etapa} + pix_etapa_em_andamento{etapa}."""
+        self.gauge_add("pix_etapa_em_andamento", 1, etapa=nome)
+        perfil = _perfil.get()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar("pix_etapa_segundos", time.perf_counter() - inicio, etapa=nome)
+            self.gauge_add("pix_etapa_em_andamento", -1, etapa=nome)
+            if perfil is not None:
+                perfil.registrar("etapa", nome, inicio)
 
+    def snapshot(self) -> dict:
+        for coletor in self.coletores:
+            try:
+                coletor(self)
+            except Exception:
+                pass
+        with self._lock:
+            return {
+                "contadores": [[n, dict(l), v] for (n, l), v in self._contadores.items()],
+                "gauges": [[n, dict(l), v] for (n, l), v in self._gauges.items()],
+                "histogramas": [[n, dict(l), list(h[0]), h[1], h[2]] for (n, l), h in self._histogramas.items()],
+            }
 
-def obter_schema_por_codigoempresa(cursor, codigoempresa: int) -> str:
-    cursor.execute(
-        f"""
-        SELECT ESQUEMA
-        FROM {TBL_AUTENTICACAO}
-        WHERE CODIGOEMPRESA = %s
-        LIMIT 1
-        """,
-        (codigoempresa,),
-    )
-    row = cursor.fetchone()
-    return (row.get("ESQUEMA") if row else "") or ""
+    # --- agregação entre workers ---
+    def gravar_snapshot(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        destino = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        tmp = destino + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, destino)
 
+    def iniciar_flush(self):
+        def _loop():
+            while True:
+                time.sleep(METRICS_FLUSH_SEG)
+                try:
+                    self.gravar_snapshot()
+                except Exception as e:
+                    log.warning("Falha ao gravar snapshot de métricas: %r", e)
 
-def obter_cliente_empresa_e_telefones(cursor, schema: str, codcadastro: int):
-    cursor.execute(
-        f"""
-        SELECT
-          razaosocial,
-          ddd1, fone1,
-          ddd2, fone2,
-          ddd3, fone3,
-          ddd4, fone4,
-          ddd5, fone5
-        FROM `{schema}`.cadastro
-        WHERE codcadastro = %s
-        LIMIT 1
-        """,
-        (codcadastro,),
-    )
-    c = cursor.fetchone() or {}
-    nome = c.get("razaosocial") or ""
+        threading.Thread(target=_loop, name="pix-metricas", daemon=True).start()
 
-    tels = []
-    for i in range(1, 6):
-        t = format_br_phone(c.get(f"ddd{i}"), c.get(f"fone{i}"))
-        if t:
-            tels.append(t)
+    def agregado(self) -> dict:
+        """Soma os snapshots recentes de todos os workers (o deste processo vem da memória)."""
+        snaps = [self.snapshot()]
+        agora = time.time()
+        for caminho in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            if os.path.basename(caminho) == f"{os.getpid()}.json":
+                continue
+            try:
+                if agora - os.path.getmtime(caminho) > METRICS_EXPIRA_SEG:
+                    continue
+                with open(caminho, "r", encoding="utf-8") as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
 
-    # remove duplicados
-    out, seen = [], set()
-    for t in tels:
-        if t not in seen:
-            out.append(t)
-            seen.add(t)
+        total = {"contadores": {}, "gauges": {}, "histogramas": {}}
+        for snap in snaps:
+            for tipo in ("contadores", "gauges"):
+                for nome, labels, valor in snap.get(tipo, []):
+                    chave = self._chave(nome, labels)
+                    total[tipo][chave] = total[tipo].get(chave, 0) + valor
+            for nome, labels, buckets, soma, qtd in snap.get("histogramas", []):
+                chave = self._chave(nome, labels)
+                h = total["histogramas"].setdefault(chave, [[0] * len(buckets), 0.0, 0])
+                h[0] = [a + b for a, b in zip(h[0], buckets)]
+                h[1] += soma
+                h[2] += qtd
+        return total
 
-    return nome, out
 
+def _labels_prom(labels, extra=None) -> str:
+    itens = list(labels) + (list(extra) if extra else [])
+    if not itens:
+        return ""
+    partes = []
+    for k, v in itens:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        partes.append(f'{k}="{v}"')
+    return "{" + ",".join(partes) + "}"
 
-def obter_codcadastro_cliente_final(cursor, schema: str, pedidovendaid: int):
-    cursor.execute(
-        f"""
-        SELECT codcadastro
-        FROM `{schema}`.pedidovenda
-        WHERE pedidovendaid = %s
-        LIMIT 1
-        """,
-        (pedidovendaid,),
-    )
-    row = cursor.fetchone()
-    return row.get("codcadastro") if row else None
 
+def render_prometheus(total: dict) -> str:
+    linhas, tipos = [], set()
 
-def obter_nome_por_codcadastro(cursor, schema: str, codcadastro: int) -> str:
-    if not codcadastro:
-        return ""
-    cursor.execute(
-        f"""
-        SELECT razaosocial
-        FROM `{schema}`.cadastro
-        WHERE codcadastro=%s
-        LIMIT 1
-        """,
-        (codcadastro,),
-    )
-    r = cursor.fetchone() or {}
-    return r.get("razaosocial") or ""
+    def tipo(nome, t):
+        if nome not in tipos:
+            tipos.add(nome)
+            linhas.append(f"# TYPE {nome} {t}")
 
+    for (nome, labels), v in sorted(total["contadores"].items()):
+        tipo(nome, "counter")
+        linhas.append(f"{nome}{_labels_prom(labels)} {v}")
+    for (nome, labels), v in sorted(total["gauges"].items()):
+        tipo(nome, "gauge")
+        linhas.append(f"{nome}{_labels_prom(labels)} {v}")
+    for (nome, labels), (buckets, soma, qtd) in sorted(total["histogramas"].items()):
+        tipo(nome, "histogram")
+        acumulado = 0
+        for limite, n in zip(list(BUCKETS_SEG) + ["+Inf"], buckets):
+            acumulado += n
+            linhas.append(f"{nome}_bucket{_labels_prom(labels, [('le', limite)])} {acumulado}")
+        linhas.append(f"{nome}_sum{_labels_prom(labels)} {soma}")
+        linhas.append(f"{nome}_count{_labels_prom(labels)} {qtd}")
+    return "\n".join(linhas) + "\n"
 
-def montar_mensagem(nome_cliente_empresa: str, numero_pedido: str, nome_cliente_final: str, valor, data_mysql: str):
-    return (
-        f"Olá, {nome_cliente_empresa}! ✅\n"
-        f"O pagamento do pedido nº {numero_pedido}, referente ao cliente {nome_cliente_final}, foi confirmado com sucesso.\n\n"
-        f"💰 Valor: R$ {money_br(valor)}\n"
-        f"📅 Data: {fmt_dt_br(data_mysql)}"
-    )
+
+metricas = Metricas()
+metricas.coletores.append(lambda m: m.gauge_set("pix_logs_descartados", _FilaSemBloqueio.descartadas))
 
 
 # =========================
-# Routes
+# Perfil de requisições (linha do tempo + cProfile)
 # =========================
-@app.get("/")
-def home():
-    return jsonify({"service": "pix-webhook", "status": "ok"}), 200
+# Perfil da requisição atual; None (padrão) = nada é anotado
+_perfil = contextvars.ContextVar("pix_perfil", default=None)
 
+_RE_SEGREDO_URL = re.compile(r"/[A-Za-z0-9]{16,}")
 
-@app.post("/webhook/pix-pago")
-def webhook_pix():
+
+class PerfilRequisicao:
     """
-    - Recebe PIX_SUCCESSFUL {event,id}
-    - Salva SEMPRE em pix_webhook_eventos
-    - Consulta GET /api/v1/pix/{id}
-    - Se status == LIQUIDATED e paymentDate existe:
-        - upsert pix_recebidos (sem tocar em pago; insert pago=0)
-        - envia WhatsApp APENAS se antes payment_date era NULL e agora não é
+    Linha do tempo de uma requisição (SQL, HTTP e etapas do pipeline, com início e
+    duração) e, se `modo` ("wall" ou "cpu"), o cProfile da thread da requisição.
     """
-    try:
-        auth = request.headers.get("Authorization", "")
-        if WEBHOOK_AUTH and auth != WEBHOOK_AUTH:
-            return jsonify({"error": "Unauthorized"}), 401
-
-        payload = request.get_json(silent=True) or {}
-        event_name = (payload.get("event") or payload.get("type") or "").strip()
-        pix_id = (payload.get("id") or payload.get("pix_id") or "").strip()
 
-        if not pix_id:
-            return jsonify({"error": "pix_id ausente no payload"}), 400
+    def __init__(self, motivo=None, modo=None):
+        self.motivo = motivo  # "header", "amostra" ou None (só guardado se passar de PERFIL_LENTO_MS)
+        self.modo = modo
+        self.inicio = time.perf_counter()
+        self.eventos = []
+        self.descartados = 0
+        self.profiler = None
+        if modo:
+            self.profiler = cProfile.Profile(time.thread_time if modo == "cpu" else time.perf_counter)
 
-        print("\n📨 Webhook recebido:")
-        print(json.dumps(payload, ensure_ascii=False))
+    def iniciar(self):
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:   # outro profiler já ativo nesta thread
+                self.profiler = None
 
-        headers_dict = {k: v for k, v in request.headers.items()}
+    def parar(self) -> float:
+        if self.profiler is not None:
+            self.profiler.disable()
+        return time.perf_counter() - self.inicio
 
-        conn = db_conn()
-        try:
-            with conn.cursor() as cursor:
-                inserir_evento(cursor, event_name, pix_id, headers_dict, payload)
+    def registrar(self, tipo: str, detalhe: str, inicio: float, **extra):
+        if len(self.eventos) >= PERFIL_MAX_EVENTOS:
+            self.descartados += 1
+            return
+        agora = time.perf_counter()
+        self.eventos.append({
+            "tipo": tipo,
+            "inicio_ms": round((inicio - self.inicio) * 1000, 2),
+            "duracao_ms": round((agora - inicio) * 1000, 2),
+            "detalhe": detalhe,
+            **extra,
+        })
 
-                if event_name.upper() == "PIX_SUCCESSFUL":
-                    vinculo = buscar_vinculo_por_pix(cursor, pix_id)
-                    if not vinculo.get("codigoparasistema"):
-                        print(f"[WARN] Sem vínculo em pix_cobrancas_geradas para pix_id={pix_id}.")
-                        conn.commit()
-                        return jsonify({"ok": True, "warn": "Sem vínculo"}), 200
+    def relatorio(self, duracao: float, **campos) -> dict:
+        resumo = {}
+        for ev in self.eventos:
+            r = resumo.setdefault(ev["tipo"], {"qtd": 0, "ms": 0.0})
+            r["qtd"] += 1
+            r["ms"] = round(r["ms"] + ev["duracao_ms"], 2)
+        rel = {
+            "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+            "em": now_str(),
+            "pid": os.getpid(),
+            "duracao_ms": round(duracao * 1000, 2),
+            "motivo": self.motivo or "lenta",
+            "modo": self.modo if self.profiler is not None else None,
+            **campos,
+            "resumo": resumo,
+            "linha_do_tempo": self.eventos,
+            "eventos_descartados": self.descartados,
+        }
+        if self.profiler is not None:
+            buf = io.StringIO()
+            pstats.Stats(self.profiler, stream=buf).sort_stats("cumulative").print_stats(PERFIL_TOP)
+            rel["perfil"] = buf.getvalue()
+        return rel
 
-                    token_company = garantir_token_company(
-                        cursor,
-                        vinculo.get("codigoparasistema"),
-                        vinculo.get("codcadastro"),
-                    )
 
-                    pix_full = tecnospeed_consultar_pix_por_id(pix_id, token_company)
+def resumo_sql(query) -> str:
+    """SQL em uma linha, truncado (sem os parâmetros)."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", errors="replace")
+    texto = " ".join(str(query).split())
+    return texto if len(texto) <= PERFIL_SQL_MAX else texto[:PERFIL_SQL_MAX] + "..."
 
-                    print("[INFO] Retorno TecnoSpeed /api/v1/pix/{id}:")
-                    print(json.dumps(pix_full, ensure_ascii=False))
 
-                    status_pix = str(pix_full.get("status") or "").upper().strip()
-                    payment_date_br = parse_iso_dt_to_br(pix_full.get("paymentDate"))
+def resumo_url(metodo: str, url: str) -> str:
+    """MÉTODO host/caminho, sem query e com segmentos longos (tokens, ids) mascarados."""
+    partes = urlsplit(url)
+    return f"{metodo} {partes.netloc}{_RE_SEGREDO_URL.sub('/***', partes.path)}"
 
-                    # sempre salva/atualiza no recebidos (sem mexer no pago)
-                    info = upsert_pix_recebido(cursor, pix_full, vinculo)
 
-                    # manda WhatsApp apenas quando realmente liquidado e acabou de ganhar payment_date
-                    prev_pd = info.get("previous_payment_date")
-                    now_pd = info.get("payment_date")
+class CursorPerfilado(pymysql.cursors.DictCursor):
+    """DictCursor que anota cada execute na linha do tempo da requisição (se houver uma)."""
 
-                    if status_pix == "LIQUIDATED" and now_pd and (not prev_pd):
-                        schema = obter_schema_por_codigoempresa(cursor, vinculo.get("codigoparasistema"))
-                        schema = (schema or "").strip().lower()
+    def execute(self, query, args=None):
+        perfil = _perfil.get()
+        if perfil is None:
+            return super().execute(query, args)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            perfil.registrar("sql", resumo_sql(query), inicio, linhas=self.rowcount)
 
-                        nome_empresa, telefones = obter_cliente_empresa_e_telefones(
-                            cursor, schema, vinculo.get("codcadastro")
-                        )
 
-                        pedidovendaid = vinculo.get("pedidovendaid")
-                        cod_final = obter_codcadastro_cliente_final(cursor, schema, pedidovendaid)
-                        nome_final = obter_nome_por_codcadastro(cursor, schema, cod_final)
+def guardar_perfil(relatorio: dict):
+    """Grava em PERFIL_DIR (compartilhado entre workers) e mantém só os PERFIL_MAX mais novos."""
+    os.makedirs(PERFIL_DIR, exist_ok=True)
+    caminho = os.path.join(PERFIL_DIR, f"{relatorio['id']}.json")
+    tmp = caminho + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, default=str)
+    os.replace(tmp, caminho)
+    for antigo in sorted(glob.glob(os.path.join(PERFIL_DIR, "*.json")))[:-PERFIL_MAX]:
+        try:
+            os.remove(antigo)
+        except OSError:
+            pass
 
-                        valor = pix_full.get("amount")
 
-                        msg = montar_mensagem(
-                            nome_cliente_empresa=nome_empresa or "Cliente",
-                            numero_pedido=str(pedidovendaid or ""),
-                            nome_cliente_final=nome_final or "Cliente",
-                            valor=valor,
-                            data_mysql=payment_date_br or "",
-                        )
+def listar_perfis() -> list:
+    """Relatórios guardados, do mais novo para o mais antigo (sem linha do tempo nem cProfile)."""
+    itens = []
+    for caminho in sorted(glob.glob(os.path.join(PERFIL_DIR, "*.json")), reverse=True):
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                rel = json.load(f)
+        except (OSError, ValueError):
+            continue
+        rel.pop("linha_do_tempo", None)
+        rel["perfil"] = "perfil" in rel
+        itens.append(rel)
+    return itens
 
-                        if telefones:
-                            for fone in telefones:
-                                enviar_whatsapp(fone, msg)
-                        else:
-                            print(f"[WARN] Nenhum telefone encontrado em {schema}.cadastro (codcadastro={vinculo.get('codcadastro')}).")
-                    else:
-                        print(f"[INFO] Não envia WhatsApp (status={status_pix}, paymentDate={payment_date_br}, prev_payment_date={prev_pd}).")
 
-                conn.commit()
+def ler_perfil(id_perfil: str):
+    if not re.fullmatch(r"[0-9]+-[0-9a-f]{8}", id_perfil or ""):
+        return None
+    try:
+        with open(os.path.join(PERFIL_DIR, f"{id_perfil}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
-        return jsonify({"ok": True}), 200
+# =========================
+# DB
+# =========================
+class ConexaoPool:
+    """
+    Conexão emprestada do pool. Repassa tudo para a conexão pymysql;
+    close() devolve ao pool em vez de fechar o socket.
+    """
 
-    except Exception as e:
-        print("❌ ERRO WEBHOOK:", repr(e))
-        return jsonify({"ok": False, "error": str(e)}), 500
+    def __init__(self, pool, conn, criada_em):
+        self._pool = pool
+        self._conn = conn
+        self._criada_em = criada_em
 
+    def __getattr__(self, nome):
+        if self._conn is None:
+            raise RuntimeError("Conexão já devolvida ao pool.")
+        return getattr(self._conn, nome)
 
-@app.get("/ui")
-def ui():
-    pix_id = request.args.get("pix_id", "").strip()
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.devolver(conn, self._criada_em)
 
-    conn = db_conn()
-    try:
-        with conn.cursor() as cursor:
-            if pix_id:
-                cursor.execute(
-                    f"SELECT * FROM {TBL_EVENTOS} WHERE pix_id=%s ORDER BY id_evento DESC LIMIT 50",
-                    (pix_id,),
-                )
-                eventos = cursor.fetchall()
+    def descartar(self):
+        """Fecha de verdade (conexão quebrada / estado duvidoso)."""
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.devolver(conn, self._criada_em, descartar=True)
 
-                cursor.execute(
-                    f"SELECT * FROM {TBL_RECEBIDOS} WHERE pix_id=%s LIMIT 1",
-                    (pix_id,),
-                )
-                recebidos = cursor.fetchone()
-            else:
-                cursor.execute(f"SELECT * FROM {TBL_EVENTOS} ORDER BY id_evento DESC LIMIT 50")
-                eventos = cursor.fetchall()
 
-                cursor.execute(f"SELECT * FROM {TBL_RECEBIDOS} ORDER BY id_recebido DESC LIMIT 50")
-                recebidos = cursor.fetchall()
+class PoolMySQL:
+    """
+    Pool thread-safe de conexões pymysql, um por processo (worker do gunicorn).
+    - LIFO: reaproveita a conexão mais quente
+    - recicla conexões com mais de `recycle` segundos
+    - ping antes de entregar conexão ociosa há mais de `ping_apos` segundos
+    - rollback antes de voltar ao pool se ficou transação aberta
+    """
+
+    def __init__(self, tamanho, timeout, recycle, ping_apos, **connect_kwargs):
+        self.tamanho = max(1, tamanho)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_apos = ping_apos
+        self._kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._livres = []  # [(conn, criada_em, devolvida_em)]
+        self._abertas = 0
+        self._pid = os.getpid()
+
+        # estatísticas de espera por conexão
+        self.esperas = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+        self.timeouts = 0
+
+    def _checar_fork(self):
+        # após fork (gunicorn --preload) as conexões herdadas não podem ser usadas
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._livres = []
+            self._abertas = 0
+
+    def _conectar(self):
+        return pymysql.connect(**self._kwargs), time.monotonic()
+
+    def conexao_avulsa(self, **sobrescrever):
+        """Conexão fora do pool (mesmos parâmetros), ex.: cursor sem buffer de exportação."""
+        return pymysql.connect(**{**self._kwargs, **sobrescrever})
+
+    def _fechar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def obter(self) -> ConexaoPool:
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        item = None
+
+        with self._cond:
+            self._checar_fork()
+            while True:
+                if self._livres:
+                    item = self._livres.pop()
+                    break
+                if self._abertas < self.tamanho:
+                    self._abertas += 1
+                    break
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.timeouts += 1
+                    metricas.inc("pix_db_pool_timeouts_total")
+                    raise RuntimeError(
+                        f"Pool MySQL esgotado: nenhuma conexão livre em {self.timeout:.1f}s "
+                        f"(tamanho={self.tamanho})"
+                    )
+                self._cond.wait(restante)
+
+            espera = time.monotonic() - inicio
+            metricas.observar("pix_db_pool_espera_segundos", espera)
+            self.esperas += 1
+            self.espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+
+        if espera >= DB_POOL_ESPERA_ALERTA:
+            log.warning("Pool MySQL: esperou %.0fms por conexão (tamanho=%s)", espera * 1000, self.tamanho)
+
+        try:
+            if item is None:
+                conn, criada_em = self._conectar()
+            else:
+                conn, criada_em, devolvida_em = item
+                agora = time.monotonic()
+                if agora - criada_em > self.recycle:
+                    self._fechar(conn)
+                    conn, criada_em = self._conectar()
+                elif agora - devolvida_em > self.ping_apos:
+                    try:
+                        conn.ping(reconnect=False)
+                    except Exception:
+                        self._fechar(conn)
+                        conn, criada_em = self._conectar()
+        except Exception:
+            with self._cond:
+                self._abertas -= 1
+                self._cond.notify()
+            raise
+
+        return ConexaoPool(self, conn, criada_em)
+
+    def devolver(self, conn, criada_em, descartar=False):
+        if not descartar and (conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS):
+            try:
+                conn.rollback()
+            except Exception:
+                descartar = True
+
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            if descartar or not conn.open:
+                self._abertas -= 1
+                self._fechar(conn)
+            else:
+                self._livres.append((conn, criada_em, time.monotonic()))
+            self._cond.notify()
+
+    def estatisticas(self) -> dict:
+        with self._cond:
+            return {
+                "tamanho": self.tamanho,
+                "abertas": self._abertas,
+                "livres": len(self._livres),
+                "esperas": self.esperas,
+                "espera_media_ms": round(self.espera_total / self.esperas * 1000, 2) if self.esperas else 0.0,
+                "espera_max_ms": round(self.espera_max * 1000, 2),
+                "timeouts": self.timeouts,
+            }
+
+
+CONEXAO_PRIMARIO = dict(
+    host=DB_HOST,
+    user=DB_USER,
+    password=DB_PASS,
+    database=DB_NAME,
+    port=DB_PORT,
+    charset="utf8mb4",
+    cursorclass=CursorPerfilado,
+    autocommit=False,
+)
+
+db_pool = PoolMySQL(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_APOS, **CONEXAO_PRIMARIO)
+
+# Rotinas de background (eventos assíncronos, renovador, despachante, feed, arquivador) têm
+# pool próprio: pipeline lento na TecnoSpeed não esgota as conexões das requisições
+db_pool_background = PoolMySQL(
+    DB_POOL_BACKGROUND_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_APOS, **CONEXAO_PRIMARIO
+)
+
+
+def _coletar_pool(m: Metricas):
+    est = db_pool.estatisticas()
+    m.gauge_set("pix_db_pool_conexoes_abertas", est["abertas"])
+    m.gauge_set("pix_db_pool_conexoes_livres", est["livres"])
+    est = db_pool_background.estatisticas()
+    m.gauge_set("pix_db_pool_background_conexoes_abertas", est["abertas"])
+    m.gauge_set("pix_db_pool_background_conexoes_livres", est["livres"])
+
+
+metricas.coletores.append(_coletar_pool)
+
+
+def db_conn():
+    """Conexão do pool; conn.close() devolve ao pool."""
+    with metricas.etapa("db_conn"):
+        return db_pool.obter()
+
+
+def db_conn_background():
+    """Conexão do pool das rotinas de background (nunca disputa com as requisições)."""
+    return db_pool_background.obter()
+
+
+# =========================
+# Réplica de leitura (roteamento)
+# =========================
+class RoteadorLeitura:
+    """
+    Leituras que toleram dado um pouco atrasado (monitor, exportação, recuperação do
+    feed, tenant/contatos) vão para a réplica; escritas e o resto da transação do
+    webhook ficam no primário.
+    - a cada `checagem_seg` mede o atraso da réplica (SHOW REPLICA STATUS); acima de
+      `atraso_max`, replicação parada ou erro: leituras no primário até a próxima checagem
+    - erro de conexão no meio de uma leitura: marca a réplica e refaz no primário
+    """
+
+    def __init__(self, replica, atraso_max: float, checagem_seg: float):
+        self.replica = replica
+        self.atraso_max = atraso_max
+        self.checagem_seg = checagem_seg
+        self.atraso = None
+        self.motivo = "desligada" if replica is None else "não checada"
+        self._saudavel = False
+        self._checada_em = None
+        self._lock = threading.Lock()
+        self._sem_privilegio_avisado = False
+
+    def _medir_atraso(self, conn):
+        """Segundos de atraso; None = replicação parada."""
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except pymysql.err.ProgrammingError:
+                cursor.execute("SHOW SLAVE STATUS")   # MySQL < 8.0.22
+            row = cursor.fetchone()
+        conn.commit()
+        if not row:
+            return 0.0   # endpoint que não é réplica direta (proxy, Aurora): sem como medir
+        atraso = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        return None if atraso is None else float(atraso)
+
+    def _checar(self):
+        conn = None
+        try:
+            conn = self.replica.obter()
+            atraso = self._medir_atraso(conn)
+        except pymysql.err.OperationalError as e:
+            if e.args and e.args[0] == 1227:
+                # sem REPLICATION CLIENT: conectou, mas o atraso não é mensurável
+                if not self._sem_privilegio_avisado:
+                    self._sem_privilegio_avisado = True
+                    log.warning("Réplica: usuário sem REPLICATION CLIENT; atraso não é verificado.")
+                self._marcar(True, None, "ok (atraso não verificado)")
+            else:
+                self._marcar(False, None, f"erro: {e!r}")
+            return
+        except Exception as e:
+            self._marcar(False, None, f"erro: {e!r}")
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        if atraso is None:
+            self._marcar(False, None, "replicação parada")
+        elif atraso > self.atraso_max:
+            self._marcar(False, atraso, f"atraso de {atraso:.0f}s")
+        else:
+            self._marcar(True, atraso, "ok")
+
+    def _marcar(self, saudavel: bool, atraso, motivo: str):
+        mudou = saudavel != self._saudavel
+        self._saudavel, self.atraso, self.motivo = saudavel, atraso, motivo
+        self._checada_em = time.monotonic()
+        if mudou and saudavel:
+            log.info("Réplica de leitura em uso (%s).", motivo)
+        elif mudou or not saudavel:
+            log.warning("Réplica de leitura fora de uso, leituras no primário: %s", motivo)
+
+    def usar_replica(self) -> bool:
+        if self.replica is None:
+            return False
+        checada_em = self._checada_em
+        if checada_em is None or time.monotonic() - checada_em >= self.checagem_seg:
+            # uma thread checa; as outras seguem com o último estado (na 1ª vez, esperam)
+            if self._lock.acquire(blocking=checada_em is None):
+                try:
+                    if self._checada_em is None or time.monotonic() - self._checada_em >= self.checagem_seg:
+                        self._checar()
+                finally:
+                    self._lock.release()
+        return self._saudavel
+
+    def falhou(self, erro):
+        self._marcar(False, self.atraso, f"erro: {erro!r}")
+
+    def executar(self, fn, cursor_primario=None):
+        """
+        fn(cursor) numa conexão de leitura. Sem réplica utilizável roda em
+        `cursor_primario` (se dado, sem pegar outra conexão) ou numa conexão do primário.
+        """
+        conn = None
+        if self.usar_replica():
+            try:
+                conn = self.replica.obter()
+            except Exception as e:   # réplica fora ou pool dela esgotado
+                self.falhou(e)
+        if conn is not None:
+            try:
+                with conn.cursor() as cursor:
+                    resultado = fn(cursor)
+                conn.commit()
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                conn.descartar()
+                self.falhou(e)
+            except Exception:
+                conn.close()
+                raise
+            else:
+                conn.close()
+                metricas.inc("pix_db_leituras_total", destino="replica")
+                return resultado
+
+        metricas.inc("pix_db_leituras_total", destino="primario")
+        if cursor_primario is not None:
+            return fn(cursor_primario)
+        conn = db_conn()
+        try:
+            with conn.cursor() as cursor:
+                resultado = fn(cursor)
+            conn.commit()
+            return resultado
+        finally:
+            conn.close()
+
+    def conexao_avulsa(self, **sobrescrever):
+        """Conexão fora do pool para leitura longa (exportação): réplica se utilizável."""
+        if self.usar_replica():
+            try:
+                return self.replica.conexao_avulsa(**sobrescrever)
+            except pymysql.err.MySQLError as e:
+                self.falhou(e)
+        return db_pool.conexao_avulsa(**sobrescrever)
+
+
+db_replica_pool = None
+if DB_REPLICA_HOST:
+    db_replica_pool = PoolMySQL(
+        DB_REPLICA_POOL_SIZE,
+        DB_REPLICA_POOL_TIMEOUT,
+        DB_POOL_RECYCLE,
+        DB_POOL_PING_APOS,
+        host=DB_REPLICA_HOST,
+        user=DB_REPLICA_USER,
+        password=DB_REPLICA_PASS,
+        database=DB_NAME,
+        port=DB_REPLICA_PORT,
+        charset="utf8mb4",
+        cursorclass=CursorPerfilado,
+        autocommit=False,
+        init_command="SET SESSION TRANSACTION READ ONLY",   # escrita roteada errado falha em vez de divergir
+    )
+
+roteador_leitura = RoteadorLeitura(db_replica_pool, DB_REPLICA_ATRASO_MAX_SEG, DB_REPLICA_CHECAGEM_SEG)
+
+
+def _coletar_replica(m: Metricas):
+    if db_replica_pool is None:
+        return
+    m.gauge_set("pix_db_replica_em_uso", 1 if roteador_leitura._saudavel else 0)
+    if roteador_leitura.atraso is not None:
+        m.gauge_set("pix_db_replica_atraso_segundos", roteador_leitura.atraso)
+    est = db_replica_pool.estatisticas()
+    m.gauge_set("pix_db_replica_conexoes_abertas", est["abertas"])
+
+
+metricas.coletores.append(_coletar_replica)
+
+
+# =========================
+# Resiliência (disjuntores, prazo, carga)
+# =========================
+class UpstreamIndisponivel(RuntimeError):
+    """Chamada não feita/abortada para não prender a thread; retry_apos em segundos."""
+
+    def __init__(self, mensagem: str, retry_apos: float = DISJUNTOR_ABERTO_SEG):
+        super().__init__(mensagem)
+        self.retry_apos = retry_apos
+
+
+class PrazoEsgotado(UpstreamIndisponivel):
+    pass
+
+
+class Disjuntor:
+    """
+    Circuit breaker de um upstream (thread-safe) + timeout de leitura adaptativo.
+    - fechado: chamadas normais; `falhas` seguidas (erro de rede, timeout, 5xx, 429) abrem
+    - aberto: recusa na hora por `aberto_seg`; depois meio_aberto deixa passar UMA sonda
+    - timeout de leitura = latência suavizada + 4 desvios (estilo RTO do TCP),
+      entre timeout_min e timeout_max
+    """
+
+    def __init__(self, nome: str, falhas: int, aberto_seg: float, timeout_min: float, timeout_max: float):
+        self.nome = nome
+        self.falhas_para_abrir = max(1, falhas)
+        self.aberto_seg = aberto_seg
+        self.timeout_min = min(timeout_min, timeout_max)
+        self.timeout_max = timeout_max
+        self.estado = "fechado"
+        self._falhas = 0
+        self._aberto_ate = 0.0
+        self._sonda = False
+        self._srtt = None
+        self._rttvar = 0.0
+        self._lock = threading.Lock()
+
+    def aberto(self) -> bool:
+        with self._lock:
+            return self.estado == "aberto" and time.monotonic() < self._aberto_ate
+
+    def retry_apos(self) -> float:
+        with self._lock:
+            return max(1.0, self._aberto_ate - time.monotonic())
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == "fechado":
+                return
+            if self.estado == "aberto" and time.monotonic() >= self._aberto_ate:
+                self.estado, self._sonda = "meio_aberto", False
+            if self.estado == "meio_aberto" and not self._sonda:
+                self._sonda = True
+                return
+            restante = max(1.0, self._aberto_ate - time.monotonic())
+        metricas.inc("pix_upstream_recusas_total", upstream=self.nome)
+        raise UpstreamIndisponivel(f"{self.nome} indisponível (disjuntor aberto)", restante)
+
+    def sucesso(self, duracao: float):
+        with self._lock:
+            if self._srtt is None:
+                self._srtt, self._rttvar = duracao, duracao / 2
+            else:
+                self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - duracao)
+                self._srtt = 0.875 * self._srtt + 0.125 * duracao
+            self._falhas = 0
+            fechou = self.estado != "fechado"
+            self.estado = "fechado"
+        if fechou:
+            log.info("Disjuntor %s fechado (upstream respondeu).", self.nome)
+
+    def falha(self):
+        with self._lock:
+            self._falhas += 1
+            abrir = self.estado == "meio_aberto" or self._falhas >= self.falhas_para_abrir
+            if abrir:
+                self.estado = "aberto"
+                self._aberto_ate = time.monotonic() + self.aberto_seg
+                self._sonda = False
+        if abrir:
+            metricas.inc("pix_upstream_disjuntor_aberturas_total", upstream=self.nome)
+            log.warning("Disjuntor %s aberto por %ss após %s falha(s).", self.nome, self.aberto_seg, self._falhas)
+
+    def liberar_sonda(self):
+        """Chamada interrompida sem veredito (cancelada, erro local): outra sonda pode passar."""
+        with self._lock:
+            if self.estado == "meio_aberto":
+                self._sonda = False
+
+    def timeout_leitura(self) -> float:
+        with self._lock:
+            if self._srtt is None:
+                return self.timeout_max
+            return min(self.timeout_max, max(self.timeout_min, self._srtt + 4 * self._rttvar))
+
+
+disjuntor_tecnospeed = Disjuntor("tecnospeed", DISJUNTOR_FALHAS, DISJUNTOR_ABERTO_SEG,
+                                 DISJUNTOR_TIMEOUT_MIN, HTTP_READ_TIMEOUT)
+disjuntor_plugz = Disjuntor("plugz", DISJUNTOR_FALHAS, DISJUNTOR_ABERTO_SEG,
+                            DISJUNTOR_TIMEOUT_MIN, HTTP_READ_TIMEOUT)
+
+
+def _coletar_disjuntores(m: Metricas):
+    for d in (disjuntor_tecnospeed, disjuntor_plugz):
+        m.gauge_set("pix_upstream_disjuntor_aberto", 1 if d.estado != "fechado" else 0, upstream=d.nome)
+        m.gauge_set("pix_upstream_timeout_leitura_segundos", d.timeout_leitura(), upstream=d.nome)
+
+
+metricas.coletores.append(_coletar_disjuntores)
+
+
+# Prazo (time.monotonic) da requisição/tarefa atual; None = sem prazo
+_prazo = contextvars.ContextVar("pix_prazo", default=None)
+
+
+@contextmanager
+def prazo_requisicao(segundos: float):
+    """Orçamento de tempo compartilhado pelas etapas (propaga com copy_context)."""
+    token = _prazo.set(time.monotonic() + segundos if segundos > 0 else None)
+    try:
+        yield
+    finally:
+        _prazo.reset(token)
+
+
+def tempo_restante():
+    fim = _prazo.get()
+    return None if fim is None else fim - time.monotonic()
+
+
+def timeout_upstream(disjuntor: Disjuntor):
+    """(connect, read) limitado pelo timeout adaptativo e pelo que resta do prazo."""
+    leitura = disjuntor.timeout_leitura()
+    restante = tempo_restante()
+    if restante is not None:
+        if restante < 0.5:
+            metricas.inc("pix_prazo_esgotado_total", upstream=disjuntor.nome)
+            raise PrazoEsgotado(f"Prazo da requisição esgotado antes de chamar {disjuntor.nome}", 1.0)
+        leitura = min(leitura, restante)
+    return (min(HTTP_CONNECT_TIMEOUT, leitura), leitura)
+
+
+def atraso_nova_tentativa(tentativa: int, retry_after=None):
+    """
+    Espera antes da próxima tentativa: backoff exponencial + jitter (ou o Retry-After do
+    upstream, até HTTP_READ_TIMEOUT). None = não cabe no que resta do prazo.
+    """
+    atraso = HTTP_BACKOFF * (2 ** tentativa) + random.uniform(0, HTTP_BACKOFF)
+    if retry_after:
+        try:
+            atraso = max(atraso, min(float(retry_after), HTTP_READ_TIMEOUT))
+        except ValueError:
+            pass
+    restante = tempo_restante()
+    if restante is not None and restante - atraso < 0.5:
+        return None
+    return atraso
+
+
+def chamar_upstream(disjuntor: Disjuntor, sessao: requests.Session, metodo: str, url: str, **kwargs):
+    """
+    sessao.request com disjuntor + prazo. 5xx/429 e erros de rede contam como falha.
+    Repete conforme a política da SessaoHTTP; a cada tentativa o timeout é recalculado pelo
+    que resta do prazo e o disjuntor é consultado de novo (aberto no meio = para de repetir).
+    """
+    repetir = isinstance(sessao, SessaoHTTP) and metodo.upper() in sessao.metodos_retry
+    tentativas = HTTP_RETRIES + 1 if repetir else 1
+    perfil = _perfil.get()
+    for tentativa in range(tentativas):
+        ultima = tentativa == tentativas - 1
+        timeout = timeout_upstream(disjuntor)
+        disjuntor.permitir()
+        inicio = time.perf_counter()
+        try:
+            r = sessao.request(metodo, url, timeout=timeout, **kwargs)
+        except Exception as e:
+            disjuntor.falha()
+            if perfil is not None:
+                perfil.registrar("http", resumo_url(metodo, url), inicio, upstream=disjuntor.nome, erro=repr(e)[:200])
+            rede = isinstance(e, (requests.ConnectionError, requests.Timeout))
+            if ultima or not rede or not (sessao.retry_leitura or falha_de_conexao(e)):
+                raise
+            atraso = atraso_nova_tentativa(tentativa)
+            if atraso is None:
+                raise
+        else:
+            if perfil is not None:
+                perfil.registrar("http", resumo_url(metodo, url), inicio, upstream=disjuntor.nome, status=r.status_code)
+            if r.status_code >= 500 or r.status_code == 429:
+                disjuntor.falha()
+            else:
+                disjuntor.sucesso(time.perf_counter() - inicio)
+            if ultima or r.status_code not in sessao.status_retry:
+                return r
+            atraso = atraso_nova_tentativa(tentativa, r.headers.get("Retry-After"))
+            if atraso is None:
+                return r
+            r.close()
+        metricas.inc("pix_upstream_retentativas_total", upstream=disjuntor.nome)
+        time.sleep(atraso)
+
+
+# Vagas de pipeline por processo: sem vaga, o webhook grava o evento e responde na hora
+_vagas_pipeline = threading.BoundedSemaphore(WEBHOOK_MAX_EM_ANDAMENTO) if WEBHOOK_MAX_EM_ANDAMENTO > 0 else None
+
+
+@contextmanager
+def vaga_pipeline():
+    """Yield True se conseguiu vaga (sem esperar), False se o processo está saturado."""
+    if _vagas_pipeline is None:
+        yield True
+        return
+    if not _vagas_pipeline.acquire(blocking=False):
+        metricas.inc("pix_webhook_descartes_total", motivo="saturado")
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        _vagas_pipeline.release()
+
+
+# =========================
+# Vinculo (pix_cobrancas_geradas)
+# =========================
+# SQL em constantes: compartilhado com o motor assíncrono (app_async.py)
+SQL_VINCULO_POR_PIX = f"""
+    SELECT
+      id_cobrancas,
+      codigoparasistema,
+      codcadastro,
+      pedidovendaid
+    FROM {TBL_COBRANCAS}
+    WHERE pix_id = %s
+    LIMIT 1
+"""
+VINCULO_VAZIO = {"id_cobrancas": None, "codigoparasistema": None, "codcadastro": None, "pedidovendaid": None}
+
+
+def buscar_vinculo_por_pix(cursor, pix_id: str) -> dict:
+    cursor.execute(SQL_VINCULO_POR_PIX, (pix_id,))
+    row = cursor.fetchone()
+    return row or dict(VINCULO_VAZIO)
+
+
+# =========================
+# Token company (dadospix)
+# =========================
+_SQL_DADOSPIX_BASE = f"""
+    SELECT
+      iddadospix,
+      token_company,
+      token_company_expires_at,
+      tecnospeed_client_id,
+      tecnospeed_client_secret
+    FROM {TBL_DADOSPIX}
+    {{where}}
+    ORDER BY iddadospix DESC
+    LIMIT 1
+"""
+
+# Uma forma de consulta por combinação de chaves NULL: "(%s IS NULL OR col = %s)" impede
+# o MySQL de usar índice. Chave: (tem codigoparasistema, tem codcadastro).
+SQL_DADOSPIX = {
+    (True, True): _SQL_DADOSPIX_BASE.format(where="WHERE codigoparasistema = %s AND codcadastro = %s"),
+    (True, False): _SQL_DADOSPIX_BASE.format(where="WHERE codigoparasistema = %s"),
+    (False, True): _SQL_DADOSPIX_BASE.format(where="WHERE codcadastro = %s"),
+    (False, False): _SQL_DADOSPIX_BASE.format(where=""),
+}
+
+
+def sql_dadospix(codigoparasistema, codcadastro):
+    """(sql, params) de dadospix para o vínculo; None = qualquer valor daquela coluna."""
+    chaves = (codigoparasistema is not None, codcadastro is not None)
+    params = tuple(v for v in (codigoparasistema, codcadastro) if v is not None)
+    return SQL_DADOSPIX[chaves], params
+
+
+SQL_ATUALIZAR_TOKEN = f"""
+    UPDATE {TBL_DADOSPIX}
+    SET token_company=%s,
+        token_company_expires_at=%s
+    WHERE iddadospix=%s
+"""
+
+
+def buscar_dadospix(cursor, codigoparasistema, codcadastro) -> dict:
+    cursor.execute(*sql_dadospix(codigoparasistema, codcadastro))
+    return cursor.fetchone() or {}
+
+
+def token_expirado(expires_at) -> bool:
+    if not expires_at:
+        return True
+    try:
+        if isinstance(expires_at, str):
+            dt = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+        else:
+            dt = expires_at
+        # se vier sem tz, assume BR
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=TZ_BR)
+        return (dt - datetime.now(dt.tzinfo)).total_seconds() < 120
+    except Exception:
+        return True
+
+
+def requisicao_token_company(client_id: str, client_secret: str):
+    """
+    POST /oauth2/token
+    Body: grant_type=client_credentials & role=company
+    Retorna (url, headers, data).
+    """
+    url = f"{TECNOSPEED_BASE}/oauth2/token"
+    raw = f"{client_id}:{client_secret}".encode("utf-8")
+    b64 = base64.b64encode(raw).decode("utf-8")
+
+    headers = {
+        "Authorization": f"Basic {b64}",
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Accept": "application/json",
+    }
+    data = {"grant_type": "client_credentials", "role": "company"}
+    return url, headers, data
+
+
+def token_da_resposta(status_code: int, texto: str, corpo) -> dict:
+    if status_code not in (200, 201):
+        raise RuntimeError(f"Falha ao renovar token ({status_code}): {texto}")
+
+    j = corpo or {}
+    access_token = (j.get("access_token") or "").strip()
+    expires_in = int(j.get("expires_in") or 3600)
+
+    if not access_token:
+        raise RuntimeError(f"Resposta sem access_token: {texto}")
+
+    expires_dt = (datetime.now(TZ_BR) + timedelta(seconds=expires_in)).replace(tzinfo=None)
+
+    return {
+        "access_token": access_token,
+        "expires_at": expires_dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "expires_in": expires_in,
+    }
+
+
+def renovar_token_company(client_id: str, client_secret: str) -> dict:
+    url, headers, data = requisicao_token_company(client_id, client_secret)
+    r = chamar_upstream(disjuntor_tecnospeed, sessao_tecnospeed, "POST", url, headers=headers, data=data)
+    corpo = r.json() if r.status_code in (200, 201) else None
+    return token_da_resposta(r.status_code, r.text, corpo)
+
+
+# Cache por processo: (codigoparasistema, codcadastro) -> {"token", "expires_at"}
+_tokens_cache = {}
+_tokens_cache_lock = threading.Lock()
+_tokens_locks = {}  # uma trava por chave: só uma renovação por vez
+
+
+def _trava_token(chave) -> threading.Lock:
+    with _tokens_cache_lock:
+        trava = _tokens_locks.get(chave)
+        if trava is None:
+            trava = _tokens_locks[chave] = threading.Lock()
+        return trava
+
+
+def token_em_cache(chave):
+    with _tokens_cache_lock:
+        item = _tokens_cache.get(chave)
+    if item and not token_expirado(item["expires_at"]):
+        return item["token"]
+    return None
+
+
+def guardar_token_cache(chave, token: str, expires_at):
+    with _tokens_cache_lock:
+        _tokens_cache[chave] = {"token": token, "expires_at": expires_at}
+
+
+def invalidar_token_cache(codigoparasistema=None, codcadastro=None):
+    """Remove o token do cache (ex.: TecnoSpeed respondeu 401). Sem argumentos limpa tudo."""
+    with _tokens_cache_lock:
+        if codigoparasistema is None and codcadastro is None:
+            _tokens_cache.clear()
+        else:
+            _tokens_cache.pop((codigoparasistema, codcadastro), None)
+
+
+def garantir_token_company(cursor, codigoparasistema, codcadastro, recusado: str = None) -> str:
+    """
+    Token company válido para o vínculo.
+    - cache em memória respeitando a margem de 120s de token_expirado
+    - single-flight: com o token vencido, só uma thread por chave consulta dadospix
+      e renova; as demais esperam e reaproveitam o resultado
+    - recusado: token que a TecnoSpeed acabou de rejeitar (401); nunca é devolvido de novo
+    """
+    chave = (codigoparasistema, codcadastro)
+
+    token = token_em_cache(chave)
+    if token and token != recusado:
+        return token
+
+    with _trava_token(chave):
+        # outra thread pode ter renovado enquanto esperávamos a trava
+        token = token_em_cache(chave)
+        if token and token != recusado:
+            return token
+        if recusado:
+            invalidar_token_cache(codigoparasistema, codcadastro)
+
+        token, expires_at = _carregar_ou_renovar_token(cursor, codigoparasistema, codcadastro, recusado)
+        guardar_token_cache(chave, token, expires_at)
+        return token
+
+
+def _carregar_ou_renovar_token(cursor, codigoparasistema, codcadastro, recusado: str = None):
+    """Lê dadospix e renova via OAuth se preciso (vencido ou igual ao recusado). Retorna (token, expires_at)."""
+    dp = buscar_dadospix(cursor, codigoparasistema, codcadastro)
+    if not dp:
+        raise RuntimeError("Não encontrei registro em dadospix para esse vínculo.")
+
+    token = (dp.get("token_company") or "").strip()
+    expires_at = dp.get("token_company_expires_at")
+    client_id = (dp.get("tecnospeed_client_id") or "").strip()
+    client_secret = (dp.get("tecnospeed_client_secret") or "").strip()
+    iddadospix = dp.get("iddadospix")
+
+    if (not token) or token_expirado(expires_at) or token == recusado:
+        novo = renovar_token_company(client_id, client_secret)
+        token = novo["access_token"]
+
+        cursor.execute(SQL_ATUALIZAR_TOKEN, (token, novo["expires_at"], iddadospix))
+        log.info("Token company renovado (iddadospix=%s) expira em %s", iddadospix, novo["expires_at"])
+        metricas.inc("pix_token_renovacoes_total", origem="webhook", resultado="ok")
+        expires_at = novo["expires_at"]
+
+    return token, expires_at
+
+
+SQL_TOKENS_A_VENCER = f"""
+    SELECT iddadospix, codigoparasistema, codcadastro, token_company_expires_at
+    FROM {TBL_DADOSPIX}
+    WHERE tecnospeed_client_id IS NOT NULL AND tecnospeed_client_id <> ''
+      AND (token_company_expires_at IS NULL OR token_company_expires_at < %s)
+    ORDER BY token_company_expires_at
+    LIMIT %s
+"""
+
+SQL_DADOSPIX_POR_ID = f"""
+    SELECT
+      iddadospix,
+      codigoparasistema,
+      codcadastro,
+      token_company,
+      token_company_expires_at,
+      tecnospeed_client_id,
+      tecnospeed_client_secret
+    FROM {TBL_DADOSPIX}
+    WHERE iddadospix = %s
+"""
+
+
+def _segundos_para_expirar(expires_at):
+    """Segundos até expires_at (hora BR sem tz); None/ilegível = já vencido."""
+    if not expires_at:
+        return 0.0
+    try:
+        dt = datetime.fromisoformat(str(expires_at)) if isinstance(expires_at, str) else expires_at
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=TZ_BR)
+        return (dt - datetime.now(dt.tzinfo)).total_seconds()
+    except Exception:
+        return 0.0
+
+
+class RenovadorTokens:
+    """
+    Renova token_company ANTES de vencer, para o webhook quase nunca pagar o OAuth.
+    - a cada `intervalo_seg` (+ jitter) lê de dadospix quem expira em até antes_seg + jitter_seg
+    - cada tenant ganha um limiar próprio (antes_seg + aleatório até jitter_seg): as
+      renovações não caem todas no mesmo instante
+    - GET_LOCK por iddadospix sem espera: só um worker/nó renova; dentro da trava relê
+      a linha e desiste se outro acabou de renovar
+    - falha: backoff por iddadospix (em memória) para não martelar credencial inválida
+    Token novo vai para dadospix (os outros processos leem de lá) e para o cache local.
+    """
+
+    def __init__(self, antes_seg, jitter_seg, intervalo_seg, paralelo, lote):
+        self.antes_seg = antes_seg
+        self.jitter_seg = max(0, jitter_seg)
+        self.intervalo_seg = intervalo_seg
+        self.paralelo = max(1, paralelo)
+        self.lote = max(1, lote)
+        self._falhas = {}  # iddadospix -> (falhas seguidas, monotonic da próxima tentativa)
+        self._falhas_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def iniciar(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.paralelo, thread_name_prefix="token-renovador")
+            threading.Thread(target=self._loop, name="token-renovador-loop", daemon=True).start()
+        log.info("Renovador de tokens iniciado (pid=%s, antes=%ss, paralelo=%s)",
+                 os.getpid(), self.antes_seg, self.paralelo)
+
+    def _loop(self):
+        # workers sobem juntos: desencontra a primeira varredura
+        time.sleep(random.uniform(0, min(self.intervalo_seg, 10)))
+        while True:
+            try:
+                if not disjuntor_tecnospeed.aberto():
+                    self.varrer()
+            except Exception as e:
+                log.exception("ERRO renovador de tokens: %r", e)
+            time.sleep(self.intervalo_seg + random.uniform(0, self.intervalo_seg / 4))
+
+    def varrer(self) -> dict:
+        """Uma varredura: renova os tokens a vencer. Retorna contagem por resultado."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.paralelo, thread_name_prefix="token-renovador")
+        limite = (datetime.now(TZ_BR) + timedelta(seconds=self.antes_seg + self.jitter_seg)).replace(tzinfo=None)
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_TOKENS_A_VENCER, (limite.strftime("%Y-%m-%d %H:%M:%S"), self.lote))
+                linhas = cursor.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+
+        agora = time.monotonic()
+        candidatas = []
+        for linha in linhas:
+            limiar = self.antes_seg + random.uniform(0, self.jitter_seg)
+            if _segundos_para_expirar(linha.get("token_company_expires_at")) > limiar:
+                continue
+            with self._falhas_lock:
+                _, proxima = self._falhas.get(linha.get("iddadospix"), (0, 0.0))
+            if proxima > agora:
+                continue
+            candidatas.append(linha)
+
+        contagem = {"renovado": 0, "ignorado": 0, "falha": 0}
+        for resultado in self._executor.map(self._renovar, candidatas):
+            contagem[resultado] += 1
+            metricas.inc("pix_token_renovacoes_total", origem="background", resultado=resultado)
+        if contagem["renovado"] or contagem["falha"]:
+            log.info("Renovador de tokens: %s", contagem)
+        return contagem
+
+    def _renovar(self, linha: dict) -> str:
+        iddadospix = linha.get("iddadospix")
+        nome = f"dadospix:{iddadospix}"
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_GET_LOCK, (nome, 0))
+                if (cursor.fetchone() or {}).get("ok") != 1:
+                    return "ignorado"  # outro worker/nó está renovando
+                try:
+                    cursor.execute(SQL_DADOSPIX_POR_ID, (iddadospix,))
+                    dp = cursor.fetchone() or {}
+                    if _segundos_para_expirar(dp.get("token_company_expires_at")) > self.antes_seg + self.jitter_seg:
+                        conn.commit()
+                        return "ignorado"  # renovado por outro enquanto isso
+                    conn.commit()  # só a trava (da sessão) fica durante o OAuth, sem transação aberta
+
+                    novo = renovar_token_company(
+                        (dp.get("tecnospeed_client_id") or "").strip(),
+                        (dp.get("tecnospeed_client_secret") or "").strip(),
+                    )
+                    cursor.execute(SQL_ATUALIZAR_TOKEN, (novo["access_token"], novo["expires_at"], iddadospix))
+                    conn.commit()
+                finally:
+                    cursor.execute(SQL_RELEASE_LOCK, (nome,))
+                    cursor.fetchone()
+
+            guardar_token_cache((dp.get("codigoparasistema"), dp.get("codcadastro")),
+                                novo["access_token"], novo["expires_at"])
+            with self._falhas_lock:
+                self._falhas.pop(iddadospix, None)
+            log.info("Token company renovado antecipadamente (iddadospix=%s) expira em %s",
+                     iddadospix, novo["expires_at"])
+            return "renovado"
+        except Exception as e:
+            conn.rollback()
+            with self._falhas_lock:
+                falhas = self._falhas.get(iddadospix, (0, 0.0))[0] + 1
+                self._falhas[iddadospix] = (falhas, time.monotonic() + min(3600, 30 * (2 ** (falhas - 1))))
+            log.warning("Falha ao renovar token antecipadamente (iddadospix=%s, %s falha(s)): %r",
+                        iddadospix, falhas, e)
+            return "falha"
+        finally:
+            conn.close()
+
+
+renovador_tokens = RenovadorTokens(
+    TOKEN_RENOVAR_ANTES_SEG, TOKEN_RENOVADOR_JITTER_SEG, TOKEN_RENOVADOR_INTERVALO_SEG,
+    TOKEN_RENOVADOR_PARALELO, TOKEN_RENOVADOR_LOTE,
+)
+
+
+# =========================
+# TecnoSpeed: Consultar PIX por ID
+# =========================
+class TokenRecusado(RuntimeError):
+    """TecnoSpeed respondeu 401: token revogado/rotacionado antes do expires_at."""
+
+
+def tecnospeed_consultar_pix_por_id(pix_id: str, token_company: str) -> dict:
+    url = f"{TECNOSPEED_BASE}/api/v1/pix/{pix_id}"
+    headers = {"Authorization": f"Bearer {token_company}", "Accept": "application/json"}
+    r = chamar_upstream(disjuntor_tecnospeed, sessao_tecnospeed, "GET", url, headers=headers)
+    if r.status_code == 401:
+        metricas.inc("pix_token_recusados_total")
+        raise TokenRecusado(f"Consulta PIX por ID falhou (401): {r.text}")
+    if r.status_code != 200:
+        raise RuntimeError(f"Consulta PIX por ID falhou ({r.status_code}): {r.text}")
+    data = r.json() or {}
+    return data if isinstance(data, dict) else {}
+
+
+# =========================
+# Inserts / Updates
+# =========================
+# Chave: (compacto, com_status). Compacto grava headers_z/json_z no lugar do texto.
+SQL_INSERIR_EVENTO = {
+    (compacto, com_status): f"""
+        INSERT INTO {TBL_EVENTOS}
+          (event_name, pix_id, {"headers_z, json_z" if compacto else "headers_json, json_completo"},
+           recebido_em{", status_processamento" if com_status else ""})
+        VALUES
+          (%s, %s, %s, %s, %s{", %s" if com_status else ""})
+    """
+    for compacto in (False, True)
+    for com_status in (False, True)
+}
+
+
+def comprimir(texto: str) -> bytes:
+    """Mesmo formato do COMPRESS() do MySQL (tamanho em 4 bytes LE + zlib): UNCOMPRESS(json_z) funciona no SQL."""
+    dados = texto.encode("utf-8")
+    if not dados:
+        return b""
+    return struct.pack("<I", len(dados)) + zlib.compress(dados, 6)
+
+
+def descomprimir(dados) -> str:
+    if not dados:
+        return ""
+    return zlib.decompress(bytes(dados)[4:]).decode("utf-8")
+
+
+def headers_permitidos(headers: dict) -> dict:
+    if "*" in EVENTOS_HEADERS:
+        return headers
+    return {k: v for k, v in (headers or {}).items() if k.lower() in EVENTOS_HEADERS}
+
+
+def expandir_evento(row: dict) -> dict:
+    """Linha de pix_webhook_eventos com headers_z/json_z vira headers_json/json_completo em texto."""
+    for comprimida, texto in (("headers_z", "headers_json"), ("json_z", "json_completo")):
+        if comprimida in row:
+            dados = row.pop(comprimida)
+            if dados and not row.get(texto):
+                row[texto] = descomprimir(dados)
+    return row
+
+
+def params_evento(event_name: str, pix_id: str, headers_json: dict, json_completo: dict,
+                  status_processamento: str = None, agora: str = None):
+    """
+    Retorna (sql, params) do insert de evento; status só entra no modo assíncrono.
+    EVENTOS_COMPACTO: só os headers permitidos, e headers/payload comprimidos.
+    """
+    if EVENTOS_COMPACTO:
+        headers, payload = comprimir(safe_json(headers_permitidos(headers_json))), comprimir(safe_json(json_completo))
+    else:
+        headers, payload = safe_json(headers_json), safe_json(json_completo)
+    valores = (str(event_name or ""), str(pix_id or ""), headers, payload, agora or now_str())
+    if status_processamento is None:
+        return SQL_INSERIR_EVENTO[(EVENTOS_COMPACTO, False)], valores
+    return SQL_INSERIR_EVENTO[(EVENTOS_COMPACTO, True)], valores + (status_processamento,)
+
+
+def inserir_evento(cursor, event_name: str, pix_id: str, headers_json: dict, json_completo: dict,
+                   status_processamento: str = None) -> int:
+    """
+    Grava o evento bruto. status_processamento só é gravado no modo assíncrono
+    (coluna criada por sql/001_pix_webhook_eventos_processamento.sql).
+    Retorna id_evento.
+    """
+    cursor.execute(*params_evento(event_name, pix_id, headers_json, json_completo, status_processamento))
+    return cursor.lastrowid
+
+
+def inserir_eventos_lote(cursor, eventos: list):
+    """
+    Insere vários eventos com INSERT multi-linha (executemany agrupa os VALUES).
+    eventos: [(event_name, pix_id, headers_json, json_completo, status_processamento)]
+    status_processamento segue a regra de inserir_evento (None = coluna não gravada).
+    """
+    agora = now_str()
+    por_sql = {}
+    for ev, pid, h, j, st in eventos:
+        sql, params = params_evento(ev, pid, h, j, st, agora)
+        por_sql.setdefault(sql, []).append(params)
+    for sql, linhas in por_sql.items():
+        cursor.executemany(sql, linhas)
+
+
+# No UPDATE as atribuições são avaliadas da esquerda p/ direita: a primeira ainda enxerga
+# o payment_date antigo e devolve via LAST_INSERT_ID() 2 (esta chamada preencheu
+# payment_date) ou 1 (não preencheu). Como a linha fica travada pelo próprio upsert,
+# duas entregas simultâneas nunca recebem 2 ao mesmo tempo.
+SQL_UPSERT_RECEBIDO = f"""
+    INSERT INTO {TBL_RECEBIDOS}
+      (pix_id, surrogate_key, status, amount, payment_date, payer_cpf_cnpj, payer_name, emv,
+       created_at_api, recebido_em, codigoparasistema, codcadastro, id_cobrancas, pago, json_completo)
+    VALUES
+      (%s,%s,%s,%s,%s,%s,%s,%s,
+       %s,%s,%s,%s,%s,0,%s)
+    ON DUPLICATE KEY UPDATE
+      surrogate_key=IF(
+        LAST_INSERT_ID(IF(payment_date IS NULL AND VALUES(payment_date) IS NOT NULL, 2, 1)) > 0,
+        VALUES(surrogate_key), surrogate_key
+      ),
+      status=VALUES(status),
+      amount=VALUES(amount),
+      payment_date=VALUES(payment_date),
+      payer_cpf_cnpj=VALUES(payer_cpf_cnpj),
+      payer_name=VALUES(payer_name),
+      emv=VALUES(emv),
+      created_at_api=VALUES(created_at_api),
+      recebido_em=VALUES(recebido_em),
+      codigoparasistema=VALUES(codigoparasistema),
+      codcadastro=VALUES(codcadastro),
+      id_cobrancas=VALUES(id_cobrancas),
+      json_completo=VALUES(json_completo)
+"""
+
+
+# Feed: registro da liquidação na mesma transação do upsert que definiu payment_date
+SQL_REGISTRAR_LIQUIDACAO = f"""
+    INSERT INTO {TBL_LIQUIDACOES} (id_recebido, pix_id, codigoparasistema, liquidado_em)
+    SELECT id_recebido, pix_id, codigoparasistema, %s
+    FROM {TBL_RECEBIDOS}
+    WHERE pix_id = %s
+"""
+
+
+def params_upsert_recebido(pix_full: dict, vinculo: dict) -> tuple:
+    return (
+        str(pix_full.get("id") or ""),
+        str(pix_full.get("surrogateKey") or ""),
+        str(pix_full.get("status") or ""),
+        pix_full.get("amount"),
+        parse_iso_dt_to_br(pix_full.get("paymentDate")),
+        str(pix_full.get("payerCpfCnpj") or ""),
+        str(pix_full.get("payerName") or ""),
+        str(pix_full.get("emv") or ""),
+        parse_iso_dt_to_br(pix_full.get("createdAt")),
+        now_str(),
+        vinculo.get("codigoparasistema"),
+        vinculo.get("codcadastro"),
+        vinculo.get("id_cobrancas"),
+        safe_json(pix_full),
+    )
+
+
+def resultado_upsert(rowcount: int, lastrowid: int, payment_date) -> dict:
+    # rowcount: 1 = inseriu, 2 = atualizou, 0 = atualizou sem mudança
+    inserido = rowcount == 1
+    if inserido:
+        definido_agora = bool(payment_date)
+    else:
+        definido_agora = lastrowid == 2
+    return {"inserido": inserido, "payment_date": payment_date, "payment_date_definido_agora": definido_agora}
+
+
+def upsert_pix_recebido(cursor, pix_full: dict, vinculo: dict):
+    """
+    Regras:
+    - Sempre INSERE com pago=0
+    - Em UPDATE: NÃO ALTERA o campo pago (outro robô cuida disso)
+    Um único INSERT ... ON DUPLICATE KEY UPDATE atômico (requer UNIQUE em pix_id,
+    sql/002_pix_recebidos_unique_pix_id.sql).
+    Retorna: payment_date_definido_agora (pra decidir envio de WhatsApp sem duplicar)
+    Com FEED_RECEBIDOS, payment_date definido agora também vai para pix_recebidos_liquidacoes.
+    """
+    params = params_upsert_recebido(pix_full, vinculo)
+    cursor.execute(SQL_UPSERT_RECEBIDO, params)
+    info = resultado_upsert(cursor.rowcount, cursor.lastrowid, params[4])
+    if FEED_RECEBIDOS and info["payment_date_definido_agora"]:
+        cursor.execute(SQL_REGISTRAR_LIQUIDACAO, (now_str(), params[0]))
+    return info
+
+
+# =========================
+# WhatsApp
+# =========================
+def format_br_phone(ddd, fone):
+    d = digits(ddd)
+    n = digits(fone)
+    if not d or not n:
+        return None
+    return f"55{d}{n}"
+
+
+def postar_whatsapp(phone_e164: str, message: str):
+    """POST send-text na PlugzAPI. Retorna (enviado, status_http|None, erro|None)."""
+    payload = {"phone": phone_e164, "message": message}
+    headers = {"Content-Type": "application/json", "Client-Token": PLUGZ_CLIENT_TOKEN}
+
+    try:
+        resp = chamar_upstream(disjuntor_plugz, sessao_plugz, "POST", PLUGZ_API_URL, headers=headers, json=payload)
+    except Exception as e:
+        log.error("Erro ao enviar WhatsApp (%s): %r", phone_e164, e)
+        metricas.inc("pix_whatsapp_envios_total", resultado="falha")
+        return False, None, repr(e)
+
+    ok = resp.status_code in (200, 201)
+    if ok:
+        log.info("Mensagem enviada ao WhatsApp %s. Status: %s", phone_e164, resp.status_code)
+        logar_corpo("Resposta da PlugzAPI", resp.text)
+    else:
+        log.warning("PlugzAPI recusou envio para %s. Status: %s", phone_e164, resp.status_code,
+                    extra={"corpo": corpo_log(resp.text)})
+    metricas.inc("pix_whatsapp_envios_total", resultado="enviado" if ok else "falha")
+    return ok, resp.status_code, (None if ok else f"HTTP {resp.status_code}: {resp.text[:500]}")
+
+
+def enviar_whatsapp(phone_e164: str, message: str) -> bool:
+    return postar_whatsapp(phone_e164, message)[0]
+
+
+_whatsapp_executor = ThreadPoolExecutor(max_workers=max(1, WHATSAPP_MAX_PARALELO), thread_name_prefix="whatsapp")
+
+
+def enviar_whatsapp_em_paralelo(telefones, message: str) -> dict:
+    """
+    Envia a mesma mensagem para vários telefones em paralelo (limite WHATSAPP_MAX_PARALELO
+    por processo). Chamar FORA da transação. Retorna {telefone: enviado}.
+    """
+    if not telefones:
+        return {}
+    futuros = {
+        fone: _whatsapp_executor.submit(contextvars.copy_context().run, enviar_whatsapp, fone, message)
+        for fone in telefones
+    }
+    resultados = {}
+    for fone, fut in futuros.items():
+        try:
+            resultados[fone] = bool(fut.result())
+        except Exception:
+            resultados[fone] = False
+    enviados = sum(1 for ok in resultados.values() if ok)
+    log.info("WhatsApp: %s/%s enviados %s", enviados, len(resultados), resultados)
+    return resultados
+
+
+SQL_ENFILEIRAR_WHATSAPP = f"""
+    INSERT INTO {TBL_OUTBOX} (pix_id, telefone, mensagem, status, criado_em)
+    VALUES (%s, %s, %s, 'pendente', %s)
+    ON DUPLICATE KEY UPDATE id_outbox=id_outbox
+"""
+
+
+def params_outbox_whatsapp(pix_id: str, telefones, message: str) -> list:
+    agora = now_str()
+    return [(pix_id, fone, message, agora) for fone in telefones]
+
+
+def enfileirar_whatsapp(cursor, pix_id: str, telefones, message: str) -> int:
+    """
+    Grava a notificação na outbox (na transação do chamador). (pix_id, telefone) é
+    único: reprocessar o mesmo PIX não duplica mensagem. Retorna linhas novas.
+    """
+    if not telefones:
+        return 0
+    cursor.executemany(SQL_ENFILEIRAR_WHATSAPP, params_outbox_whatsapp(pix_id, telefones, message))
+    return cursor.rowcount
+
+
+# codigoempresa -> ESQUEMA quase nunca muda: carregado inteiro em memória (IndiceEsquemas)
+SQL_ESQUEMAS = f"""
+    SELECT CODIGOEMPRESA, ESQUEMA
+    FROM {TBL_AUTENTICACAO}
+"""
+
+# modelos por esquema do tenant: .format(schema=...)
+# empresa (contatos) + cliente final do pedido numa ida ao banco; sempre devolve 1 linha
+SQL_NOTIFICACAO_TENANT = """
+    SELECT
+      e.razaosocial,
+      e.ddd1, e.fone1,
+      e.ddd2, e.fone2,
+      e.ddd3, e.fone3,
+      e.ddd4, e.fone4,
+      e.ddd5, e.fone5,
+      f.razaosocial AS nome_final
+    FROM (SELECT 1) AS x
+    LEFT JOIN `{schema}`.cadastro e ON e.codcadastro = %s
+    LEFT JOIN `{schema}`.pedidovenda p ON p.pedidovendaid = %s
+    LEFT JOIN `{schema}`.cadastro f ON f.codcadastro = p.codcadastro
+    LIMIT 1
+"""
+
+# empresa já em cache: só o cliente final do pedido
+SQL_NOME_FINAL_PEDIDO = """
+    SELECT f.razaosocial AS nome_final
+    FROM `{schema}`.pedidovenda p
+    JOIN `{schema}`.cadastro f ON f.codcadastro = p.codcadastro
+    WHERE p.pedidovendaid = %s
+    LIMIT 1
+"""
+
+
+class IndiceEsquemas:
+    """
+    codigoempresa -> ESQUEMA (autenticacao) em memória, recarregado inteiro a cada `ttl`
+    ou via invalidar(). Código desconhecido força recarga (tenant novo), no máximo a
+    cada `recarga_min` segundos.
+    """
+
+    def __init__(self, ttl: float, recarga_min: float = 30):
+        self.ttl = ttl
+        self.recarga_min = recarga_min
+        self.carga_lock = threading.Lock()  # uma recarga por vez
+        self._lock = threading.Lock()
+        self._esquemas = {}
+        self._carregado_em = None
+
+    def precisa_carregar(self, codigoempresa=None) -> bool:
+        with self._lock:
+            if self._carregado_em is None:
+                return True
+            idade = time.monotonic() - self._carregado_em
+            if idade >= self.ttl:
+                return True
+            return (codigoempresa is not None and str(codigoempresa) not in self._esquemas
+                    and idade >= self.recarga_min)
+
+    def carregar(self, linhas):
+        esquemas = {
+            str(l.get("CODIGOEMPRESA")): (l.get("ESQUEMA") or "").strip().lower()
+            for l in linhas or []
+        }
+        with self._lock:
+            self._esquemas = esquemas
+            self._carregado_em = time.monotonic()
+
+    def obter(self, codigoempresa) -> str:
+        with self._lock:
+            return self._esquemas.get(str(codigoempresa), "")
+
+    def invalidar(self):
+        with self._lock:
+            self._carregado_em = None
+
+
+class CacheContatos:
+    """LRU com TTL: (schema, codcadastro) -> (razaosocial, telefones) da empresa."""
+
+    def __init__(self, max_itens: int, ttl: float):
+        self.max_itens = max(1, max_itens)
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            if time.monotonic() - item[0] >= self.ttl:
+                del self._itens[chave]
+                return None
+            self._itens.move_to_end(chave)
+            return item[1]
+
+    def guardar(self, chave, valor):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._itens[chave] = (time.monotonic(), valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, schema=None, codcadastro=None):
+        """Sem argumentos limpa tudo; só schema limpa o tenant inteiro."""
+        with self._lock:
+            if schema is None:
+                self._itens.clear()
+            elif codcadastro is None:
+                for chave in [k for k in self._itens if k[0] == schema]:
+                    del self._itens[chave]
+            else:
+                self._itens.pop((schema, codcadastro), None)
+
+
+indice_esquemas = IndiceEsquemas(TENANT_ESQUEMAS_TTL)
+contatos_cache = CacheContatos(TENANT_CONTATOS_MAX, TENANT_CONTATOS_TTL)
+
+
+def esquema_do_tenant(cursor, codigoempresa) -> str:
+    if indice_esquemas.precisa_carregar(codigoempresa):
+        with indice_esquemas.carga_lock:
+            if indice_esquemas.precisa_carregar(codigoempresa):
+                cursor.execute(SQL_ESQUEMAS)
+                indice_esquemas.carregar(cursor.fetchall())
+    return indice_esquemas.obter(codigoempresa)
+
+
+def nome_e_telefones(c: dict):
+    """Linha de cadastro -> (razaosocial, telefones E.164 sem duplicados)."""
+    c = c or {}
+    nome = c.get("razaosocial") or ""
+
+    tels = []
+    for i in range(1, 6):
+        t = format_br_phone(c.get(f"ddd{i}"), c.get(f"fone{i}"))
+        if t:
+            tels.append(t)
+
+    # remove duplicados
+    out, seen = [], set()
+    for t in tels:
+        if t not in seen:
+            out.append(t)
+            seen.add(t)
+
+    return nome, out
+
+
+def sql_notificacao(schema: str, codcadastro, pedidovendaid):
+    """(sql, params, contato_em_cache|None): com a empresa em cache só busca o cliente final."""
+    contato = contatos_cache.obter((schema, codcadastro))
+    if contato is not None:
+        return SQL_NOME_FINAL_PEDIDO.format(schema=schema), (pedidovendaid,), contato
+    return SQL_NOTIFICACAO_TENANT.format(schema=schema), (codcadastro, pedidovendaid), None
+
+
+def resultado_notificacao(schema: str, codcadastro, row, contato):
+    """-> (nome_empresa, telefones, nome_final); guarda o contato da empresa no cache."""
+    row = row or {}
+    if contato is None:
+        contato = nome_e_telefones(row)
+        contatos_cache.guardar((schema, codcadastro), contato)
+    return contato[0], contato[1], row.get("nome_final") or ""
+
+
+def dados_notificacao(cursor, vinculo: dict):
+    """
+    (schema, nome_empresa, telefones, nome_final) do vínculo: esquema vem do índice em
+    memória e empresa + cliente final de uma consulta só (no máximo 1 ida ao banco).
+    """
+    codigoempresa = vinculo.get("codigoparasistema")
+    schema = esquema_do_tenant(cursor, codigoempresa)
+    if not schema:
+        log.warning("Sem ESQUEMA em autenticacao para CODIGOEMPRESA=%s.", codigoempresa)
+        return "", "", [], ""
+    codcadastro = vinculo.get("codcadastro")
+    sql, params, contato = sql_notificacao(schema, codcadastro, vinculo.get("pedidovendaid"))
+    cursor.execute(sql, params)
+    return (schema, *resultado_notificacao(schema, codcadastro, cursor.fetchone(), contato))
+
+
+def montar_mensagem(nome_cliente_empresa: str, numero_pedido: str, nome_cliente_final: str, valor, data_mysql: str):
+    return (
+        f"Olá, {nome_cliente_empresa}! ✅\n"
+        f"O pagamento do pedido nº {numero_pedido}, referente ao cliente {nome_cliente_final}, foi confirmado com sucesso.\n\n"
+        f"💰 Valor: R$ {money_br(valor)}\n"
+        f"📅 Data: {fmt_dt_br(data_mysql)}"
+    )
+
+
+# =========================
+# Idempotência (pix_ids já liquidados)
+# =========================
+class LRULiquidados:
+    """Conjunto LRU limitado e thread-safe de pix_ids já liquidados."""
+
+    def __init__(self, maximo: int):
+        self.maximo = max(1, maximo)
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contem(self, pix_id: str) -> bool:
+        with self._lock:
+            if pix_id in self._itens:
+                self._itens.move_to_end(pix_id)
+                return True
+            return False
+
+    def adicionar(self, pix_id: str):
+        with self._lock:
+            self._itens[pix_id] = True
+            self._itens.move_to_end(pix_id)
+            while len(self._itens) > self.maximo:
+                self._itens.popitem(last=False)
+
+    def __len__(self):
+        return len(self._itens)
+
+
+liquidados_lru = LRULiquidados(IDEMPOTENCIA_LRU_MAX)
+
+# duplicados absorvidos, por origem da resposta
+duplicados_absorvidos = {"lru": 0, "banco": 0}
+_duplicados_lock = threading.Lock()
+
+
+def _contar_duplicado(origem: str):
+    with _duplicados_lock:
+        duplicados_absorvidos[origem] += 1
+    metricas.inc("pix_duplicados_absorvidos_total", origem=origem)
+
+
+def duplicado_em_memoria(pix_id: str):
+    """
+    Curto-circuito antes da coalescência e do GET_LOCK: pix_id no LRU de liquidados
+    responde sem ir ao banco. None = miss (a checagem no banco fica depois da trava).
+    """
+    if not liquidados_lru.contem(pix_id):
+        return None
+    _contar_duplicado("lru")
+    log.info("pix_id=%s já liquidado; entrega duplicada ignorada.", pix_id)
+    metricas.inc("pix_webhook_resultado_total", resultado="duplicado")
+    return {"ok": True, "duplicado": True}
+
+
+SQL_JA_LIQUIDADO = f"""
+    SELECT 1 AS liquidado
+    FROM {TBL_RECEBIDOS}
+    WHERE pix_id = %s
+      AND status = 'LIQUIDATED'
+      AND payment_date IS NOT NULL
+    LIMIT 1
+"""
+
+
+def pix_ja_liquidado(cursor, pix_id: str) -> bool:
+    """LRU em memória; no miss, consulta pontual por pix_id (índice único) em pix_recebidos."""
+    if liquidados_lru.contem(pix_id):
+        _contar_duplicado("lru")
+        return True
+
+    cursor.execute(SQL_JA_LIQUIDADO, (pix_id,))
+    if cursor.fetchone():
+        liquidados_lru.adicionar(pix_id)
+        _contar_duplicado("banco")
+        return True
+    return False
+
+
+# =========================
+# Pipeline PIX_SUCCESSFUL
+# =========================
+class _Voo:
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class CoalescedorPix:
+    """Single-flight por pix_id dentro do processo: o primeiro processa, os demais aguardam o resultado."""
+
+    def __init__(self):
+        self._voos = {}
+        self._lock = threading.Lock()
+
+    def entrar(self, pix_id: str):
+        """Retorna (voo, lider)."""
+        with self._lock:
+            voo = self._voos.get(pix_id)
+            if voo is not None:
+                return voo, False
+            voo = self._voos[pix_id] = _Voo()
+            return voo, True
+
+    def sair(self, pix_id: str, voo: _Voo):
+        with self._lock:
+            if self._voos.get(pix_id) is voo:
+                del self._voos[pix_id]
+        voo.pronto.set()
+
+
+coalescedor_pix = CoalescedorPix()
+
+
+SQL_GET_LOCK = "SELECT GET_LOCK(%s, %s) AS ok"
+SQL_RELEASE_LOCK = "SELECT RELEASE_LOCK(%s) AS ok"
+
+
+def nome_trava_pix(pix_id: str) -> str:
+    nome = f"pix:{pix_id}"
+    # GET_LOCK aceita no máximo 64 caracteres
+    return nome if len(nome) <= 64 else "pix:" + hashlib.sha1(pix_id.encode("utf-8")).hexdigest()
+
+
+def adquirir_trava_pix(conn, pix_id: str) -> bool:
+    """Trava consultiva do MySQL (GET_LOCK) por pix_id, compartilhada entre workers e nós."""
+    with conn.cursor() as cursor:
+        cursor.execute(SQL_GET_LOCK, (nome_trava_pix(pix_id), PIX_TRAVA_ESPERA_SEG))
+        return (cursor.fetchone() or {}).get("ok") == 1
+
+
+def liberar_trava_pix(conn, pix_id: str):
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(SQL_RELEASE_LOCK, (nome_trava_pix(pix_id),))
+            cursor.fetchone()
+    except Exception as e:
+        # sessão perdida: o MySQL solta a trava sozinho
+        log.warning("Falha ao liberar trava de pix_id=%s: %r", pix_id, e)
+
+
+def espera_seguidor() -> float:
+    """Quanto o seguidor aguarda o líder: PIX_COALESCER_ESPERA_SEG, sem passar do prazo da requisição."""
+    restante = tempo_restante()
+    return PIX_COALESCER_ESPERA_SEG if restante is None else max(0.0, min(PIX_COALESCER_ESPERA_SEG, restante))
+
+
+def processar_pix_successful(conn, pix_id: str) -> dict:
+    """
+    Pipeline do PIX_SUCCESSFUL com coalescência por pix_id:
+    - no mesmo processo, entregas simultâneas esperam o resultado da primeira
+    - entre workers/nós, GET_LOCK por pix_id serializa; quem espera cai no curto-circuito
+      de idempotência se o primeiro liquidou
+    WhatsApp é disparado após o commit e depois de soltar a trava.
+    """
+    duplicado = duplicado_em_memoria(pix_id)
+    if duplicado:
+        return duplicado
+
+    voo, lider = coalescedor_pix.entrar(pix_id)
+    if not lider:
+        metricas.inc("pix_webhook_resultado_total", resultado="coalescido")
+        if not voo.pronto.wait(espera_seguidor()):
+            return {"ok": True, "em_andamento": True}
+        if voo.erro is not None:
+            # mesmo tipo do líder: UpstreamIndisponivel segue virando 503 + Retry-After
+            raise voo.erro
+        resultado = {k: v for k, v in (voo.resultado or {}).items() if k != "whatsapp"}
+        resultado["coalescido"] = True
+        return resultado
+
+    try:
+        if PIX_TRAVA_GLOBAL:
+            if not adquirir_trava_pix(conn, pix_id):
+                log.info("pix_id=%s em processamento em outro worker; não aguardou mais.", pix_id)
+                metricas.inc("pix_webhook_resultado_total", resultado="em_andamento")
+                voo.resultado = {"ok": True, "em_andamento": True}
+                return voo.resultado
+            try:
+                resultado, notificacao = _pipeline_pix(conn, pix_id)
+            finally:
+                liberar_trava_pix(conn, pix_id)
+        else:
+            resultado, notificacao = _pipeline_pix(conn, pix_id)
+
+        if notificacao:
+            with metricas.etapa("whatsapp"):
+                resultado["whatsapp"] = enviar_whatsapp_em_paralelo(*notificacao)
+        voo.resultado = resultado
+        return resultado
+    except Exception as e:
+        voo.erro = e
+        metricas.inc("pix_webhook_resultado_total",
+                     resultado="adiado" if isinstance(e, UpstreamIndisponivel) else "erro")
+        raise
+    finally:
+        coalescedor_pix.sair(pix_id, voo)
+
+
+def _pipeline_pix(conn, pix_id: str):
+    """
+    - pix_id já liquidado: só registra (evento já gravado), sem TecnoSpeed nem upsert
+    - Busca vínculo em pix_cobrancas_geradas
+    - Garante token company e consulta GET /api/v1/pix/{id}
+    - upsert pix_recebidos (sem tocar em pago; insert pago=0)
+    - envia WhatsApp APENAS se antes payment_date era NULL e agora não é (decidido pelo upsert atômico)
+    Faz commit da transação; o WhatsApp fica para depois (sem segurar locks de
+    pix_recebidos/dadospix durante a PlugzAPI). Retorna (resultado, notificacao|None).
+    Com WHATSAPP_OUTBOX a mensagem vai para pix_whatsapp_outbox no mesmo commit e
+    notificacao é sempre None.
+    """
+    resultado = {"ok": True}
+    notificacao = None
+    liquidado = False
+    with conn.cursor() as cursor:
+        with metricas.etapa("idempotencia"):
+            ja_liquidado = pix_ja_liquidado(cursor, pix_id)
+        if ja_liquidado:
+            log.info("pix_id=%s já liquidado; entrega duplicada ignorada.", pix_id)
+            conn.commit()
+            metricas.inc("pix_webhook_resultado_total", resultado="duplicado")
+            return {"ok": True, "duplicado": True}, None
+
+        with metricas.etapa("vinculo"):
+            vinculo = buscar_vinculo_por_pix(cursor, pix_id)
+        if not vinculo.get("codigoparasistema"):
+            log.warning("Sem vínculo em pix_cobrancas_geradas para pix_id=%s.", pix_id)
+            conn.commit()
+            metricas.inc("pix_webhook_resultado_total", resultado="sem_vinculo")
+            return {"ok": True, "warn": "Sem vínculo"}, None
+
+        acrescentar_contexto_log(tenant=vinculo.get("codigoparasistema"), codcadastro=vinculo.get("codcadastro"))
+
+        with metricas.etapa("token"):
+            token_company = garantir_token_company(
+                cursor,
+                vinculo.get("codigoparasistema"),
+                vinculo.get("codcadastro"),
+            )
+        # nenhuma transação (nem lock de linha de dadospix) aberta durante a TecnoSpeed
+        conn.commit()
+
+        with metricas.etapa("tecnospeed"):
+            try:
+                pix_full = tecnospeed_consultar_pix_por_id(pix_id, token_company)
+            except TokenRecusado:
+                # uma nova tentativa com token renovado (o do cache/dadospix foi rejeitado)
+                token_company = garantir_token_company(
+                    cursor,
+                    vinculo.get("codigoparasistema"),
+                    vinculo.get("codcadastro"),
+                    recusado=token_company,
+                )
+                conn.commit()
+                pix_full = tecnospeed_consultar_pix_por_id(pix_id, token_company)
+
+        logar_corpo("Retorno TecnoSpeed /api/v1/pix/{id}", pix_full)
+
+        status_pix = str(pix_full.get("status") or "").upper().strip()
+        payment_date_br = parse_iso_dt_to_br(pix_full.get("paymentDate"))
+
+        # sempre salva/atualiza no recebidos (sem mexer no pago)
+        with metricas.etapa("upsert"):
+            info = upsert_pix_recebido(cursor, pix_full, vinculo)
+        liquidado = status_pix == "LIQUIDATED" and bool(info.get("payment_date"))
+
+        # manda WhatsApp apenas quando realmente liquidado e acabou de ganhar payment_date
+        definido_agora = info.get("payment_date_definido_agora")
+
+        if status_pix == "LIQUIDATED" and definido_agora:
+            pedidovendaid = vinculo.get("pedidovendaid")
+            with metricas.etapa("tenant"):
+                # cadastro do tenant tolera atraso: réplica, se houver (senão o próprio cursor)
+                schema, nome_empresa, telefones, nome_final = roteador_leitura.executar(
+                    lambda c: dados_notificacao(c, vinculo), cursor_primario=cursor,
+                )
+
+            valor = pix_full.get("amount")
+
+            msg = montar_mensagem(
+                nome_cliente_empresa=nome_empresa or "Cliente",
+                numero_pedido=str(pedidovendaid or ""),
+                nome_cliente_final=nome_final or "Cliente",
+                valor=valor,
+                data_mysql=payment_date_br or "",
+            )
+
+            if not telefones:
+                log.warning("Nenhum telefone encontrado em %s.cadastro (codcadastro=%s).", schema, vinculo.get("codcadastro"))
+            elif WHATSAPP_OUTBOX:
+                resultado["whatsapp_enfileirado"] = enfileirar_whatsapp(cursor, pix_id, telefones, msg)
+            else:
+                notificacao = (telefones, msg)
+        else:
+            log.info("Não envia WhatsApp (status=%s, paymentDate=%s, payment_date_definido_agora=%s).",
+                     status_pix, payment_date_br, definido_agora)
+
+    conn.commit()
+    if liquidado:
+        liquidados_lru.adicionar(pix_id)
+    if resultado.get("whatsapp_enfileirado"):
+        despachante_whatsapp.acordar()
+    if liquidado:
+        feed_recebidos.acordar()
+    metricas.inc("pix_webhook_resultado_total", resultado="liquidado" if liquidado else "nao_liquidado")
+
+    return resultado, notificacao
+
+
+def processar_pix_isolado(pix_id: str, fim_prazo: float = None) -> dict:
+    """
+    processar_pix_successful com conexão própria; erro vira resultado (uso em paralelo).
+    fim_prazo: time.monotonic() limite compartilhado pelo lote (None = sem prazo).
+    """
+    restante = None if fim_prazo is None else fim_prazo - time.monotonic()
+    if restante is not None and restante < 0.5:
+        return {"ok": False, "status": "adiado", "error": "prazo do lote esgotado"}
+    conn = db_conn()
+    try:
+        with contexto_log(pix_id=pix_id), prazo_requisicao(restante or 0):
+            return processar_pix_successful(conn, pix_id)
+    except UpstreamIndisponivel as e:
+        conn.rollback()
+        log.warning("pix_id=%s adiado: %s", pix_id, e)
+        return {"ok": False, "status": "adiado", "error": str(e)}
+    except Exception as e:
+        log.error("ERRO processando pix_id=%s: %r", pix_id, e)
+        return {"ok": False, "error": str(e)}
+    finally:
+        conn.close()
+
+
+# =========================
+# Processamento assíncrono (pix_webhook_eventos.status_processamento)
+# =========================
+class ProcessadorEventos:
+    """
+    Workers em background (por processo) que consomem eventos 'pendente'.
+    Estados: pendente -> processando -> concluido | erro
+    - reserva em lote via claim_token (seguro com vários workers/nós)
+    - reservas órfãs (processo morreu) voltam a 'pendente' após WEBHOOK_RESERVA_EXPIRA_SEG
+    - falha: nova tentativa com backoff até WEBHOOK_MAX_TENTATIVAS, depois 'erro'
+    - em_andamento (pix_id com outro worker/thread): volta a 'pendente' sem gastar tentativa;
+      só fecha quando este evento vê o resultado (o outro pode falhar e soltar a trava)
+    """
+
+    def __init__(self, workers, poll_seg, max_tentativas, reserva_expira_seg):
+        self.workers = max(1, workers)
+        self.poll_seg = poll_seg
+        self.max_tentativas = max_tentativas
+        self.reserva_expira_seg = reserva_expira_seg
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def iniciar(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pix-evento")
+            threading.Thread(target=self._loop, name="pix-eventos-loop", daemon=True).start()
+        log.info("Processamento assíncrono iniciado (pid=%s, workers=%s)", os.getpid(), self.workers)
+
+    def acordar(self):
+        self._acordar.set()
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(self.poll_seg)
+            self._acordar.clear()
+            try:
+                self._liberar_reservas_expiradas()
+                while not disjuntor_tecnospeed.aberto():
+                    eventos = self._reservar(self.workers)
+                    if not eventos:
+                        break
+                    futures_wait([self._executor.submit(self._processar, ev) for ev in eventos])
+            except Exception as e:
+                log.exception("ERRO loop de eventos: %r", e)
+
+    def _liberar_reservas_expiradas(self):
+        limite = (datetime.now(TZ_BR) - timedelta(seconds=self.reserva_expira_seg)).replace(tzinfo=None)
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {TBL_EVENTOS}
+                    SET status_processamento='pendente', claim_token=NULL
+                    WHERE status_processamento='processando'
+                      AND reservado_em < %s
+                    """,
+                    (limite.strftime("%Y-%m-%d %H:%M:%S"),),
+                )
+                if cursor.rowcount:
+                    log.warning("%s evento(s) com reserva expirada voltaram para 'pendente'.", cursor.rowcount)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _reservar(self, limite: int) -> list:
+        claim = uuid.uuid4().hex
+        agora = now_str()
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {TBL_EVENTOS}
+                    SET status_processamento='processando',
+                        claim_token=%s,
+                        reservado_em=%s,
+                        tentativas=tentativas+1
+                    WHERE status_processamento='pendente'
+                      AND (processar_apos IS NULL OR processar_apos <= %s)
+                    ORDER BY id_evento
+                    LIMIT %s
+                    """,
+                    (claim, agora, agora, limite),
+                )
+                conn.commit()
+                if not cursor.rowcount:
+                    return []
+                cursor.execute(
+                    f"""
+                    SELECT id_evento, event_name, pix_id, tentativas
+                    FROM {TBL_EVENTOS}
+                    WHERE claim_token=%s
+                    ORDER BY id_evento
+                    """,
+                    (claim,),
+                )
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _processar(self, evento: dict):
+        id_evento = evento.get("id_evento")
+        pix_id = evento.get("pix_id") or ""
+        with contexto_log(id_evento=id_evento, pix_id=pix_id):
+            self._processar_evento(evento, id_evento, pix_id)
+
+    def _processar_evento(self, evento: dict, id_evento, pix_id: str):
+        conn = db_conn_background()
+        try:
+            try:
+                resultado = processar_pix_successful(conn, pix_id)
+                if resultado.get("em_andamento"):
+                    atraso = max(5, PIX_TRAVA_ESPERA_SEG)
+                    self._finalizar(conn, id_evento, "pendente", "em andamento em outro worker", atraso,
+                                    devolver_tentativa=True)
+                else:
+                    self._finalizar(conn, id_evento, "concluido", resultado.get("warn"))
+            except Exception as e:
+                conn.rollback()
+                log.error("ERRO processando evento %s (pix_id=%s): %r", id_evento, pix_id, e)
+                tentativas = int(evento.get("tentativas") or 1)
+                if tentativas >= self.max_tentativas:
+                    self._finalizar(conn, id_evento, "erro", repr(e))
+                else:
+                    atraso = min(3600, 30 * (2 ** (tentativas - 1)))
+                    self._finalizar(conn, id_evento, "pendente", repr(e), atraso)
+        except Exception as e:
+            log.error("ERRO finalizando evento %s: %r", id_evento, e)
+        finally:
+            conn.close()
+
+    def _finalizar(self, conn, id_evento, status: str, erro=None, atraso_seg: int = 0,
+                   devolver_tentativa: bool = False):
+        processar_apos = None
+        if atraso_seg:
+            processar_apos = (datetime.now(TZ_BR) + timedelta(seconds=atraso_seg)).replace(tzinfo=None)
+            processar_apos = processar_apos.strftime("%Y-%m-%d %H:%M:%S")
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {TBL_EVENTOS}
+                SET status_processamento=%s,
+                    claim_token=NULL,
+                    processado_em=%s,
+                    processar_apos=%s,
+                    erro_processamento=%s,
+                    tentativas=GREATEST(tentativas - %s, 0)
+                WHERE id_evento=%s
+                """,
+                (status, now_str(), processar_apos, (str(erro)[:1000] if erro else None),
+                 1 if devolver_tentativa else 0, id_evento),
+            )
+        conn.commit()
+
+
+processador_eventos = ProcessadorEventos(
+    WEBHOOK_WORKERS, WEBHOOK_POLL_SEG, WEBHOOK_MAX_TENTATIVAS, WEBHOOK_RESERVA_EXPIRA_SEG
+)
+
+
+# =========================
+# Outbox WhatsApp (pix_whatsapp_outbox)
+# =========================
+class DespachanteWhatsApp:
+    """
+    Drena pix_whatsapp_outbox. Estados: pendente -> processando -> enviado | morto
+    - reserva em lote via claim_token (vários despachantes/nós podem rodar juntos)
+    - envios em paralelo (WHATSAPP_MAX_PARALELO), limitados a `rps` na instância PlugzAPI
+    - falha transitória (rede, 5xx, 408, 429): nova tentativa com backoff até
+      `max_tentativas`; 4xx ou tentativas esgotadas: 'morto' (fica para análise)
+    """
+
+    def __init__(self, lote, paralelo, rps, rajada, poll_seg, max_tentativas, reserva_expira_seg):
+        self.lote = max(1, lote)
+        self.paralelo = max(1, paralelo)
+        self.poll_seg = poll_seg
+        self.max_tentativas = max_tentativas
+        self.reserva_expira_seg = reserva_expira_seg
+        self.limitador = LimitadorTaxa(rps, rajada=rajada)
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def iniciar(self):
+        """Sobe a thread de despacho neste processo (idempotente, seguro após fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.paralelo, thread_name_prefix="whatsapp-outbox")
+            threading.Thread(target=self._loop, name="whatsapp-outbox-loop", daemon=True).start()
+        log.info("Despachante de WhatsApp iniciado (pid=%s, paralelo=%s, rps=%s)",
+                 os.getpid(), self.paralelo, self.limitador.por_segundo)
+
+    def acordar(self):
+        self._acordar.set()
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(self.poll_seg)
+            self._acordar.clear()
+            try:
+                self.drenar()
+            except Exception as e:
+                log.exception("ERRO despachante de WhatsApp: %r", e)
+
+    def drenar(self) -> dict:
+        """Envia tudo que estiver pronto na outbox; retorna contagem por resultado."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.paralelo, thread_name_prefix="whatsapp-outbox")
+        contagem = {"enviado": 0, "retentativa": 0, "morto": 0}
+        self._liberar_reservas_expiradas()
+        while True:
+            if disjuntor_plugz.aberto():
+                return contagem
+            itens = self._reservar()
+            if not itens:
+                return contagem
+            futuros = [self._executor.submit(contextvars.copy_context().run, self._enviar, it) for it in itens]
+            resultados = [f.result() for f in futuros]
+            self._finalizar(resultados)
+            for _, status, _, _ in resultados:
+                chave = "retentativa" if status == "pendente" else status
+                contagem[chave] += 1
+                metricas.inc("pix_whatsapp_outbox_total", resultado=chave)
+
+    def _liberar_reservas_expiradas(self):
+        limite = (datetime.now(TZ_BR) - timedelta(seconds=self.reserva_expira_seg)).replace(tzinfo=None)
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {TBL_OUTBOX}
+                    SET status='pendente', claim_token=NULL
+                    WHERE status='processando'
+                      AND reservado_em < %s
+                    """,
+                    (limite.strftime("%Y-%m-%d %H:%M:%S"),),
+                )
+                if cursor.rowcount:
+                    log.warning("%s mensagem(ns) com reserva expirada voltaram para 'pendente'.", cursor.rowcount)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _reservar(self) -> list:
+        claim = uuid.uuid4().hex
+        agora = now_str()
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {TBL_OUTBOX}
+                    SET status='processando',
+                        claim_token=%s,
+                        reservado_em=%s,
+                        tentativas=tentativas+1
+                    WHERE status='pendente'
+                      AND (processar_apos IS NULL OR processar_apos <= %s)
+                    ORDER BY id_outbox
+                    LIMIT %s
+                    """,
+                    (claim, agora, agora, self.lote),
+                )
+                conn.commit()
+                if not cursor.rowcount:
+                    return []
+                cursor.execute(
+                    f"""
+                    SELECT id_outbox, pix_id, telefone, mensagem, tentativas
+                    FROM {TBL_OUTBOX}
+                    WHERE claim_token=%s
+                    ORDER BY id_outbox
+                    """,
+                    (claim,),
+                )
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _enviar(self, item: dict):
+        """Retorna (id_outbox, status, erro, atraso_seg)."""
+        with contexto_log(pix_id=item.get("pix_id"), id_outbox=item.get("id_outbox")):
+            self.limitador.aguardar()
+            ok, status_http, erro = postar_whatsapp(item.get("telefone"), item.get("mensagem") or "")
+            if ok:
+                return item.get("id_outbox"), "enviado", None, 0
+
+            tentativas = int(item.get("tentativas") or 1)
+            permanente = status_http is not None and 400 <= status_http < 500 and status_http not in (408, 429)
+            if permanente or tentativas >= self.max_tentativas:
+                log.error("WhatsApp para %s descartado após %s tentativa(s): %s",
+                          item.get("telefone"), tentativas, erro)
+                return item.get("id_outbox"), "morto", erro, 0
+            atraso = min(3600, 15 * (2 ** (tentativas - 1)))
+            return item.get("id_outbox"), "pendente", erro, atraso + random.uniform(0, atraso / 4)
+
+    def _finalizar(self, resultados: list):
+        agora = datetime.now(TZ_BR).replace(tzinfo=None)
+        params = []
+        for id_outbox, status, erro, atraso_seg in resultados:
+            processar_apos = None
+            if atraso_seg:
+                processar_apos = (agora + timedelta(seconds=atraso_seg)).strftime("%Y-%m-%d %H:%M:%S")
+            enviado_em = now_str() if status == "enviado" else None
+            params.append((status, processar_apos, enviado_em, (str(erro)[:1000] if erro else None), id_outbox))
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    f"""
+                    UPDATE {TBL_OUTBOX}
+                    SET status=%s,
+                        claim_token=NULL,
+                        processar_apos=%s,
+                        enviado_em=%s,
+                        erro=%s
+                    WHERE id_outbox=%s
+                    """,
+                    params,
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+despachante_whatsapp = DespachanteWhatsApp(
+    WHATSAPP_LOTE, WHATSAPP_MAX_PARALELO, WHATSAPP_RPS, WHATSAPP_RAJADA,
+    WHATSAPP_POLL_SEG, WHATSAPP_MAX_TENTATIVAS, WHATSAPP_RESERVA_EXPIRA_SEG,
+)
+
+
+# =========================
+# Arquivamento de pix_webhook_eventos
+# =========================
+SQL_INDICE_ARQUIVO = """
+    CREATE TABLE IF NOT EXISTS eventos (
+      id_evento INTEGER PRIMARY KEY,
+      pix_id TEXT,
+      recebido_em TEXT,
+      arquivo TEXT NOT NULL,
+      deslocamento INTEGER NOT NULL
+    )
+"""
+
+
+class ArquivadorEventos:
+    """
+    Tira de pix_webhook_eventos o que passou de `retencao_dias` e guarda em disco local:
+    - <dir>/AAAA/MM/eventos-AAAA-MM-DD.ndjson.gz, pelo dia de recebido_em; cada lote
+      acrescenta um membro gzip (o arquivo continua legível com zcat)
+    - <dir>/indice.sqlite: id_evento -> pix_id, arquivo e deslocamento do membro, para
+      buscar() não descomprimir o dia inteiro
+    Por lote: grava e faz fsync do arquivo, grava o índice e só então DELETE no MySQL.
+    Se cair no meio, o lote é arquivado de novo (o índice fica com a cópia mais nova).
+    Um nó por vez (GET_LOCK sem espera); os arquivos ficam no disco de quem arquivou.
+    """
+
+    TRAVA = "pix:arquivar-eventos"
+
+    def __init__(self, diretorio, retencao_dias, lote, pausa_seg=0.0, intervalo_seg=3600.0):
+        self.diretorio = diretorio
+        self.retencao_dias = retencao_dias
+        self.lote = max(1, lote)
+        self.pausa_seg = pausa_seg
+        self.intervalo_seg = intervalo_seg
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def iniciar(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="arquivador-eventos", daemon=True).start()
+        log.info("Arquivador de eventos iniciado (pid=%s, retenção=%s dias, dir=%s)",
+                 os.getpid(), self.retencao_dias, self.diretorio)
+
+    def _loop(self):
+        time.sleep(random.uniform(0, min(self.intervalo_seg, 60)))
+        while True:
+            try:
+                resultado = self.arquivar()
+                if resultado and resultado["arquivados"]:
+                    log.info("Eventos arquivados: %s", resultado)
+            except Exception as e:
+                log.exception("ERRO arquivador de eventos: %r", e)
+            time.sleep(self.intervalo_seg + random.uniform(0, self.intervalo_seg / 10))
+
+    def _indice(self):
+        os.makedirs(self.diretorio, exist_ok=True)
+        indice = sqlite3.connect(os.path.join(self.diretorio, "indice.sqlite"), timeout=30)
+        indice.execute(SQL_INDICE_ARQUIVO)
+        indice.execute("CREATE INDEX IF NOT EXISTS idx_eventos_pix_id ON eventos (pix_id)")
+        return indice
+
+    def _sql_antigos(self) -> str:
+        # no modo assíncrono, evento ainda não processado fica na tabela
+        filtro = ""
+        if WEBHOOK_ASYNC:
+            filtro = "AND (status_processamento IS NULL OR status_processamento NOT IN ('pendente', 'processando'))"
+        return f"""
+            SELECT *
+            FROM {TBL_EVENTOS}
+            WHERE recebido_em < %s
+              {filtro}
+            ORDER BY recebido_em, id_evento
+            LIMIT %s
+        """
+
+    def arquivar(self, max_lotes=None):
+        """
+        Arquiva tudo que passou da retenção. Retorna {"arquivados", "lotes"},
+        ou None se outro processo/nó já está arquivando.
+        """
+        if self.retencao_dias <= 0:
+            return {"arquivados": 0, "lotes": 0}
+        corte = (datetime.now(TZ_BR) - timedelta(days=self.retencao_dias)).strftime("%Y-%m-%d %H:%M:%S")
+        sql = self._sql_antigos()
+        total = lotes = 0
+        conn = db_conn_background()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_GET_LOCK, (self.TRAVA, 0))
+                travou = bool((cursor.fetchone() or {}).get("ok"))
+            conn.commit()
+            if not travou:
+                return None
+            try:
+                indice = self._indice()
+                try:
+                    while max_lotes is None or lotes < max_lotes:
+                        with conn.cursor() as cursor:
+                            cursor.execute(sql, (corte, self.lote))
+                            linhas = cursor.fetchall()
+                        conn.commit()
+                        if not linhas:
+                            break
+                        self._gravar(indice, linhas)
+                        ids = [row["id_evento"] for row in linhas]
+                        with conn.cursor() as cursor:
+                            cursor.execute(
+                                f"DELETE FROM {TBL_EVENTOS} WHERE id_evento IN ({', '.join(['%s'] * len(ids))})",
+                                ids,
+                            )
+                        conn.commit()
+                        total += len(ids)
+                        lotes += 1
+                        metricas.inc("pix_eventos_arquivados_total", len(ids))
+                        if self.pausa_seg:
+                            time.sleep(self.pausa_seg)
+                finally:
+                    indice.close()
+            finally:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(SQL_RELEASE_LOCK, (self.TRAVA,))
+                        cursor.fetchone()
+                    conn.commit()
+                except Exception as e:
+                    # sessão perdida: o MySQL solta a trava sozinho
+                    log.warning("Falha ao liberar trava do arquivador: %r", e)
+        finally:
+            conn.close()
+        return {"arquivados": total, "lotes": lotes}
+
+    def _gravar(self, indice, linhas: list):
+        por_dia = {}
+        for row in linhas:
+            expandir_evento(row)
+            for c in ("headers_json", "json_completo"):
+                if isinstance(row.get(c), str):
+                    try:
+                        row[c] = json.loads(row[c])
+                    except ValueError:
+                        pass
+            por_dia.setdefault(row["recebido_em"].strftime("%Y-%m-%d"), []).append(row)
+
+        registros = []
+        for dia, rows in sorted(por_dia.items()):
+            relativo = os.path.join(dia[:4], dia[5:7], f"eventos-{dia}.ndjson.gz")
+            caminho = os.path.join(self.diretorio, relativo)
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            corpo = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in rows)
+            with open(caminho, "ab") as f:
+                f.seek(0, os.SEEK_END)
+                deslocamento = f.tell()
+                f.write(gzip.compress(corpo.encode("utf-8")))
+                f.flush()
+                os.fsync(f.fileno())
+            registros += [
+                (r["id_evento"], r.get("pix_id"), str(r["recebido_em"]), relativo, deslocamento) for r in rows
+            ]
+        indice.executemany("INSERT OR REPLACE INTO eventos VALUES (?, ?, ?, ?, ?)", registros)
+        indice.commit()
+
+    def buscar(self, pix_id: str) -> list:
+        """Eventos arquivados do pix_id (mais antigo primeiro), lidos só dos membros gzip indexados."""
+        if not os.path.exists(os.path.join(self.diretorio, "indice.sqlite")):
+            return []
+        indice = self._indice()
+        try:
+            linhas = indice.execute(
+                "SELECT id_evento, arquivo, deslocamento FROM eventos WHERE pix_id = ? ORDER BY id_evento",
+                (pix_id,),
+            ).fetchall()
+        finally:
+            indice.close()
+
+        por_membro = {}
+        for id_evento, arquivo, deslocamento in linhas:
+            por_membro.setdefault((arquivo, deslocamento), set()).add(id_evento)
+        eventos = {}
+        for (arquivo, deslocamento), ids in por_membro.items():
+            with open(os.path.join(self.diretorio, arquivo), "rb") as f:
+                f.seek(deslocamento)
+                # o GzipFile segue para os membros seguintes; para assim que achar todos
+                for linha in gzip.GzipFile(fileobj=f):
+                    row = json.loads(linha)
+                    if row.get("id_evento") in ids:
+                        eventos[row["id_evento"]] = row
+                        ids.discard(row["id_evento"])
+                        if not ids:
+                            break
+        return [eventos[i] for i in sorted(eventos)]
+
+
+arquivador_eventos = ArquivadorEventos(
+    EVENTOS_ARQUIVO_DIR, EVENTOS_RETENCAO_DIAS, EVENTOS_ARQUIVO_LOTE,
+    EVENTOS_ARQUIVO_PAUSA_SEG, EVENTOS_ARQUIVAR_INTERVALO_SEG,
+)
+
+
+# =========================
+# Verificação de esquema (índices e planos das consultas quentes)
+# =========================
+def indices_necessarios() -> list:
+    """(tabela, colunas, único) exigidos pelas consultas do app, conforme os recursos ligados."""
+    indices = [
+        ("pix_cobrancas_geradas", ("pix_id",), False),
+        ("pix_recebidos", ("pix_id",), True),          # upsert ON DUPLICATE KEY
+        ("pix_webhook_eventos", ("pix_id",), False),
+        ("dadospix", ("codigoparasistema", "codcadastro"), False),
+        ("dadospix", ("codcadastro",), False),
+        ("autenticacao", ("CODIGOEMPRESA",), False),
+    ]
+    if WEBHOOK_ASYNC:
+        indices += [
+            ("pix_webhook_eventos", ("status_processamento", "id_evento"), False),
+            ("pix_webhook_eventos", ("claim_token",), False),
+        ]
+    if WHATSAPP_OUTBOX:
+        indices += [
+            ("pix_whatsapp_outbox", ("pix_id", "telefone"), True),
+            ("pix_whatsapp_outbox", ("status", "id_outbox"), False),
+            ("pix_whatsapp_outbox", ("claim_token",), False),
+        ]
+    if TOKEN_RENOVADOR:
+        indices.append(("dadospix", ("token_company_expires_at",), False))
+    if FEED_RECEBIDOS:
+        indices += [
+            ("pix_recebidos_liquidacoes", ("codigoparasistema", "id_liquidacao"), False),
+            ("pix_recebidos_liquidacoes", ("liquidado_em",), False),
+        ]
+    if EVENTOS_ARQUIVAR_EMBUTIDO:
+        indices.append(("pix_webhook_eventos", ("recebido_em",), False))
+    return indices
+
+
+def verificar_indices(cursor) -> list:
+    """
+    Confere em information_schema se cada índice necessário existe: basta um índice
+    cujas primeiras colunas sejam as pedidas (único: exatamente essas colunas).
+    Retorna a lista de faltantes com o DDL sugerido.
+    """
+    necessarios = indices_necessarios()
+    tabelas = sorted({t for t, _, _ in necessarios})
+    cursor.execute(
+        f"""
+        SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, SEQ_IN_INDEX, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = %s
+          AND TABLE_NAME IN ({", ".join(["%s"] * len(tabelas))})
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+        """,
+        (DB_NAME, *tabelas),
+    )
+    existentes = {}  # (tabela, índice) -> {"colunas": [...], "unico": bool}
+    for row in cursor.fetchall():
+        idx = existentes.setdefault(
+            (row["TABLE_NAME"].lower(), row["INDEX_NAME"]),
+            {"colunas": [], "unico": not int(row["NON_UNIQUE"])},
+        )
+        idx["colunas"].append(row["COLUMN_NAME"].lower())
+
+    faltando = []
+    for tabela, colunas, unico in necessarios:
+        pedidas = [c.lower() for c in colunas]
+        ok = False
+        for (t, _), idx in existentes.items():
+            if t != tabela.lower():
+                continue
+            if unico:
+                ok = idx["unico"] and idx["colunas"] == pedidas
+            else:
+                ok = idx["colunas"][:len(pedidas)] == pedidas
+            if ok:
+                break
+        if not ok:
+            nome = ("uk_" if unico else "idx_") + tabela.replace("pix_", "") + "_" + "_".join(pedidas)
+            faltando.append({
+                "tabela": tabela,
+                "colunas": list(colunas),
+                "unico": unico,
+                "ddl": f"ALTER TABLE {tabela} ADD {'UNIQUE KEY' if unico else 'INDEX'} {nome[:64]} ({', '.join(colunas)})",
+            })
+    return faltando
+
+
+def consultas_quentes(pix_id: str = "x", codigo: int = 0) -> list:
+    """(nome, sql, params) das consultas do caminho do webhook; pix_id/codigo = valores de exemplo."""
+    consultas = [
+        ("vinculo_por_pix", SQL_VINCULO_POR_PIX, (pix_id,)),
+        ("ja_liquidado", SQL_JA_LIQUIDADO, (pix_id,)),
+        ("eventos_por_pix", f"SELECT id_evento FROM {TBL_EVENTOS} WHERE pix_id = %s", (pix_id,)),
+    ]
+    for (tem_cps, tem_cc), sql in SQL_DADOSPIX.items():
+        params = tuple(codigo for tem in (tem_cps, tem_cc) if tem)
+        consultas.append((f"dadospix_{int(tem_cps)}{int(tem_cc)}", sql, params))
+    return consultas
+
+
+def verificar_planos(cursor) -> list:
+    """
+    EXPLAIN de cada consulta quente; regressão = tabela acessada sem nenhum índice
+    utilizável (possible_keys e key vazios; key sozinho = ORDER BY ... LIMIT pelo índice).
+    O plano escolhido (type=ALL ou não) depende dos dados e das estatísticas — numa base
+    vazia/pequena o otimizador prefere varrer —, já possible_keys só depende dos
+    predicados e dos índices existentes. type=ALL com base semeada é coberto por
+    tests/test_planos_consultas.py.
+    Linha sem tabela ("no matching row in const table") = resolvida por chave única.
+    """
+    problemas = []
+    for nome, sql, params in consultas_quentes():
+        cursor.execute("EXPLAIN " + sql, params)
+        for linha in cursor.fetchall():
+            if linha.get("table") and not linha.get("possible_keys") and not linha.get("key"):
+                problemas.append({
+                    "consulta": nome,
+                    "tabela": linha.get("table"),
+                    "type": linha.get("type"),
+                    "rows": linha.get("rows"),
+                })
+    return problemas
+
+
+def verificar_banco() -> dict:
+    conn = db_conn()
+    try:
+        with conn.cursor() as cursor:
+            resultado = {"indices_faltando": verificar_indices(cursor), "sem_indice": verificar_planos(cursor)}
+        conn.commit()
+        return resultado
+    finally:
+        conn.close()
+
+
+def _verificar_banco_na_subida():
+    try:
+        resultado = verificar_banco()
+    except Exception as e:
+        log.warning("Verificação de índices não rodou: %r", e)
+        return
+    for f in resultado["indices_faltando"]:
+        log.warning("Índice faltando em %s(%s): %s", f["tabela"], ", ".join(f["colunas"]), f["ddl"])
+    for v in resultado["sem_indice"]:
+        log.warning("Consulta %s não tem índice utilizável em %s (type=%s)", v["consulta"], v["tabela"], v["type"])
+
+
+def _carregar_esquemas_na_subida():
+    try:
+        roteador_leitura.executar(lambda cursor: esquema_do_tenant(cursor, None))
+    except Exception as e:
+        log.warning("Índice de esquemas não carregou na subida (carrega no primeiro uso): %r", e)
+
+
+_background_pid = None
+_background_lock = threading.Lock()
+
+
+def iniciar_background():
+    """Sobe as rotinas de background deste processo (idempotente, seguro após fork)."""
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        metricas.iniciar_flush()
+        threading.Thread(target=_carregar_esquemas_na_subida, name="carregar-esquemas", daemon=True).start()
+        if VERIFICAR_BANCO_NA_SUBIDA:
+            threading.Thread(target=_verificar_banco_na_subida, name="verificar-banco", daemon=True).start()
+    if WEBHOOK_ASYNC:
+        processador_eventos.iniciar()
+    if WHATSAPP_OUTBOX and WHATSAPP_DESPACHANTE_EMBUTIDO:
+        despachante_whatsapp.iniciar()
+    if TOKEN_RENOVADOR:
+        renovador_tokens.iniciar()
+    if EVENTOS_ARQUIVAR_EMBUTIDO and EVENTOS_RETENCAO_DIAS > 0:
+        arquivador_eventos.iniciar()
+
+
+# =========================
+# Routes
+# =========================
+def webhook_autorizado() -> bool:
+    auth = request.headers.get("Authorization", "")
+    return not WEBHOOK_AUTH or auth == WEBHOOK_AUTH
+
+
+def resposta_adiada(id_evento, motivo: str, retry_apos: float):
+    """Evento já gravado, processamento adiado: 503 + Retry-After (o provedor reenvia)."""
+    log.warning("Processamento adiado (id_evento=%s): %s", id_evento, motivo)
+    resp = jsonify({"ok": False, "id_evento": id_evento, "status": "adiado", "motivo": motivo})
+    resp.headers["Retry-After"] = str(max(1, int(round(retry_apos))))
+    return resp, 503
+
+
+@app.before_request
+def _garantir_background():
+    _log_contexto.set({})
+    iniciar_background()
+    if request.endpoint in ("webhook_pix", "webhook_pix_lote"):
+        g.metricas_inicio = time.perf_counter()
+        metricas.gauge_add("pix_webhook_em_andamento", 1)
+
+
+@app.teardown_request
+def _medir_webhook(_erro=None):
+    inicio = g.pop("metricas_inicio", None)
+    if inicio is not None:
+        metricas.gauge_add("pix_webhook_em_andamento", -1)
+        metricas.observar("pix_webhook_segundos", time.perf_counter() - inicio, rota=request.endpoint)
+
+
+# Streams e long-poll são lentos por natureza; /metrics e /admin não se medem
+ROTAS_SEM_PERFIL = {
+    "feed_long_poll", "feed_sse", "export_recebidos", "export_eventos",
+    "metrics", "admin_perfis", "admin_perfil", "static",
+}
+
+
+@app.before_request
+def _iniciar_perfil():
+    if request.endpoint in ROTAS_SEM_PERFIL:
+        return
+    motivo = modo = None
+    if PERFIL_AUTH and request.headers.get("X-Perfil") == PERFIL_AUTH:
+        motivo = "header"
+        modo = "cpu" if request.headers.get("X-Perfil-Modo", "").lower() == "cpu" else "wall"
+    elif PERFIL_AMOSTRA > 0 and random.random() < PERFIL_AMOSTRA:
+        motivo, modo = "amostra", PERFIL_MODO
+    elif PERFIL_LENTO_MS <= 0:
+        return
+    perfil = PerfilRequisicao(motivo, modo)
+    g.perfil = perfil
+    _perfil.set(perfil)
+    perfil.iniciar()
+
+
+@app.after_request
+def _fechar_perfil(resp):
+    perfil = g.pop("perfil", None)
+    if perfil is None:
+        return resp
+    _perfil.set(None)
+    duracao = perfil.parar()
+    if perfil.motivo is None and not (PERFIL_LENTO_MS > 0 and duracao * 1000 >= PERFIL_LENTO_MS):
+        return resp
+    try:
+        rel = perfil.relatorio(
+            duracao,
+            metodo=request.method,
+            rota=request.path,
+            endpoint=request.endpoint,
+            status=resp.status_code,
+            contexto=dict(_log_contexto.get()),
+        )
+        guardar_perfil(rel)
+        metricas.inc("pix_perfis_guardados_total", motivo=rel["motivo"])
+        if perfil.motivo == "header":
+            resp.headers["X-Perfil-Id"] = rel["id"]
+    except Exception as e:
+        log.warning("Perfil da requisição não foi guardado: %r", e)
+    return resp
+
+
+@app.teardown_request
+def _descartar_perfil(_erro=None):
+    # after_request não rodou (erro no meio da resposta): só desliga o profiler
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        _perfil.set(None)
+        perfil.parar()
+
+
+@app.get("/metrics")
+def metrics():
+    """Métricas de todos os workers (snapshots em METRICS_DIR) no formato texto do Prometheus."""
+    total = metricas.agregado()
+    return Response(render_prometheus(total), mimetype="text/plain; version=0.0.4")
+
 
-        html = f"""
+@app.get("/")
+def home():
+    return jsonify({
+        "service": "pix-webhook",
+        "status": "ok",
+        "db_pool": db_pool.estatisticas(),
+        "db_pool_background": db_pool_background.estatisticas(),
+        "db_replica": None if db_replica_pool is None else {
+            "em_uso": roteador_leitura._saudavel,
+            "motivo": roteador_leitura.motivo,
+            "atraso_seg": roteador_leitura.atraso,
+            "pool": db_replica_pool.estatisticas(),
+        },
+        "duplicados_absorvidos": dict(duplicados_absorvidos),
+    }), 200
+
+
+@app.post("/webhook/pix-pago")
+def webhook_pix():
+    """
+    - Recebe PIX_SUCCESSFUL {event,id}
+    - Salva SEMPRE em pix_webhook_eventos (commit antes de processar)
+    - WEBHOOK_ASYNC=1: marca o evento como 'pendente' e responde 202 na hora;
+      os workers de background rodam processar_pix_successful
+    - senão: processa na própria requisição, dentro de WEBHOOK_PRAZO_SEG; com a TecnoSpeed
+      fora (disjuntor aberto) ou o processo saturado, o evento fica gravado e a resposta é
+      503 + Retry-After para o provedor reenviar depois
+    """
+    try:
+        if not webhook_autorizado():
+            return jsonify({"error": "Unauthorized"}), 401
+
+        payload = request.get_json(silent=True) or {}
+        event_name = (payload.get("event") or payload.get("type") or "").strip()
+        pix_id = (payload.get("id") or payload.get("pix_id") or "").strip()
+
+        if not pix_id:
+            return jsonify({"error": "pix_id ausente no payload"}), 400
+
+        acrescentar_contexto_log(pix_id=pix_id, evento=event_name)
+        log.info("Webhook recebido (event=%s)", event_name)
+        logar_corpo("Payload do webhook", payload)
+
+        headers_dict = {k: v for k, v in request.headers.items()}
+        processar = event_name.upper() == "PIX_SUCCESSFUL"
+
+        conn = db_conn()
+        try:
+            status_processamento = None
+            if WEBHOOK_ASYNC:
+                status_processamento = "pendente" if processar else "concluido"
+
+            with conn.cursor() as cursor:
+                id_evento = inserir_evento(cursor, event_name, pix_id, headers_dict, payload, status_processamento)
+            conn.commit()
+            acrescentar_contexto_log(id_evento=id_evento)
+
+            if WEBHOOK_ASYNC:
+                if processar:
+                    processador_eventos.acordar()
+                return jsonify({"ok": True, "id_evento": id_evento, "status": status_processamento}), 202
+
+            resultado = {"ok": True}
+            if processar:
+                if disjuntor_tecnospeed.aberto():
+                    metricas.inc("pix_webhook_descartes_total", motivo="disjuntor_aberto")
+                    return resposta_adiada(id_evento, "tecnospeed indisponível", disjuntor_tecnospeed.retry_apos())
+                with vaga_pipeline() as vaga:
+                    if not vaga:
+                        return resposta_adiada(id_evento, "serviço saturado", 2)
+                    try:
+                        with prazo_requisicao(WEBHOOK_PRAZO_SEG):
+                            resultado = processar_pix_successful(conn, pix_id)
+                    except UpstreamIndisponivel as e:
+                        conn.rollback()
+                        return resposta_adiada(id_evento, str(e), e.retry_apos)
+
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        return jsonify(resultado), 200
+
+    except Exception as e:
+        log.exception("ERRO WEBHOOK: %r", e)
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+def _ler_itens_lote() -> list:
+    """Corpo do lote: array JSON, {"eventos": [...]} ou NDJSON (um objeto por linha)."""
+    dados = request.get_json(silent=True)
+    if isinstance(dados, dict):
+        dados = dados.get("eventos")
+    if isinstance(dados, list):
+        return dados
+
+    itens = []
+    for linha in request.get_data(as_text=True).splitlines():
+        linha = linha.strip()
+        if not linha:
+            continue
+        try:
+            itens.append(json.loads(linha))
+        except ValueError:
+            itens.append(None)
+    return itens
+
+
+def _resposta_lote_adiada(resultados: list, a_processar: list, gravados: int, motivo: str, retry_apos: float):
+    """Lote gravado, PIX_SUCCESSFUL não processados: 503 + Retry-After (o cliente reenvia o lote)."""
+    log.warning("Lote adiado (%s itens): %s", len(resultados), motivo)
+    for resultado in a_processar:
+        resultado["ok"], resultado["status"] = False, "adiado"
+    resp = jsonify({"ok": False, "total": len(resultados), "gravados": gravados, "status": "adiado",
+                    "motivo": motivo, "resultados": resultados})
+    resp.headers["Retry-After"] = str(max(1, int(round(retry_apos))))
+    return resp, 503
+
+
+@app.post("/webhook/pix-pago/lote")
+def webhook_pix_lote():
+    """
+    Ingestão em lote de payloads {event,id} (replay do provedor / reprocessamento).
+    - Mesma autenticação de /webhook/pix-pago
+    - Grava todos em pix_webhook_eventos numa transação (INSERT multi-linha)
+    - WEBHOOK_ASYNC=1: PIX_SUCCESSFUL ficam 'pendente' para os workers; responde 202
+    - senão: no máximo WEBHOOK_LOTE_SINCRONO_MAX pix_id distintos (acima: 413, nada gravado),
+      processados com até WEBHOOK_LOTE_PARALELO em paralelo dentro de WEBHOOK_PRAZO_SEG
+      (o lote todo); TecnoSpeed fora ou processo saturado: eventos gravados + 503 Retry-After
+    - Devolve resultado por item, na ordem recebida
+    """
+    try:
+        if not webhook_autorizado():
+            return jsonify({"error": "Unauthorized"}), 401
+
+        itens = _ler_itens_lote()
+        if not itens:
+            return jsonify({"error": "Lote vazio ou inválido"}), 400
+        if len(itens) > WEBHOOK_LOTE_MAX:
+            return jsonify({"error": f"Lote acima do limite ({WEBHOOK_LOTE_MAX})"}), 413
+
+        headers_dict = {k: v for k, v in request.headers.items()}
+        resultados, eventos, a_processar = [], [], []
+
+        for indice, item in enumerate(itens):
+            if not isinstance(item, dict):
+                resultados.append({"indice": indice, "ok": False, "error": "item inválido"})
+                continue
+            event_name = str(item.get("event") or item.get("type") or "").strip()
+            pix_id = str(item.get("id") or item.get("pix_id") or "").strip()
+            if not pix_id:
+                resultados.append({"indice": indice, "ok": False, "error": "pix_id ausente no payload"})
+                continue
+
+            processar = event_name.upper() == "PIX_SUCCESSFUL"
+            status_processamento = None
+            if WEBHOOK_ASYNC:
+                status_processamento = "pendente" if processar else "concluido"
+
+            eventos.append((event_name, pix_id, headers_dict, item, status_processamento))
+            resultado = {"indice": indice, "pix_id": pix_id, "ok": True}
+            if status_processamento:
+                resultado["status"] = status_processamento
+            if processar:
+                a_processar.append(resultado)
+            resultados.append(resultado)
+
+        # cada pix_id é processado uma vez, mesmo repetido no lote
+        unicos = list(dict.fromkeys(r["pix_id"] for r in a_processar))
+        if not WEBHOOK_ASYNC and len(unicos) > WEBHOOK_LOTE_SINCRONO_MAX:
+            return jsonify({
+                "error": f"Lote com {len(unicos)} PIX_SUCCESSFUL distintos; processamento síncrono aceita até "
+                         f"{WEBHOOK_LOTE_SINCRONO_MAX} (divida o lote ou use WEBHOOK_ASYNC=1)",
+            }), 413
+
+        if eventos:
+            conn = db_conn()
+            try:
+                with conn.cursor() as cursor:
+                    inserir_eventos_lote(cursor, eventos)
+                conn.commit()
+            finally:
+                conn.close()
+
+        log.info("Lote recebido: %s itens, %s gravados, %s PIX_SUCCESSFUL", len(itens), len(eventos), len(a_processar))
+
+        if WEBHOOK_ASYNC:
+            if a_processar:
+                processador_eventos.acordar()
+            return jsonify({"ok": True, "total": len(itens), "gravados": len(eventos), "resultados": resultados}), 202
+
+        if unicos:
+            if disjuntor_tecnospeed.aberto():
+                metricas.inc("pix_webhook_descartes_total", motivo="disjuntor_aberto")
+                return _resposta_lote_adiada(resultados, a_processar, len(eventos),
+                                             "tecnospeed indisponível", disjuntor_tecnospeed.retry_apos())
+            with vaga_pipeline() as vaga:
+                if not vaga:
+                    return _resposta_lote_adiada(resultados, a_processar, len(eventos), "serviço saturado", 2)
+                fim_prazo = time.monotonic() + WEBHOOK_PRAZO_SEG if WEBHOOK_PRAZO_SEG > 0 else None
+                with ThreadPoolExecutor(max_workers=max(1, min(WEBHOOK_LOTE_PARALELO, len(unicos)))) as ex:
+                    por_pix = dict(zip(unicos, ex.map(lambda p: processar_pix_isolado(p, fim_prazo), unicos)))
+            for resultado in a_processar:
+                proc = por_pix[resultado["pix_id"]]
+                resultado["processamento"] = proc
+                resultado["ok"] = bool(proc.get("ok"))
+
+        return jsonify({"ok": True, "total": len(itens), "gravados": len(eventos), "resultados": resultados}), 200
+
+    except Exception as e:
+        log.exception("ERRO WEBHOOK LOTE: %r", e)
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+
+# =========================
+# UI (monitor)
+# =========================
+UI_CACHE = {}
+_ui_cache_lock = threading.Lock()
+
+COLS_UI_EVENTOS = "e.id_evento, e.event_name, e.pix_id, e.recebido_em"
+COLS_UI_RECEBIDOS = (
+    "r.id_recebido, r.pix_id, r.status, r.amount, r.payment_date, r.payer_name, "
+    "r.codigoparasistema, r.codcadastro, r.pago, r.recebido_em"
+)
+
+
+def _ui_cache_get(chave):
+    with _ui_cache_lock:
+        item = UI_CACHE.get(chave)
+    if item and time.monotonic() - item[0] < UI_CACHE_TTL:
+        return item[1]
+    return None
+
+
+def _ui_cache_set(chave, valor):
+    with _ui_cache_lock:
+        if len(UI_CACHE) >= UI_CACHE_MAX:
+            agora = time.monotonic()
+            for k in [k for k, (t, _) in UI_CACHE.items() if agora - t >= UI_CACHE_TTL]:
+                del UI_CACHE[k]
+            if len(UI_CACHE) >= UI_CACHE_MAX:
+                UI_CACHE.clear()
+        UI_CACHE[chave] = (time.monotonic(), valor)
+
+
+def _int_arg(nome, estrito: bool = False):
+    """Inteiro da query string; None se ausente/inválido. estrito: inválido levanta ValueError (400)."""
+    valor = request.args.get(nome, "").strip()
+    try:
+        return int(valor)
+    except ValueError:
+        if estrito and valor:
+            raise ValueError(f"{nome} deve ser um número inteiro")
+        return None
+
+
+def _filtros_ui() -> dict:
+    """Filtros do monitor; de/ate (YYYY-MM-DD) e tenant inválidos levantam ValueError (400)."""
+    f = {
+        "pix_id": request.args.get("pix_id", "").strip(),
+        "de": request.args.get("de", "").strip(),
+        "ate": request.args.get("ate", "").strip(),
+        "status": request.args.get("status", "").strip(),
+        "tenant": request.args.get("tenant", "").strip(),
+    }
+    for nome in ("de", "ate"):
+        if f[nome]:
+            try:
+                datetime.strptime(f[nome], "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"{nome} inválido (use YYYY-MM-DD)")
+    if f["tenant"] and not f["tenant"].isdigit():
+        raise ValueError("tenant deve ser um número inteiro")
+    return f
+
+
+def consultar_ui_eventos(cursor, f: dict, antes_id=None, limite=UI_LIMITE) -> list:
+    where, args = [], []
+    if antes_id:
+        where.append("e.id_evento < %s")
+        args.append(antes_id)
+    if f["pix_id"]:
+        where.append("e.pix_id = %s")
+        args.append(f["pix_id"])
+    if f["de"]:
+        where.append("e.recebido_em >= %s")
+        args.append(f["de"])
+    if f["ate"]:
+        where.append("e.recebido_em < DATE_ADD(%s, INTERVAL 1 DAY)")
+        args.append(f["ate"])
+    if f["tenant"]:
+        where.append(f"e.pix_id IN (SELECT c.pix_id FROM {TBL_COBRANCAS} c WHERE c.codigoparasistema = %s)")
+        args.append(f["tenant"])
+    cursor.execute(
+        f"""
+        SELECT {COLS_UI_EVENTOS}
+        FROM {TBL_EVENTOS} e
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY e.id_evento DESC
+        LIMIT %s
+        """,
+        tuple(args) + (limite,),
+    )
+    return cursor.fetchall()
+
+
+def consultar_ui_recebidos(cursor, f: dict, antes_id=None, limite=UI_LIMITE) -> list:
+    where, args = [], []
+    if antes_id:
+        where.append("r.id_recebido < %s")
+        args.append(antes_id)
+    if f["pix_id"]:
+        where.append("r.pix_id = %s")
+        args.append(f["pix_id"])
+    if f["de"]:
+        where.append("r.recebido_em >= %s")
+        args.append(f["de"])
+    if f["ate"]:
+        where.append("r.recebido_em < DATE_ADD(%s, INTERVAL 1 DAY)")
+        args.append(f["ate"])
+    if f["status"]:
+        where.append("r.status = %s")
+        args.append(f["status"])
+    if f["tenant"]:
+        where.append("r.codigoparasistema = %s")
+        args.append(f["tenant"])
+    cursor.execute(
+        f"""
+        SELECT {COLS_UI_RECEBIDOS}
+        FROM {TBL_RECEBIDOS} r
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY r.id_recebido DESC
+        LIMIT %s
+        """,
+        tuple(args) + (limite,),
+    )
+    return cursor.fetchall()
+
+
+def _tabela_html(linhas: list, colunas: list, link_detalhe: str, chave_id: str) -> str:
+    if not linhas:
+        return "<p><i>Nenhum registro.</i></p>"
+    cab = "".join(f"<th>{html.escape(c)}</th>" for c in colunas)
+    corpo = []
+    for ln in linhas:
+        celulas = []
+        for c in colunas:
+            v = ln.get(c)
+            if c == "amount":
+                texto = money_br(v)
+            else:
+                texto = "" if v is None else str(v)
+            celulas.append(f"<td>{html.escape(texto)}</td>")
+        url = f"{link_detalhe}/{ln.get(chave_id)}"
+        celulas.append(f'<td><a href="{html.escape(url)}">json</a></td>')
+        corpo.append("<tr>" + "".join(celulas) + "</tr>")
+    return (
+        '<table border="1" cellpadding="4" cellspacing="0" style="border-collapse:collapse;font-size:13px;">'
+        f"<tr>{cab}<th></th></tr>{''.join(corpo)}</table>"
+    )
+
+
+def _url_ui(f: dict, **extra) -> str:
+    params = {k: v for k, v in f.items() if v}
+    params.update({k: v for k, v in extra.items() if v})
+    return "/ui" + ("?" + urlencode(params) if params else "")
+
+
+@app.get("/ui")
+def ui():
+    """
+    Monitor: só colunas de resumo, paginação keyset (antes_evento / antes_recebido),
+    filtros (pix_id, de/ate em recebido_em, status, tenant=codigoparasistema).
+    JSON completo sob demanda em /ui/evento/<id> e /ui/recebido/<id>.
+    Cache de UI_CACHE_TTL segundos por URL.
+    """
+    chave = request.full_path
+    pagina = _ui_cache_get(chave)
+    if pagina is not None:
+        return Response(pagina, mimetype="text/html")
+
+    try:
+        f = _filtros_ui()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    antes_evento = _int_arg("antes_evento")
+    antes_recebido = _int_arg("antes_recebido")
+
+    eventos, recebidos = roteador_leitura.executar(
+        lambda cursor: (consultar_ui_eventos(cursor, f, antes_evento), consultar_ui_recebidos(cursor, f, antes_recebido))
+    )
+
+    # um link por lista: avança só aquela e mantém o cursor atual da outra
+    mais_eventos = mais_recebidos = ""
+    if len(eventos) == UI_LIMITE:
+        url = _url_ui(f, antes_evento=eventos[-1]["id_evento"], antes_recebido=antes_recebido)
+        mais_eventos = f'<p><a href="{html.escape(url)}">Mais eventos →</a></p>'
+    if len(recebidos) == UI_LIMITE:
+        url = _url_ui(f, antes_evento=antes_evento, antes_recebido=recebidos[-1]["id_recebido"])
+        mais_recebidos = f'<p><a href="{html.escape(url)}">Mais recebidos →</a></p>'
+
+    def campo(nome, rotulo, largura, tipo="text"):
+        return (
+            f'<label>{rotulo}</label> <input type="{tipo}" name="{nome}" value="{html.escape(f[nome])}" '
+            f'style="width:{largura}px;padding:6px;margin-right:8px;" />'
+        )
+
+    pagina = f"""
         <html>
           <head><meta charset="utf-8"><title>PIX Monitor</title></head>
           <body style="font-family: Arial; margin: 20px;">
             <h2>PIX Monitor (Railway)</h2>
 
             <form method="get" action="/ui" style="margin-bottom: 14px;">
-              <label>Buscar por PIX ID:</label>
-              <input name="pix_id" value="{pix_id}" style="width:520px;padding:6px;" />
+              {campo("pix_id", "PIX ID:", 320)}
+              {campo("de", "De:", 140, "date")}
+              {campo("ate", "Até:", 140, "date")}
+              {campo("status", "Status:", 110)}
+              {campo("tenant", "Empresa:", 80)}
               <button type="submit" style="padding:6px 10px;">Buscar</button>
               <a href="/ui" style="margin-left:10px;">Limpar</a>
             </form>
 
             <h3>Últimos Eventos (pix_webhook_eventos)</h3>
-            <pre style="background:#f6f6f6;padding:10px;border-radius:8px;overflow:auto;max-height:360px;">{json.dumps(eventos, ensure_ascii=False, indent=2)}</pre>
+            {_tabela_html(eventos, ["id_evento", "event_name", "pix_id", "recebido_em"], "/ui/evento", "id_evento")}
+            {mais_eventos}
 
             <h3>PIX Recebidos (pix_recebidos)</h3>
-            <pre style="background:#f6f6f6;padding:10px;border-radius:8px;overflow:auto;max-height:360px;">{json.dumps(recebidos, ensure_ascii=False, indent=2)}</pre>
+            {_tabela_html(recebidos, ["id_recebido", "pix_id", "status", "amount", "payment_date", "payer_name",
+                                      "codigoparasistema", "codcadastro", "pago", "recebido_em"],
+                          "/ui/recebido", "id_recebido")}
+            {mais_recebidos}
           </body>
         </html>
         """
-        return Response(html, mimetype="text/html")
+    _ui_cache_set(chave, pagina)
+    return Response(pagina, mimetype="text/html")
+
+
+def _detalhe_json(tabela: str, coluna_id: str, valor_id: int):
+    def ler(cursor):
+        cursor.execute(f"SELECT * FROM {tabela} WHERE {coluna_id}=%s LIMIT 1", (valor_id,))
+        return cursor.fetchone()
+
+    row = roteador_leitura.executar(ler)
+
+    if not row:
+        return jsonify({"error": "Não encontrado"}), 404
+    expandir_evento(row)
+    for c in ("headers_json", "json_completo"):
+        if isinstance(row.get(c), str):
+            try:
+                row[c] = json.loads(row[c])
+            except ValueError:
+                pass
+    corpo = json.dumps(row, ensure_ascii=False, indent=2, default=str)
+    return Response(corpo, mimetype="application/json")
+
+
+@app.get("/ui/evento/<int:id_evento>")
+def ui_evento(id_evento):
+    return _detalhe_json(TBL_EVENTOS, "id_evento", id_evento)
+
 
+@app.get("/ui/arquivo")
+def ui_arquivo():
+    """Eventos já arquivados (EVENTOS_RETENCAO_DIAS) de um pix_id: ?pix_id=..."""
+    pix_id = request.args.get("pix_id", "").strip()
+    if not pix_id:
+        return jsonify({"error": "pix_id obrigatório"}), 400
+    corpo = json.dumps(arquivador_eventos.buscar(pix_id), ensure_ascii=False, indent=2, default=str)
+    return Response(corpo, mimetype="application/json")
+
+
+@app.get("/ui/recebido/<int:id_recebido>")
+def ui_recebido(id_recebido):
+    return _detalhe_json(TBL_RECEBIDOS, "id_recebido", id_recebido)
+
+
+def _negar_admin():
+    if not PERFIL_AUTH:
+        return jsonify({"error": "Perfis desabilitados (defina PERFIL_AUTH)"}), 403
+    if request.headers.get("Authorization", "") != PERFIL_AUTH:
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+
+@app.get("/admin/perfis")
+def admin_perfis():
+    """Resumo dos relatórios guardados (lentas, amostradas e pedidas por X-Perfil), mais novo primeiro."""
+    negado = _negar_admin()
+    if negado:
+        return negado
+    return jsonify(listar_perfis())
+
+
+@app.get("/admin/perfis/<id_perfil>")
+def admin_perfil(id_perfil):
+    """Relatório completo: linha do tempo de SQL/HTTP/etapas e, se houver, o cProfile (?formato=texto)."""
+    negado = _negar_admin()
+    if negado:
+        return negado
+    rel = ler_perfil(id_perfil)
+    if rel is None:
+        return jsonify({"error": "Não encontrado"}), 404
+    if request.args.get("formato") == "texto":
+        linhas = [f"{rel.get('metodo')} {rel.get('rota')} -> {rel.get('status')} em {rel.get('duracao_ms')}ms "
+                  f"({rel.get('motivo')})", ""]
+        for ev in rel.get("linha_do_tempo", []):
+            extra = " ".join(f"{k}={ev[k]}" for k in ("status", "linhas", "erro") if ev.get(k) is not None)
+            linhas.append(f"{ev['inicio_ms']:>10.1f}ms {ev['duracao_ms']:>9.1f}ms  {ev['tipo']:<5} {ev['detalhe']} {extra}")
+        if rel.get("perfil"):
+            linhas += ["", rel["perfil"]]
+        return Response("\n".join(linhas) + "\n", mimetype="text/plain")
+    return Response(json.dumps(rel, ensure_ascii=False, indent=2, default=str), mimetype="application/json")
+
+
+# =========================
+# Exportação (streaming)
+# =========================
+COLS_EXPORT_RECEBIDOS = [
+    "id_recebido", "pix_id", "surrogate_key", "status", "amount", "payment_date",
+    "payer_cpf_cnpj", "payer_name", "created_at_api", "recebido_em",
+    "codigoparasistema", "codcadastro", "id_cobrancas", "pago",
+]
+COLS_EXPORT_EVENTOS = ["id_evento", "event_name", "pix_id", "recebido_em"]
+
+_RE_DATA = re.compile(r"^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$")
+
+
+def _filtro_periodo(where: list, args: list, coluna: str, prefixo: str):
+    """?<prefixo>_de / ?<prefixo>_ate (YYYY-MM-DD[ HH:MM[:SS]]); só data em _ate inclui o dia."""
+    for sufixo in ("de", "ate"):
+        valor = request.args.get(f"{prefixo}_{sufixo}", "").strip()
+        if not valor:
+            continue
+        if not _RE_DATA.match(valor):
+            raise ValueError(f"{prefixo}_{sufixo} inválido (use YYYY-MM-DD ou YYYY-MM-DD HH:MM:SS)")
+        if sufixo == "de":
+            where.append(f"{coluna} >= %s")
+        elif len(valor) == 10:
+            where.append(f"{coluna} < DATE_ADD(%s, INTERVAL 1 DAY)")
+        else:
+            where.append(f"{coluna} <= %s")
+        args.append(valor)
+
+
+def consulta_export_recebidos():
+    where, args = [], []
+    _filtro_periodo(where, args, "payment_date", "payment")
+    _filtro_periodo(where, args, "recebido_em", "recebido")
+    if request.args.get("status", "").strip():
+        where.append("status = %s")
+        args.append(request.args["status"].strip().upper())
+    # filtro de tenant: valor inválido é 400, nunca "sem filtro"
+    codigo = _int_arg("codigoparasistema", estrito=True)
+    if codigo is not None:
+        where.append("codigoparasistema = %s")
+        args.append(codigo)
+    pago = request.args.get("pago", "").strip()
+    if pago:
+        if pago not in ("0", "1"):
+            raise ValueError("pago deve ser 0 ou 1")
+        where.append("pago = %s")
+        args.append(int(pago))
+
+    colunas = COLS_EXPORT_RECEBIDOS + (["json_completo"] if request.args.get("json") == "1" else [])
+    sql = f"""
+        SELECT {", ".join(colunas)}
+        FROM {TBL_RECEBIDOS}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY id_recebido
+    """
+    return sql, tuple(args), colunas
+
+
+def consulta_export_eventos():
+    where, args = [], []
+    _filtro_periodo(where, args, "recebido_em", "recebido")
+    for coluna in ("event_name", "pix_id"):
+        if request.args.get(coluna, "").strip():
+            where.append(f"{coluna} = %s")
+            args.append(request.args[coluna].strip())
+
+    colunas = COLS_EXPORT_EVENTOS + (["headers_json", "json_completo"] if request.args.get("json") == "1" else [])
+    selecionadas = colunas + (["headers_z", "json_z"] if EVENTOS_COMPACTO and "json_completo" in colunas else [])
+    sql = f"""
+        SELECT {", ".join(selecionadas)}
+        FROM {TBL_EVENTOS}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY id_evento
+    """
+    return sql, tuple(args), colunas
+
+
+def _valor_csv(v):
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d %H:%M:%S")
+    return v
+
+
+def _linhas_exportadas(tipo: str, sql: str, args: tuple, colunas: list, formato: str):
+    """
+    Gera o corpo em pedaços direto de um SSDictCursor (sem buffer no cliente MySQL):
+    memória constante, primeiro byte assim que a 1ª linha chega. Conexão própria,
+    fora do pool, porque o resultado fica preso à conexão até o fim do streaming.
+    """
+    conn = roteador_leitura.conexao_avulsa(cursorclass=pymysql.cursors.SSDictCursor, autocommit=True)
+    total = 0
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET SESSION net_write_timeout = %s", (EXPORT_NET_WRITE_TIMEOUT,))
+            cursor.execute(sql, args)
+
+            buf = io.StringIO()
+            escritor = csv.writer(buf, lineterminator="\n") if formato == "csv" else None
+            if escritor:
+                escritor.writerow(colunas)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+            while True:
+                linhas = cursor.fetchmany(EXPORT_LOTE)
+                if not linhas:
+                    break
+                for row in linhas:
+                    expandir_evento(row)
+                    if escritor:
+                        escritor.writerow([_valor_csv(row.get(c)) for c in colunas])
+                    else:
+                        buf.write(json.dumps(row, ensure_ascii=False, default=str))
+                        buf.write("\n")
+                total += len(linhas)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
     finally:
+        conn.close()
+        metricas.inc("pix_export_linhas_total", total, tipo=tipo)
+        log.info("Exportação %s (%s): %s linhas", tipo, formato, total)
+
+
+def _negar_leitura():
+    """Export e feed: None se autorizado, senão a resposta de erro."""
+    if not EXPORT_AUTH:
+        return jsonify({"error": "Exportação desabilitada (defina EXPORT_AUTH)"}), 403
+    if request.headers.get("Authorization", "") != EXPORT_AUTH:
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+
+def _exportar(tipo: str, montar_consulta):
+    negado = _negar_leitura()
+    if negado:
+        return negado
+
+    formato = request.args.get("formato", "csv").strip().lower()
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"error": "formato deve ser csv ou ndjson"}), 400
+    try:
+        sql, args, colunas = montar_consulta()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    mimetype = "text/csv" if formato == "csv" else "application/x-ndjson"
+    nome = f"pix_{tipo}_{datetime.now(TZ_BR).strftime('%Y%m%d_%H%M%S')}.{formato}"
+    resp = Response(stream_with_context(_linhas_exportadas(tipo, sql, args, colunas, formato)),
+                    mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{nome}"'
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@app.get("/export/recebidos")
+def export_recebidos():
+    """
+    pix_recebidos em CSV (padrão) ou NDJSON (?formato=ndjson), em streaming.
+    Filtros: payment_de/payment_ate, recebido_de/recebido_ate, status, codigoparasistema,
+    pago=0|1; json=1 inclui json_completo. Header Authorization = EXPORT_AUTH.
+    """
+    return _exportar("recebidos", consulta_export_recebidos)
+
+
+@app.get("/export/eventos")
+def export_eventos():
+    """pix_webhook_eventos: recebido_de/recebido_ate, event_name, pix_id; json=1 inclui headers/payload."""
+    return _exportar("eventos", consulta_export_eventos)
+
+
+# =========================
+# Feed de liquidações (SSE / long-poll)
+# =========================
+COLS_FEED = (
+    "l.id_liquidacao, r.id_recebido, r.pix_id, r.status, r.amount, r.payment_date, r.codigoparasistema, "
+    "r.codcadastro, r.id_cobrancas, r.pago, r.recebido_em"
+)
+
+# ponto de partida: liquidações com mais de FEED_LACUNA_SEG já estão commitadas
+SQL_FEED_INICIO = f"""
+    SELECT COALESCE(MAX(id_liquidacao), 0) AS ultimo
+    FROM {TBL_LIQUIDACOES}
+    WHERE liquidado_em < %s
+"""
+
+SQL_FEED_NOVOS = f"""
+    SELECT {COLS_FEED}
+    FROM {TBL_LIQUIDACOES} l
+    JOIN {TBL_RECEBIDOS} r ON r.id_recebido = l.id_recebido
+    WHERE l.id_liquidacao > %s
+      {{filtro}}
+    ORDER BY l.id_liquidacao
+    LIMIT %s
+"""
+
+
+class FeedRecebidos:
+    """
+    Liquidações novas (pix_recebidos_liquidacoes) para assinantes deste processo.
+    - UMA consulta por processo a cada FEED_POLL_SEG, só enquanto houver assinantes,
+      por mais que sejam; o pipeline acorda a busca logo após o commit local
+    - cursor = id_liquidacao, gravado na transação que definiu payment_date: linha
+      criada antes e liquidada depois entra no feed quando liquida
+    - auto-incremento não é ordem de commit: um id que falta (transação ainda aberta)
+      segura o cursor até aparecer ou até `lacuna_seg` (rollback); nada é publicado
+      depois de uma lacuna recente
+    - buffer com as últimas `buffer_max` linhas; cursor mais antigo que o buffer é
+      atendido direto do banco (primário), em páginas, só até o início do buffer
+    - assinantes síncronos esperam numa Condition; os do motor ASGI registram um
+      ouvinte (callback) e esperam num asyncio.Event
+    """
+
+    def __init__(self, poll_seg, buffer_max, lote, lacuna_seg):
+        self.poll_seg = poll_seg
+        self.buffer_max = max(1, buffer_max)
+        self.lote = max(1, lote)
+        self.lacuna_seg = lacuna_seg
+        self.geracao = 0
+        self.assinantes = 0
+        self._cond = threading.Condition()
+        self._buffer = deque()
+        self._base = None       # id_liquidacao antes do 1º item do buffer
+        self._ultimo_id = None  # maior id_liquidacao publicado
+        self._passo = 1         # @@auto_increment_increment
+        self._lacuna = None     # (id esperado, monotonic em que faltou)
+        self._busca_lock = threading.Lock()
+        self._ouvintes = set()
+        self._acordar = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def iniciar(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="feed-recebidos", daemon=True).start()
+
+    def acordar(self):
+        self._acordar.set()
+
+    def entrar(self, maximo: int) -> bool:
+        """Registra um assinante (False se o limite do processo foi atingido)."""
+        self.iniciar()
+        with self._cond:
+            if self.assinantes >= maximo:
+                metricas.inc("pix_feed_recusas_total")
+                return False
+            self.assinantes += 1
+        if self._ultimo_id is None:
+            try:
+                self._buscar_novos()
+            except Exception:
+                self.sair()
+                raise
+        self.acordar()
+        return True
+
+    def sair(self):
+        with self._cond:
+            self.assinantes = max(0, self.assinantes - 1)
+
+    def ouvir(self, callback):
+        with self._cond:
+            self._ouvintes.add(callback)
+
+    def parar_de_ouvir(self, callback):
+        with self._cond:
+            self._ouvintes.discard(callback)
+
+    def ultimo_id(self) -> int:
+        with self._cond:
+            return self._ultimo_id or 0
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(self.poll_seg)
+            self._acordar.clear()
+            if not self.assinantes:
+                continue
+            try:
+                self._buscar_novos()
+            except Exception as e:
+                log.exception("ERRO feed de liquidações: %r", e)
+
+    def _buscar_novos(self):
+        # sempre no primário: acordar() chega logo após o commit, antes da réplica ver a linha
+        with self._busca_lock:
+            conn = db_conn_background()
+            try:
+                with conn.cursor() as cursor:
+                    with self._cond:
+                        ultimo = self._ultimo_id
+                    if ultimo is None:
+                        limite = datetime.now(TZ_BR) - timedelta(seconds=self.lacuna_seg)
+                        cursor.execute(SQL_FEED_INICIO, (limite.strftime("%Y-%m-%d %H:%M:%S"),))
+                        ultimo = int((cursor.fetchone() or {}).get("ultimo") or 0)
+                        cursor.execute("SELECT @@auto_increment_increment AS passo")
+                        passo = int((cursor.fetchone() or {}).get("passo") or 1)
+                        with self._cond:
+                            self._ultimo_id = self._base = ultimo
+                            self._passo = max(1, passo)
+                    while True:
+                        cursor.execute(SQL_FEED_NOVOS.format(filtro=""), (ultimo, self.lote))
+                        linhas = cursor.fetchall()
+                        prontas = self._sem_lacunas(ultimo, linhas)
+                        if prontas:
+                            self._publicar(prontas)
+                            ultimo = prontas[-1]["id_liquidacao"]
+                        if len(prontas) < self.lote:
+                            break
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _sem_lacunas(self, ultimo: int, linhas: list) -> list:
+        """Prefixo de `linhas` sem id faltando (ou cuja falta já passou de lacuna_seg)."""
+        esperado = ultimo + self._passo
+        prontas = []
+        for linha in linhas:
+            id_liquidacao = linha["id_liquidacao"]
+            if id_liquidacao > esperado:
+                agora = time.monotonic()
+                if self._lacuna is None or self._lacuna[0] != esperado:
+                    self._lacuna = (esperado, agora)
+                if agora - self._lacuna[1] < self.lacuna_seg:
+                    break
+                log.warning("Feed: id_liquidacao %s..%s não apareceu em %.0fs (rollback?); seguindo.",
+                            esperado, id_liquidacao - self._passo, self.lacuna_seg)
+                metricas.inc("pix_feed_lacunas_puladas_total")
+                self._lacuna = None
+            prontas.append(linha)
+            esperado = id_liquidacao + self._passo
+        return prontas
+
+    def _publicar(self, linhas: list):
+        with self._cond:
+            for linha in linhas:
+                if linha["id_liquidacao"] <= (self._ultimo_id or 0):
+                    continue
+                self._buffer.append(linha)
+                self._ultimo_id = linha["id_liquidacao"]
+                if len(self._buffer) > self.buffer_max:
+                    self._base = self._buffer.popleft()["id_liquidacao"]
+            self.geracao += 1
+            self._cond.notify_all()
+            ouvintes = list(self._ouvintes)
+        for callback in ouvintes:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def do_buffer(self, desde: int, tenant, limite: int):
+        """(linhas, cursor, geracao); linhas=None se `desde` é anterior ao buffer (ir ao banco)."""
+        with self._cond:
+            geracao = self.geracao
+            if self._ultimo_id is None or desde >= self._ultimo_id:
+                return [], max(desde, self._ultimo_id or 0), geracao
+            if desde < self._base:
+                return None, desde, geracao
+            linhas = []
+            for linha in self._buffer:
+                if linha["id_liquidacao"] <= desde:
+                    continue
+                if tenant is not None and linha.get("codigoparasistema") != tenant:
+                    continue
+                linhas.append(linha)
+                if len(linhas) >= limite:
+                    return linhas, linhas[-1]["id_liquidacao"], geracao
+            return linhas, self._ultimo_id, geracao
+
+    def do_banco(self, desde: int, tenant, limite: int):
+        """
+        Recuperação de cursor antigo direto do banco, até o início do buffer (o que já
+        passou pela checagem de lacunas). Primário: a réplica aplica em ordem de commit
+        e pode ainda não ter um id menor que outro já visível. Retorna (linhas, cursor).
+        """
+        with self._cond:
+            base = self._base or 0
+        filtro = "AND l.id_liquidacao <= %s" + (" AND l.codigoparasistema = %s" if tenant is not None else "")
+        args = (desde, base, tenant, limite) if tenant is not None else (desde, base, limite)
+        conn = db_conn()
         try:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_FEED_NOVOS.format(filtro=filtro), args)
+                linhas = cursor.fetchall()
+            conn.commit()
+        finally:
             conn.close()
-        except Exception:
-            pass
+        if len(linhas) >= limite:
+            return linhas, linhas[-1]["id_liquidacao"]
+        return linhas, max(desde, base)
+
+    def proximos(self, desde: int, tenant, limite: int):
+        """(linhas, cursor, geracao) a partir de `desde` (buffer ou banco)."""
+        linhas, cursor, geracao = self.do_buffer(desde, tenant, limite)
+        if linhas is None:
+            linhas, cursor = self.do_banco(desde, tenant, limite)
+        return linhas, cursor, geracao
+
+    def esperar(self, geracao: int, timeout: float):
+        with self._cond:
+            if self.geracao == geracao:
+                self._cond.wait(timeout)
+
+
+feed_recebidos = FeedRecebidos(FEED_POLL_SEG, FEED_BUFFER, FEED_LOTE, FEED_LACUNA_SEG)
+
+
+def _coletar_feed(m: Metricas):
+    m.gauge_set("pix_feed_assinantes", feed_recebidos.assinantes)
+
+
+metricas.coletores.append(_coletar_feed)
+
+
+def linha_feed_json(linha: dict) -> str:
+    return json.dumps(linha, ensure_ascii=False, default=str)
+
+
+def evento_sse(linha: dict) -> str:
+    return f"id: {linha['id_liquidacao']}\nevent: liquidado\ndata: {linha_feed_json(linha)}\n\n"
+
+
+def _negar_feed():
+    if not FEED_RECEBIDOS:
+        return jsonify({"error": "Feed desabilitado (FEED_RECEBIDOS=1, requer sql/006_pix_recebidos_liquidacoes.sql)"}), 404
+    return _negar_leitura()
+
+
+def _args_feed():
+    """(desde|None, tenant|None, limite) da query string / Last-Event-ID. Tenant inválido: ValueError."""
+    desde = _int_arg("desde")
+    if desde is None:
+        try:
+            desde = int(request.headers.get("Last-Event-ID", ""))
+        except ValueError:
+            desde = None
+    limite = _int_arg("limite") or FEED_LOTE
+    return desde, _int_arg("codigoparasistema", estrito=True), max(1, min(limite, FEED_LOTE))
+
+
+@app.get("/feed/recebidos")
+def feed_long_poll():
+    """
+    Long-poll de liquidações: responde assim que houver id_liquidacao > desde
+    (ou após ?espera= seg., máx. FEED_ESPERA_MAX). Sem desde: só o que chegar a partir
+    de agora. Filtro: codigoparasistema. Retoma com o "cursor" devolvido.
+    """
+    negado = _negar_feed()
+    if negado:
+        return negado
+    try:
+        desde, tenant, limite = _args_feed()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        espera = min(FEED_ESPERA_MAX, max(0.0, float(request.args.get("espera", FEED_ESPERA_MAX))))
+    except ValueError:
+        espera = FEED_ESPERA_MAX
+
+    if not feed_recebidos.entrar(FEED_MAX_ASSINANTES):
+        resp = jsonify({"error": "Limite de assinantes do feed neste processo"})
+        resp.headers["Retry-After"] = "5"
+        return resp, 503
+    try:
+        cursor = feed_recebidos.ultimo_id() if desde is None else desde
+        fim = time.monotonic() + espera
+        while True:
+            linhas, cursor, geracao = feed_recebidos.proximos(cursor, tenant, limite)
+            restante = fim - time.monotonic()
+            if linhas or restante <= 0:
+                break
+            feed_recebidos.esperar(geracao, restante)
+    finally:
+        feed_recebidos.sair()
+
+    corpo = json.dumps({"cursor": cursor, "recebidos": linhas}, ensure_ascii=False, default=str)
+    return Response(corpo, mimetype="application/json")
+
+
+@app.get("/feed/recebidos/stream")
+def feed_sse():
+    """
+    Server-Sent Events (event: liquidado, id: id_liquidacao). Reconexão do EventSource
+    retoma pelo Last-Event-ID. Para muitos assinantes ociosos use o motor ASGI.
+    """
+    negado = _negar_feed()
+    if negado:
+        return negado
+    try:
+        desde, tenant, limite = _args_feed()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not feed_recebidos.entrar(FEED_MAX_ASSINANTES):
+        resp = jsonify({"error": "Limite de assinantes do feed neste processo"})
+        resp.headers["Retry-After"] = "5"
+        return resp, 503
+
+    def gerar():
+        try:
+            cursor = feed_recebidos.ultimo_id() if desde is None else desde
+            yield "retry: 2000\n\n"
+            while True:
+                linhas, cursor, geracao = feed_recebidos.proximos(cursor, tenant, limite)
+                if linhas:
+                    yield "".join(evento_sse(l) for l in linhas)
+                    continue
+                feed_recebidos.esperar(geracao, FEED_HEARTBEAT_SEG)
+                if feed_recebidos.geracao == geracao:
+                    yield ": ping\n\n"
+        finally:
+            feed_recebidos.sair()
+
+    resp = Response(stream_with_context(gerar()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
 if __name__ == "__main__":
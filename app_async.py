@@ -0,0 +1,569 @@
+"""
+Motor ASGI (asyncio) opcional do serviço de webhook.
+
+Mesmas rotas do app Flask: `/` e `/webhook/pix-pago` rodam aqui com aiomysql e
+httpx (pools de conexão assíncronos), então um processo segura centenas de
+webhooks em voo; `/feed/recebidos/stream` (SSE) segura milhares de assinantes
+ociosos. O restante (`/ui`, `/metrics`, lote...) é servido pelo próprio app
+Flask montado via WSGI.
+
+Mesmo SQL (constantes de app.py) e mesma deduplicação do WhatsApp: curto-circuito
+de idempotência, coalescência por pix_id (no processo + GET_LOCK) e upsert atômico
+decidindo quem preencheu payment_date; envio só após o commit.
+
+Dependências extras: pip install -r requirements-async.txt
+Uso: uvicorn app_async:app --host 0.0.0.0 --port $PORT --workers 2
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import aiomysql
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as sync_app
+from app import log, metricas
+
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+ASYNC_HTTP_MAX_CONEXOES = int(os.getenv("ASYNC_HTTP_MAX_CONEXOES", "100"))
+# pipelines simultâneos por processo (equivalente de WEBHOOK_MAX_EM_ANDAMENTO; 0 = sem limite)
+ASYNC_MAX_EM_ANDAMENTO = int(os.getenv("ASYNC_MAX_EM_ANDAMENTO", "200"))
+
+_estado = {"em_andamento": 0}
+_voos = {}            # pix_id -> asyncio.Future do processamento em andamento
+_travas_token = {}    # (codigoparasistema, codcadastro) -> asyncio.Lock
+
+
+# =========================
+# HTTP (httpx)
+# =========================
+def _criar_cliente_http(limite: int) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(sync_app.HTTP_READ_TIMEOUT, connect=sync_app.HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=limite, max_keepalive_connections=limite),
+    )
+
+
+async def _requisitar(cliente, disjuntor, metodo: str, url: str, status_retry, retry_leitura: bool = True, **kwargs):
+    """
+    Mesma política de app.chamar_upstream (backoff exponencial + jitter): a cada tentativa
+    o timeout é recalculado pelo que resta do prazo e o disjuntor é consultado de novo.
+    """
+    for tentativa in range(sync_app.HTTP_RETRIES + 1):
+        ultima = tentativa >= sync_app.HTTP_RETRIES
+        conexao, leitura = sync_app.timeout_upstream(disjuntor)
+        kwargs["timeout"] = httpx.Timeout(leitura, connect=conexao)
+        disjuntor.permitir()
+        inicio = time.perf_counter()
+        resolvido = False
+        try:
+            r = await cliente.request(metodo, url, **kwargs)
+        except httpx.TransportError as e:
+            disjuntor.falha()
+            resolvido = True
+            # sem conexão/vaga no pool: a requisição não saiu, pode repetir mesmo com retry_leitura=False
+            nao_enviada = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+            atraso = None if ultima or not (retry_leitura or nao_enviada) else sync_app.atraso_nova_tentativa(tentativa)
+            if atraso is None:
+                raise
+        else:
+            if r.status_code >= 500 or r.status_code == 429:
+                disjuntor.falha()
+            else:
+                disjuntor.sucesso(time.perf_counter() - inicio)
+            resolvido = True
+            if r.status_code not in status_retry or ultima:
+                return r
+            atraso = sync_app.atraso_nova_tentativa(tentativa, r.headers.get("Retry-After"))
+            if atraso is None:
+                return r
+            await r.aclose()
+        finally:
+            if not resolvido:  # CancelledError, erro local...: a sonda do meio_aberto não pode ficar presa
+                disjuntor.liberar_sonda()
+        metricas.inc("pix_upstream_retentativas_total", upstream=disjuntor.nome)
+        await asyncio.sleep(atraso)
+
+
+async def renovar_token_company(client_id: str, client_secret: str) -> dict:
+    url, headers, data = sync_app.requisicao_token_company(client_id, client_secret)
+    r = await _requisitar(_estado["tecnospeed"], sync_app.disjuntor_tecnospeed, "POST", url, (500, 502, 503, 504), headers=headers, data=data)
+    corpo = r.json() if r.status_code in (200, 201) else None
+    return sync_app.token_da_resposta(r.status_code, r.text, corpo)
+
+
+async def tecnospeed_consultar_pix_por_id(pix_id: str, token_company: str) -> dict:
+    url = f"{sync_app.TECNOSPEED_BASE}/api/v1/pix/{pix_id}"
+    headers = {"Authorization": f"Bearer {token_company}", "Accept": "application/json"}
+    r = await _requisitar(_estado["tecnospeed"], sync_app.disjuntor_tecnospeed, "GET", url, (500, 502, 503, 504), headers=headers)
+    if r.status_code == 401:
+        metricas.inc("pix_token_recusados_total")
+        raise sync_app.TokenRecusado(f"Consulta PIX por ID falhou (401): {r.text}")
+    if r.status_code != 200:
+        raise RuntimeError(f"Consulta PIX por ID falhou ({r.status_code}): {r.text}")
+    data = r.json() or {}
+    return data if isinstance(data, dict) else {}
+
+
+async def enviar_whatsapp(phone_e164: str, message: str) -> bool:
+    payload = {"phone": phone_e164, "message": message}
+    headers = {"Content-Type": "application/json", "Client-Token": sync_app.PLUGZ_CLIENT_TOKEN}
+    try:
+        async with _estado["whatsapp_semaforo"]:
+            resp = await _requisitar(
+                _estado["plugz"], sync_app.disjuntor_plugz, "POST", sync_app.PLUGZ_API_URL, (502, 503, 504),
+                retry_leitura=False, headers=headers, json=payload,
+            )
+        ok = resp.status_code in (200, 201)
+        if ok:
+            log.info("Mensagem enviada ao WhatsApp %s. Status: %s", phone_e164, resp.status_code)
+        else:
+            log.warning("PlugzAPI recusou envio para %s. Status: %s", phone_e164, resp.status_code,
+                        extra={"corpo": sync_app.corpo_log(resp.text)})
+    except Exception as e:
+        log.error("Erro ao enviar WhatsApp (%s): %r", phone_e164, e)
+        ok = False
+    metricas.inc("pix_whatsapp_envios_total", resultado="enviado" if ok else "falha")
+    return ok
+
+
+async def enviar_whatsapp_em_paralelo(telefones, message: str) -> dict:
+    if not telefones:
+        return {}
+    enviados = await asyncio.gather(*(enviar_whatsapp(fone, message) for fone in telefones))
+    resultados = dict(zip(telefones, enviados))
+    log.info("WhatsApp: %s/%s enviados %s", sum(enviados), len(resultados), resultados)
+    return resultados
+
+
+# =========================
+# DB (aiomysql)
+# =========================
+async def _um(conn, sql: str, params=None):
+    async with conn.cursor() as cursor:
+        await cursor.execute(sql, params)
+        return await cursor.fetchone()
+
+
+async def garantir_token_company(conn, codigoparasistema, codcadastro, recusado: str = None) -> str:
+    """Mesmo cache de app.py; single-flight por chave com asyncio.Lock. recusado: token rejeitado (401)."""
+    chave = (codigoparasistema, codcadastro)
+    token = sync_app.token_em_cache(chave)
+    if token and token != recusado:
+        return token
+
+    trava = _travas_token.setdefault(chave, asyncio.Lock())
+    async with trava:
+        token = sync_app.token_em_cache(chave)
+        if token and token != recusado:
+            return token
+        if recusado:
+            sync_app.invalidar_token_cache(codigoparasistema, codcadastro)
+
+        dp = await _um(conn, *sync_app.sql_dadospix(codigoparasistema, codcadastro))
+        if not dp:
+            raise RuntimeError("Não encontrei registro em dadospix para esse vínculo.")
+
+        token = (dp.get("token_company") or "").strip()
+        expires_at = dp.get("token_company_expires_at")
+        if (not token) or sync_app.token_expirado(expires_at) or token == recusado:
+            novo = await renovar_token_company(
+                (dp.get("tecnospeed_client_id") or "").strip(),
+                (dp.get("tecnospeed_client_secret") or "").strip(),
+            )
+            token, expires_at = novo["access_token"], novo["expires_at"]
+            async with conn.cursor() as cursor:
+                await cursor.execute(sync_app.SQL_ATUALIZAR_TOKEN, (token, expires_at, dp.get("iddadospix")))
+            log.info("Token company renovado (iddadospix=%s) expira em %s", dp.get("iddadospix"), expires_at)
+            metricas.inc("pix_token_renovacoes_total", origem="webhook", resultado="ok")
+
+        sync_app.guardar_token_cache(chave, token, expires_at)
+        return token
+
+
+async def pix_ja_liquidado(conn, pix_id: str) -> bool:
+    if sync_app.liquidados_lru.contem(pix_id):
+        sync_app._contar_duplicado("lru")
+        return True
+    if await _um(conn, sync_app.SQL_JA_LIQUIDADO, (pix_id,)):
+        sync_app.liquidados_lru.adicionar(pix_id)
+        sync_app._contar_duplicado("banco")
+        return True
+    return False
+
+
+async def _dados_notificacao(conn, vinculo: dict):
+    """Espelho de app.dados_notificacao (mesmo índice de esquemas e cache de contatos)."""
+    codigoempresa = vinculo.get("codigoparasistema")
+    if sync_app.indice_esquemas.precisa_carregar(codigoempresa):
+        async with conn.cursor() as cursor:
+            await cursor.execute(sync_app.SQL_ESQUEMAS)
+            sync_app.indice_esquemas.carregar(await cursor.fetchall())
+    schema = sync_app.indice_esquemas.obter(codigoempresa)
+    if not schema:
+        log.warning("Sem ESQUEMA em autenticacao para CODIGOEMPRESA=%s.", codigoempresa)
+        return "", "", [], ""
+
+    codcadastro = vinculo.get("codcadastro")
+    sql, params, contato = sync_app.sql_notificacao(schema, codcadastro, vinculo.get("pedidovendaid"))
+    row = await _um(conn, sql, params)
+    return (schema, *sync_app.resultado_notificacao(schema, codcadastro, row, contato))
+
+
+async def _pipeline_pix(conn, pix_id: str):
+    """Espelho de app._pipeline_pix. Retorna (resultado, notificacao|None)."""
+    with metricas.etapa("idempotencia"):
+        ja_liquidado = await pix_ja_liquidado(conn, pix_id)
+    if ja_liquidado:
+        log.info("pix_id=%s já liquidado; entrega duplicada ignorada.", pix_id)
+        await conn.commit()
+        metricas.inc("pix_webhook_resultado_total", resultado="duplicado")
+        return {"ok": True, "duplicado": True}, None
+
+    with metricas.etapa("vinculo"):
+        vinculo = await _um(conn, sync_app.SQL_VINCULO_POR_PIX, (pix_id,)) or dict(sync_app.VINCULO_VAZIO)
+    if not vinculo.get("codigoparasistema"):
+        log.warning("Sem vínculo em pix_cobrancas_geradas para pix_id=%s.", pix_id)
+        await conn.commit()
+        metricas.inc("pix_webhook_resultado_total", resultado="sem_vinculo")
+        return {"ok": True, "warn": "Sem vínculo"}, None
+
+    sync_app.acrescentar_contexto_log(tenant=vinculo.get("codigoparasistema"), codcadastro=vinculo.get("codcadastro"))
+
+    with metricas.etapa("token"):
+        token_company = await garantir_token_company(conn, vinculo.get("codigoparasistema"), vinculo.get("codcadastro"))
+    await conn.commit()  # nenhuma transação aberta durante a TecnoSpeed
+
+    with metricas.etapa("tecnospeed"):
+        try:
+            pix_full = await tecnospeed_consultar_pix_por_id(pix_id, token_company)
+        except sync_app.TokenRecusado:
+            token_company = await garantir_token_company(
+                conn, vinculo.get("codigoparasistema"), vinculo.get("codcadastro"), recusado=token_company
+            )
+            await conn.commit()
+            pix_full = await tecnospeed_consultar_pix_por_id(pix_id, token_company)
+    sync_app.logar_corpo("Retorno TecnoSpeed /api/v1/pix/{id}", pix_full)
+
+    status_pix = str(pix_full.get("status") or "").upper().strip()
+    payment_date_br = sync_app.parse_iso_dt_to_br(pix_full.get("paymentDate"))
+
+    with metricas.etapa("upsert"):
+        params = sync_app.params_upsert_recebido(pix_full, vinculo)
+        async with conn.cursor() as cursor:
+            await cursor.execute(sync_app.SQL_UPSERT_RECEBIDO, params)
+            info = sync_app.resultado_upsert(cursor.rowcount, cursor.lastrowid, params[4])
+            if sync_app.FEED_RECEBIDOS and info["payment_date_definido_agora"]:
+                await cursor.execute(sync_app.SQL_REGISTRAR_LIQUIDACAO, (sync_app.now_str(), params[0]))
+    liquidado = status_pix == "LIQUIDATED" and bool(info.get("payment_date"))
+    definido_agora = info.get("payment_date_definido_agora")
+
+    resultado = {"ok": True}
+    notificacao = None
+    if status_pix == "LIQUIDATED" and definido_agora:
+        with metricas.etapa("tenant"):
+            schema, nome_empresa, telefones, nome_final = await _dados_notificacao(conn, vinculo)
+        msg = sync_app.montar_mensagem(
+            nome_cliente_empresa=nome_empresa or "Cliente",
+            numero_pedido=str(vinculo.get("pedidovendaid") or ""),
+            nome_cliente_final=nome_final or "Cliente",
+            valor=pix_full.get("amount"),
+            data_mysql=payment_date_br or "",
+        )
+        if not telefones:
+            log.warning("Nenhum telefone encontrado em %s.cadastro (codcadastro=%s).", schema, vinculo.get("codcadastro"))
+        elif sync_app.WHATSAPP_OUTBOX:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(sync_app.SQL_ENFILEIRAR_WHATSAPP,
+                                         sync_app.params_outbox_whatsapp(pix_id, telefones, msg))
+                resultado["whatsapp_enfileirado"] = cursor.rowcount
+        else:
+            notificacao = (telefones, msg)
+    else:
+        log.info("Não envia WhatsApp (status=%s, paymentDate=%s, payment_date_definido_agora=%s).",
+                 status_pix, payment_date_br, definido_agora)
+
+    await conn.commit()
+    if liquidado:
+        sync_app.liquidados_lru.adicionar(pix_id)
+    if resultado.get("whatsapp_enfileirado"):
+        sync_app.despachante_whatsapp.acordar()
+    if liquidado:
+        sync_app.feed_recebidos.acordar()
+    metricas.inc("pix_webhook_resultado_total", resultado="liquidado" if liquidado else "nao_liquidado")
+    return resultado, notificacao
+
+
+async def processar_pix_successful(pix_id: str) -> dict:
+    """Espelho de app.processar_pix_successful (coalescência por pix_id + GET_LOCK)."""
+    duplicado = sync_app.duplicado_em_memoria(pix_id)
+    if duplicado:
+        return duplicado
+
+    voo = _voos.get(pix_id)
+    if voo is not None:
+        metricas.inc("pix_webhook_resultado_total", resultado="coalescido")
+        try:
+            resultado = await asyncio.wait_for(asyncio.shield(voo), sync_app.espera_seguidor())
+        except asyncio.TimeoutError:
+            return {"ok": True, "em_andamento": True}
+        resultado = {k: v for k, v in resultado.items() if k != "whatsapp"}
+        resultado["coalescido"] = True
+        return resultado
+
+    voo = _voos[pix_id] = asyncio.get_running_loop().create_future()
+    try:
+        async with _estado["db"].acquire() as conn:
+            try:
+                if sync_app.PIX_TRAVA_GLOBAL:
+                    nome = sync_app.nome_trava_pix(pix_id)
+                    trava = await _um(conn, sync_app.SQL_GET_LOCK, (nome, sync_app.PIX_TRAVA_ESPERA_SEG))
+                    if (trava or {}).get("ok") != 1:
+                        log.info("pix_id=%s em processamento em outro worker; não aguardou mais.", pix_id)
+                        metricas.inc("pix_webhook_resultado_total", resultado="em_andamento")
+                        resultado = {"ok": True, "em_andamento": True}
+                        voo.set_result(resultado)
+                        return resultado
+                    try:
+                        resultado, notificacao = await _pipeline_pix(conn, pix_id)
+                    finally:
+                        await _um(conn, sync_app.SQL_RELEASE_LOCK, (nome,))
+                else:
+                    resultado, notificacao = await _pipeline_pix(conn, pix_id)
+            except Exception:
+                await conn.rollback()
+                raise
+
+        if notificacao:
+            with metricas.etapa("whatsapp"):
+                resultado["whatsapp"] = await enviar_whatsapp_em_paralelo(*notificacao)
+        voo.set_result(resultado)
+        return resultado
+    except Exception as e:
+        if not voo.done():
+            voo.set_exception(e)
+            voo.exception()  # marca como lida (pode não haver seguidores)
+        metricas.inc("pix_webhook_resultado_total",
+                     resultado="adiado" if isinstance(e, sync_app.UpstreamIndisponivel) else "erro")
+        raise
+    finally:
+        _voos.pop(pix_id, None)
+
+
+# =========================
+# Rotas
+# =========================
+async def home(request):
+    db = _estado["db"]
+    return JSONResponse({
+        "service": "pix-webhook",
+        "status": "ok",
+        "motor": "asgi",
+        "db_pool": {"tamanho": db.maxsize, "abertas": db.size, "livres": db.freesize},
+        "pipelines_em_andamento": _estado["em_andamento"],
+        "duplicados_absorvidos": dict(sync_app.duplicados_absorvidos),
+    })
+
+
+def _resposta_adiada(id_evento, motivo: str, retry_apos: float):
+    log.warning("Processamento adiado (id_evento=%s): %s", id_evento, motivo)
+    return JSONResponse(
+        {"ok": False, "id_evento": id_evento, "status": "adiado", "motivo": motivo},
+        status_code=503,
+        headers={"Retry-After": str(max(1, int(round(retry_apos))))},
+    )
+
+
+async def webhook_pix(request):
+    """
+    Mesmo contrato (e mesmas gravações) de app.webhook_pix:
+    - WEBHOOK_ASYNC=1: evento 'pendente'/'concluido', 202 na hora (workers de app.py processam)
+    - senão: pipeline na requisição dentro de WEBHOOK_PRAZO_SEG; disjuntor aberto ou mais de
+      ASYNC_MAX_EM_ANDAMENTO pipelines no processo: evento gravado + 503 Retry-After
+    """
+    inicio = time.perf_counter()
+    metricas.gauge_add("pix_webhook_em_andamento", 1)
+    try:
+        if sync_app.WEBHOOK_AUTH and request.headers.get("Authorization", "") != sync_app.WEBHOOK_AUTH:
+            return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        event_name = (payload.get("event") or payload.get("type") or "").strip()
+        pix_id = (payload.get("id") or payload.get("pix_id") or "").strip()
+
+        if not pix_id:
+            return JSONResponse({"error": "pix_id ausente no payload"}, status_code=400)
+
+        sync_app.acrescentar_contexto_log(pix_id=pix_id, evento=event_name)
+        log.info("Webhook recebido (event=%s)", event_name)
+        sync_app.logar_corpo("Payload do webhook", payload)
+
+        headers_dict = {k: v for k, v in request.headers.items()}
+        processar = event_name.upper() == "PIX_SUCCESSFUL"
+        status_processamento = None
+        if sync_app.WEBHOOK_ASYNC:
+            status_processamento = "pendente" if processar else "concluido"
+
+        async with _estado["db"].acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(*sync_app.params_evento(
+                    event_name, pix_id, headers_dict, payload, status_processamento
+                ))
+                id_evento = cursor.lastrowid
+            await conn.commit()
+        sync_app.acrescentar_contexto_log(id_evento=id_evento)
+
+        if sync_app.WEBHOOK_ASYNC:
+            if processar:
+                sync_app.processador_eventos.acordar()
+            return JSONResponse({"ok": True, "id_evento": id_evento, "status": status_processamento},
+                                status_code=202)
+
+        resultado = {"ok": True}
+        if processar:
+            if sync_app.disjuntor_tecnospeed.aberto():
+                metricas.inc("pix_webhook_descartes_total", motivo="disjuntor_aberto")
+                return _resposta_adiada(id_evento, "tecnospeed indisponível", sync_app.disjuntor_tecnospeed.retry_apos())
+            if 0 < ASYNC_MAX_EM_ANDAMENTO <= _estado["em_andamento"]:
+                metricas.inc("pix_webhook_descartes_total", motivo="saturado")
+                return _resposta_adiada(id_evento, "serviço saturado", 2)
+            _estado["em_andamento"] += 1
+            try:
+                with sync_app.prazo_requisicao(sync_app.WEBHOOK_PRAZO_SEG):
+                    resultado = await processar_pix_successful(pix_id)
+            except sync_app.UpstreamIndisponivel as e:
+                return _resposta_adiada(id_evento, str(e), e.retry_apos)
+            finally:
+                _estado["em_andamento"] -= 1
+        return JSONResponse(resultado)
+
+    except Exception as e:
+        log.exception("ERRO WEBHOOK: %r", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+    finally:
+        metricas.gauge_add("pix_webhook_em_andamento", -1)
+        metricas.observar("pix_webhook_segundos", time.perf_counter() - inicio, rota="webhook_pix")
+
+
+def _int_param(request, nome: str, estrito: bool = False):
+    """Espelho de app._int_arg."""
+    valor = request.query_params.get(nome, "").strip()
+    try:
+        return int(valor)
+    except ValueError:
+        if estrito and valor:
+            raise ValueError(f"{nome} deve ser um número inteiro")
+        return None
+
+
+async def feed_sse(request):
+    """
+    Mesmo contrato de app.feed_sse, mas cada assinante é uma corrotina esperando um
+    asyncio.Event (sem thread presa): milhares de conexões ociosas por processo.
+    """
+    if not sync_app.FEED_RECEBIDOS:
+        return JSONResponse({"error": "Feed desabilitado (FEED_RECEBIDOS=1, requer sql/006_pix_recebidos_liquidacoes.sql)"},
+                            status_code=404)
+    if not sync_app.EXPORT_AUTH:
+        return JSONResponse({"error": "Exportação desabilitada (defina EXPORT_AUTH)"}, status_code=403)
+    if request.headers.get("Authorization", "") != sync_app.EXPORT_AUTH:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    desde = _int_param(request, "desde")
+    if desde is None:
+        try:
+            desde = int(request.headers.get("Last-Event-ID", ""))
+        except ValueError:
+            desde = None
+    try:
+        tenant = _int_param(request, "codigoparasistema", estrito=True)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    limite = max(1, min(_int_param(request, "limite") or sync_app.FEED_LOTE, sync_app.FEED_LOTE))
+
+    feed = sync_app.feed_recebidos
+    if not await asyncio.to_thread(feed.entrar, sync_app.FEED_MAX_ASSINANTES_ASYNC):
+        return JSONResponse({"error": "Limite de assinantes do feed neste processo"},
+                            status_code=503, headers={"Retry-After": "5"})
+
+    loop = asyncio.get_running_loop()
+    novidade = asyncio.Event()
+
+    def avisar():
+        loop.call_soon_threadsafe(novidade.set)
+
+    feed.ouvir(avisar)
+
+    async def gerar():
+        try:
+            cursor = feed.ultimo_id() if desde is None else desde
+            yield "retry: 2000\n\n"
+            while True:
+                novidade.clear()
+                linhas, cursor, _ = feed.do_buffer(cursor, tenant, limite)
+                if linhas is None:
+                    linhas, cursor = await asyncio.to_thread(feed.do_banco, cursor, tenant, limite)
+                if linhas:
+                    yield "".join(sync_app.evento_sse(l) for l in linhas)
+                    continue
+                try:
+                    await asyncio.wait_for(novidade.wait(), sync_app.FEED_HEARTBEAT_SEG)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            feed.parar_de_ouvir(avisar)
+            feed.sair()
+
+    return StreamingResponse(gerar(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    _estado["db"] = await aiomysql.create_pool(
+        host=sync_app.DB_HOST,
+        port=sync_app.DB_PORT,
+        user=sync_app.DB_USER,
+        password=sync_app.DB_PASS,
+        db=sync_app.DB_NAME,
+        charset="utf8mb4",
+        autocommit=False,
+        cursorclass=aiomysql.DictCursor,
+        minsize=1,
+        maxsize=ASYNC_DB_POOL_SIZE,
+        pool_recycle=sync_app.DB_POOL_RECYCLE,
+    )
+    _estado["tecnospeed"] = _criar_cliente_http(ASYNC_HTTP_MAX_CONEXOES)
+    _estado["plugz"] = _criar_cliente_http(ASYNC_HTTP_MAX_CONEXOES)
+    _estado["whatsapp_semaforo"] = asyncio.Semaphore(max(1, sync_app.WHATSAPP_MAX_PARALELO))
+    sync_app.iniciar_background()
+    log.info("Motor ASGI iniciado (pid=%s, db_pool=%s)", os.getpid(), ASYNC_DB_POOL_SIZE)
+    try:
+        yield
+    finally:
+        await _estado["tecnospeed"].aclose()
+        await _estado["plugz"].aclose()
+        _estado["db"].close()
+        await _estado["db"].wait_closed()
+
+
+app = Starlette(
+    routes=[
+        Route("/", home, methods=["GET"]),
+        Route("/webhook/pix-pago", webhook_pix, methods=["POST"]),
+        Route("/feed/recebidos/stream", feed_sse, methods=["GET"]),
+        # /ui, /metrics, /webhook/pix-pago/lote...: app Flask (síncrono, em thread pool)
+        Mount("/", app=WSGIMiddleware(sync_app.app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,52 @@
+"""
+Arquivamento de pix_webhook_eventos.
+
+Eventos com mais de EVENTOS_RETENCAO_DIAS saem da tabela e vão para arquivos
+gzip NDJSON por dia em EVENTOS_ARQUIVO_DIR (AAAA/MM/eventos-AAAA-MM-DD.ndjson.gz),
+com um índice por pix_id em EVENTOS_ARQUIVO_DIR/indice.sqlite. Assim a tabela
+quente fica do mesmo tamanho com o passar dos meses.
+
+Uso (mesmas variáveis de ambiente do app; requer sql/005_pix_webhook_eventos_compacto.sql):
+    python arquivar_eventos.py                     # arquiva o que passou da retenção e sai (ex.: cron diário)
+    python arquivar_eventos.py --dias 60 --lote 1000
+    python arquivar_eventos.py --buscar <pix_id>   # eventos arquivados do pix_id (JSON)
+
+Só um processo arquiva por vez (GET_LOCK). Rode sempre na mesma máquina/volume:
+os arquivos ficam no disco de quem arquivou. Alternativa sem processo extra:
+EVENTOS_ARQUIVAR_EMBUTIDO=1 nos workers web (com EVENTOS_ARQUIVO_DIR em volume persistente).
+"""
+import argparse
+import json
+
+import app
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Move eventos antigos do webhook PIX para arquivos comprimidos.")
+    p.add_argument("--dias", type=int, default=app.EVENTOS_RETENCAO_DIAS, help="retenção na tabela (dias)")
+    p.add_argument("--dir", default=app.EVENTOS_ARQUIVO_DIR, help="diretório dos arquivos")
+    p.add_argument("--lote", type=int, default=app.EVENTOS_ARQUIVO_LOTE, help="linhas por DELETE")
+    p.add_argument("--pausa", type=float, default=app.EVENTOS_ARQUIVO_PAUSA_SEG, help="seg. entre lotes")
+    p.add_argument("--max-lotes", type=int, help="para depois de N lotes")
+    p.add_argument("--buscar", metavar="PIX_ID", help="só lista os eventos arquivados deste pix_id")
+    args = p.parse_args(argv)
+
+    arquivador = app.ArquivadorEventos(args.dir, args.dias, args.lote, args.pausa)
+
+    if args.buscar:
+        print(json.dumps(arquivador.buscar(args.buscar), ensure_ascii=False, indent=2, default=str))
+        return 0
+
+    if args.dias <= 0:
+        print("[INFO] Retenção desligada (--dias 0); nada a arquivar.")
+        return 0
+    resultado = arquivador.arquivar(args.max_lotes)
+    if resultado is None:
+        print("[WARN] Outro processo já está arquivando; tente mais tarde.")
+        return 1
+    print(f"[INFO] Eventos arquivados: {resultado['arquivados']} em {resultado['lotes']} lote(s) -> {args.dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+"""
+Stand-ins HTTP locais para o benchmark: TecnoSpeed e PlugzAPI.
+
+- POST /oauth2/token                          -> {"access_token", "expires_in"}
+- GET  /api/v1/pix/{id}                       -> PIX LIQUIDATED (ou não, conforme --liquidado)
+- POST /instances/.../token/.../send-text     -> {"ok": true}
+
+Latência (média + jitter uniforme) e taxa de erro 5xx configuráveis por upstream.
+Pode rodar sozinho (python bench/fakes.py) ou ser iniciado por bench/run.py.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ConfigUpstream:
+    def __init__(self, latencia_ms=0.0, jitter_ms=0.0, taxa_erro=0.0):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.taxa_erro = taxa_erro
+
+    def simular(self) -> bool:
+        """Dorme a latência simulada; True se esta chamada deve falhar com 503."""
+        atraso = self.latencia_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if atraso > 0:
+            time.sleep(atraso / 1000.0)
+        return random.random() < self.taxa_erro
+
+
+class Contadores:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.valores = {}
+
+    def inc(self, nome):
+        with self._lock:
+            self.valores[nome] = self.valores.get(nome, 0) + 1
+
+
+def criar_servidor(porta: int, tecnospeed: ConfigUpstream, plugz: ConfigUpstream, liquidado: float = 1.0):
+    contadores = Contadores()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _ler_corpo(self):
+            tamanho = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(tamanho) if tamanho else b""
+
+        def _responder(self, status, corpo):
+            dados = json.dumps(corpo).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def do_POST(self):
+            self._ler_corpo()
+            if self.path.startswith("/oauth2/token"):
+                contadores.inc("oauth")
+                if tecnospeed.simular():
+                    return self._responder(503, {"error": "indisponivel"})
+                return self._responder(200, {"access_token": uuid.uuid4().hex, "expires_in": 3600})
+            if self.path.endswith("/send-text"):
+                contadores.inc("send_text")
+                if plugz.simular():
+                    return self._responder(503, {"error": "indisponivel"})
+                return self._responder(200, {"ok": True, "messageId": uuid.uuid4().hex})
+            self._responder(404, {"error": "rota"})
+
+        def do_GET(self):
+            if self.path.startswith("/api/v1/pix/"):
+                contadores.inc("pix")
+                if tecnospeed.simular():
+                    return self._responder(503, {"error": "indisponivel"})
+                pix_id = self.path.rsplit("/", 1)[-1]
+                agora = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+                pago = random.random() < liquidado
+                return self._responder(200, {
+                    "id": pix_id,
+                    "surrogateKey": pix_id[:20],
+                    "status": "LIQUIDATED" if pago else "ACTIVE",
+                    "amount": round(random.uniform(10, 500), 2),
+                    "paymentDate": agora if pago else None,
+                    "payerCpfCnpj": "12345678909",
+                    "payerName": "Pagador Benchmark",
+                    "emv": "00020126580014br.gov.bcb.pix",
+                    "createdAt": agora,
+                })
+            self._responder(404, {"error": "rota"})
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", porta), Handler)
+    servidor.daemon_threads = True
+    servidor.contadores = contadores
+    return servidor
+
+
+def iniciar_em_thread(porta: int, tecnospeed: ConfigUpstream, plugz: ConfigUpstream, liquidado: float = 1.0):
+    servidor = criar_servidor(porta, tecnospeed, plugz, liquidado)
+    threading.Thread(target=servidor.serve_forever, name="bench-fakes", daemon=True).start()
+    return servidor
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Fakes HTTP de TecnoSpeed e PlugzAPI.")
+    p.add_argument("--porta", type=int, default=18080)
+    p.add_argument("--tecnospeed-latencia-ms", type=float, default=80)
+    p.add_argument("--tecnospeed-jitter-ms", type=float, default=40)
+    p.add_argument("--tecnospeed-erro", type=float, default=0.0)
+    p.add_argument("--plugz-latencia-ms", type=float, default=300)
+    p.add_argument("--plugz-jitter-ms", type=float, default=150)
+    p.add_argument("--plugz-erro", type=float, default=0.0)
+    p.add_argument("--liquidado", type=float, default=1.0, help="fração de consultas LIQUIDATED")
+    args = p.parse_args(argv)
+
+    servidor = criar_servidor(
+        args.porta,
+        ConfigUpstream(args.tecnospeed_latencia_ms, args.tecnospeed_jitter_ms, args.tecnospeed_erro),
+        ConfigUpstream(args.plugz_latencia_ms, args.plugz_jitter_ms, args.plugz_erro),
+        args.liquidado,
+    )
+    print(f"Fakes em http://127.0.0.1:{args.porta}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
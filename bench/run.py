@@ -0,0 +1,271 @@
+"""
+Benchmark reproduzível do serviço de webhook.
+
+1. Recria um banco MySQL de teste (bench/schema.sql + migrações de sql/ em ordem)
+   e popula cobranças, dadospix, autenticacao e o esquema do tenant
+2. Sobe os fakes de TecnoSpeed/PlugzAPI (bench/fakes.py) com latência e erro configuráveis
+3. Sobe app:app no gunicorn (mesmo layout do Procfile) apontando para tudo isso
+4. Dispara PIX_SUCCESSFUL realistas, com fração configurável de reentregas
+5. Reporta throughput, p50/p95/p99 e status HTTP (e grava JSON com --saida p/ comparar antes/depois)
+
+Precisa de um MySQL acessível com usuário que possa criar bancos, ex.:
+    docker run -d -p 3307:3306 -e MYSQL_ROOT_PASSWORD=bench mysql:8
+    python bench/run.py --db-port 3307 --db-pass bench --requisicoes 5000 --concorrencia 32
+    python bench/run.py ... --env WEBHOOK_ASYNC=1 --saida depois.json
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+import requests
+
+import fakes
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TENANT_EMPRESA = 1
+
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def executar_script(cursor, sql: str):
+    sem_comentarios = "\n".join(ln for ln in sql.splitlines() if not ln.strip().startswith("--"))
+    for comando in sem_comentarios.split(";"):
+        comando = comando.strip()
+        if comando:
+            cursor.execute(comando)
+
+
+def preparar_banco(args) -> list:
+    """Recria os bancos, aplica as migrações e devolve os pix_ids semeados."""
+    conn = pymysql.connect(host=args.db_host, port=args.db_port, user=args.db_user,
+                           password=args.db_pass, autocommit=True, charset="utf8mb4")
+    try:
+        with conn.cursor() as cursor:
+            with open(os.path.join(RAIZ, "bench", "schema.sql"), encoding="utf-8") as f:
+                sql = f.read().replace("__DB__", args.db_name).replace("__TENANT__", args.tenant)
+            executar_script(cursor, sql)
+
+            cursor.execute(f"USE {args.db_name}")
+            for caminho in sorted(glob.glob(os.path.join(RAIZ, "sql", "*.sql"))):
+                with open(caminho, encoding="utf-8") as f:
+                    executar_script(cursor, f.read())
+
+            cursor.execute(
+                "INSERT INTO autenticacao (CODIGOEMPRESA, ESQUEMA) VALUES (%s, %s)",
+                (TENANT_EMPRESA, args.tenant),
+            )
+            cursor.executemany(
+                """
+                INSERT INTO dadospix
+                  (codigoparasistema, codcadastro, tecnospeed_client_id, tecnospeed_client_secret)
+                VALUES (%s, %s, %s, %s)
+                """,
+                [(TENANT_EMPRESA, cod, f"client{cod}", "secret") for cod in range(1, args.clientes + 1)],
+            )
+
+            cadastros = []
+            for cod in range(1, args.clientes + args.pedidos + 1):
+                fones = [("11", f"9{cod:08d}"[-9:]) for _ in range(args.telefones if cod <= args.clientes else 0)]
+                fones += [(None, None)] * (5 - len(fones))
+                cadastros.append((cod, f"Cadastro {cod}", *[x for par in fones for x in par]))
+            cursor.executemany(
+                f"""
+                INSERT INTO {args.tenant}.cadastro
+                  (codcadastro, razaosocial, ddd1, fone1, ddd2, fone2, ddd3, fone3, ddd4, fone4, ddd5, fone5)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                """,
+                cadastros,
+            )
+            cursor.executemany(
+                f"INSERT INTO {args.tenant}.pedidovenda (pedidovendaid, codcadastro) VALUES (%s, %s)",
+                [(pv, args.clientes + pv) for pv in range(1, args.pedidos + 1)],
+            )
+
+            pix_ids = [uuid.uuid4().hex for _ in range(args.pix)]
+            cursor.executemany(
+                """
+                INSERT INTO pix_cobrancas_geradas (pix_id, codigoparasistema, codcadastro, pedidovendaid)
+                VALUES (%s, %s, %s, %s)
+                """,
+                [
+                    (pid, TENANT_EMPRESA, random.randint(1, args.clientes), random.randint(1, args.pedidos))
+                    for pid in pix_ids
+                ],
+            )
+        return pix_ids
+    finally:
+        conn.close()
+
+
+def subir_gunicorn(args, porta_app: int, porta_fakes: int):
+    env = dict(os.environ)
+    env.update({
+        "DB_HOST": args.db_host,
+        "DB_PORT": str(args.db_port),
+        "DB_USER": args.db_user,
+        "DB_PASS": args.db_pass,
+        "DB_NAME": args.db_name,
+        "TECNOSPEED_BASE": f"http://127.0.0.1:{porta_fakes}",
+        "PLUGZ_API_URL": f"http://127.0.0.1:{porta_fakes}/instances/BENCH/token/BENCH/send-text",
+        "WEBHOOK_AUTH": "",
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        chave, _, valor = item.partition("=")
+        env[chave] = valor
+
+    cmd = [
+        sys.executable, "-m", "gunicorn", "app:app",
+        "--bind", f"127.0.0.1:{porta_app}",
+        "--workers", str(args.workers),
+        "--threads", str(args.threads),
+        "--timeout", "120",
+    ]
+    proc = subprocess.Popen(cmd, cwd=RAIZ, env=env)
+
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        try:
+            if requests.get(f"http://127.0.0.1:{porta_app}/", timeout=1).status_code == 200:
+                return proc
+        except requests.RequestException:
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError("gunicorn terminou durante a subida")
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn não respondeu em 30s")
+
+
+def percentil(ordenados: list, p: float) -> float:
+    if not ordenados:
+        return 0.0
+    k = min(len(ordenados) - 1, max(0, int(round(p / 100.0 * (len(ordenados) - 1)))))
+    return ordenados[k]
+
+
+def disparar(args, porta_app: int, pix_ids: list) -> dict:
+    url = f"http://127.0.0.1:{porta_app}/webhook/pix-pago"
+    local = threading.local()
+    enviados = []
+    lock = threading.Lock()
+
+    def proximo_id():
+        with lock:
+            if enviados and random.random() < args.duplicados:
+                return random.choice(enviados)
+            pid = pix_ids[len(enviados) % len(pix_ids)]
+            enviados.append(pid)
+            return pid
+
+    def uma(_):
+        sessao = getattr(local, "sessao", None)
+        if sessao is None:
+            sessao = local.sessao = requests.Session()
+        pid = proximo_id()
+        inicio = time.perf_counter()
+        try:
+            r = sessao.post(url, json={"event": "PIX_SUCCESSFUL", "id": pid}, timeout=130)
+            status = r.status_code
+        except requests.RequestException:
+            status = "erro_conexao"
+        return time.perf_counter() - inicio, status
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as ex:
+        resultados = list(ex.map(uma, range(args.requisicoes)))
+    duracao = time.perf_counter() - inicio
+
+    latencias = sorted(lat for lat, _ in resultados)
+    status = {}
+    for _, st in resultados:
+        status[str(st)] = status.get(str(st), 0) + 1
+    return {
+        "requisicoes": len(resultados),
+        "duracao_seg": round(duracao, 3),
+        "throughput_rps": round(len(resultados) / duracao, 1) if duracao else 0.0,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 1),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 1),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 1),
+        "max_ms": round(latencias[-1] * 1000, 1) if latencias else 0.0,
+        "status": status,
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark do webhook PIX com stand-ins locais.")
+    p.add_argument("--db-host", default="127.0.0.1")
+    p.add_argument("--db-port", type=int, default=3306)
+    p.add_argument("--db-user", default="root")
+    p.add_argument("--db-pass", default="")
+    p.add_argument("--db-name", default="pix_bench")
+    p.add_argument("--tenant", default="pix_bench_tenant")
+    p.add_argument("--pix", type=int, default=2000, help="cobranças semeadas")
+    p.add_argument("--clientes", type=int, default=50, help="empresas (codcadastro) do tenant")
+    p.add_argument("--pedidos", type=int, default=500)
+    p.add_argument("--telefones", type=int, default=2, help="telefones por empresa (0-5)")
+    p.add_argument("--requisicoes", type=int, default=2000)
+    p.add_argument("--concorrencia", type=int, default=16)
+    p.add_argument("--duplicados", type=float, default=0.2, help="fração de reentregas de pix_id já enviado")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--env", action="append", default=[], help="variável extra p/ o app (CHAVE=valor)")
+    p.add_argument("--tecnospeed-latencia-ms", type=float, default=80)
+    p.add_argument("--tecnospeed-jitter-ms", type=float, default=40)
+    p.add_argument("--tecnospeed-erro", type=float, default=0.0)
+    p.add_argument("--plugz-latencia-ms", type=float, default=300)
+    p.add_argument("--plugz-jitter-ms", type=float, default=150)
+    p.add_argument("--plugz-erro", type=float, default=0.0)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--saida", help="grava o relatório JSON neste arquivo")
+    args = p.parse_args(argv)
+
+    random.seed(args.seed)
+    pix_ids = preparar_banco(args)
+
+    porta_fakes = porta_livre()
+    servidor = fakes.iniciar_em_thread(
+        porta_fakes,
+        fakes.ConfigUpstream(args.tecnospeed_latencia_ms, args.tecnospeed_jitter_ms, args.tecnospeed_erro),
+        fakes.ConfigUpstream(args.plugz_latencia_ms, args.plugz_jitter_ms, args.plugz_erro),
+    )
+
+    porta_app = porta_livre()
+    proc = subir_gunicorn(args, porta_app, porta_fakes)
+    try:
+        relatorio = disparar(args, porta_app, pix_ids)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        servidor.shutdown()
+
+    relatorio["upstream_chamadas"] = dict(servidor.contadores.valores)
+    relatorio["config"] = {
+        k: v for k, v in vars(args).items() if k not in ("db_pass",)
+    }
+    print(json.dumps(relatorio, ensure_ascii=False, indent=2))
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
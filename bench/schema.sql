@@ -0,0 +1,73 @@
+-- Esquema mínimo para o benchmark (estado anterior às migrações de sql/).
+-- __DB__ e __TENANT__ são substituídos por bench/run.py.
+DROP DATABASE IF EXISTS __DB__;
+CREATE DATABASE __DB__ CHARACTER SET utf8mb4;
+DROP DATABASE IF EXISTS __TENANT__;
+CREATE DATABASE __TENANT__ CHARACTER SET utf8mb4;
+
+CREATE TABLE __DB__.pix_cobrancas_geradas (
+  id_cobrancas INT AUTO_INCREMENT PRIMARY KEY,
+  pix_id VARCHAR(64) NOT NULL,
+  codigoparasistema INT NULL,
+  codcadastro INT NULL,
+  pedidovendaid INT NULL
+);
+
+CREATE TABLE __DB__.pix_recebidos (
+  id_recebido INT AUTO_INCREMENT PRIMARY KEY,
+  pix_id VARCHAR(64) NOT NULL,
+  surrogate_key VARCHAR(100) NULL,
+  status VARCHAR(30) NULL,
+  amount DECIMAL(12,2) NULL,
+  payment_date DATETIME NULL,
+  payer_cpf_cnpj VARCHAR(20) NULL,
+  payer_name VARCHAR(200) NULL,
+  emv TEXT NULL,
+  created_at_api DATETIME NULL,
+  recebido_em DATETIME NULL,
+  codigoparasistema INT NULL,
+  codcadastro INT NULL,
+  id_cobrancas INT NULL,
+  pago TINYINT NOT NULL DEFAULT 0,
+  json_completo LONGTEXT NULL,
+  KEY idx_recebidos_pix_id (pix_id)
+);
+
+CREATE TABLE __DB__.dadospix (
+  iddadospix INT AUTO_INCREMENT PRIMARY KEY,
+  codigoparasistema INT NULL,
+  codcadastro INT NULL,
+  token_company TEXT NULL,
+  token_company_expires_at DATETIME NULL,
+  tecnospeed_client_id VARCHAR(100) NULL,
+  tecnospeed_client_secret VARCHAR(100) NULL
+);
+
+CREATE TABLE __DB__.pix_webhook_eventos (
+  id_evento INT AUTO_INCREMENT PRIMARY KEY,
+  event_name VARCHAR(60) NULL,
+  pix_id VARCHAR(64) NULL,
+  headers_json LONGTEXT NULL,
+  json_completo LONGTEXT NULL,
+  recebido_em DATETIME NULL
+);
+
+CREATE TABLE __DB__.autenticacao (
+  CODIGOEMPRESA INT PRIMARY KEY,
+  ESQUEMA VARCHAR(64) NOT NULL
+);
+
+CREATE TABLE __TENANT__.cadastro (
+  codcadastro INT PRIMARY KEY,
+  razaosocial VARCHAR(200) NULL,
+  ddd1 VARCHAR(3) NULL, fone1 VARCHAR(12) NULL,
+  ddd2 VARCHAR(3) NULL, fone2 VARCHAR(12) NULL,
+  ddd3 VARCHAR(3) NULL, fone3 VARCHAR(12) NULL,
+  ddd4 VARCHAR(3) NULL, fone4 VARCHAR(12) NULL,
+  ddd5 VARCHAR(3) NULL, fone5 VARCHAR(12) NULL
+);
+
+CREATE TABLE __TENANT__.pedidovenda (
+  pedidovendaid INT PRIMARY KEY,
+  codcadastro INT NULL
+);
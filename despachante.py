@@ -0,0 +1,57 @@
+"""
+Despachante da outbox de WhatsApp (pix_whatsapp_outbox).
+
+Com WHATSAPP_OUTBOX=1 o webhook só grava a mensagem na outbox, na mesma
+transação do upsert em pix_recebidos; este processo faz o envio à PlugzAPI
+em lotes, com paralelismo, limite de taxa por instância, novas tentativas
+com backoff e 'morto' para o que não tiver mais jeito.
+
+Uso (mesmas variáveis de ambiente do app; requer sql/003_pix_whatsapp_outbox.sql):
+    python despachante.py                      # contínuo (ex.: "worker:" no Procfile)
+    python despachante.py --uma-vez            # drena o que estiver pronto e sai
+    python despachante.py --rps 2 --paralelo 4
+
+Pode rodar em mais de uma réplica: a reserva por claim_token não entrega a mesma
+mensagem para dois despachantes (o limite de taxa, porém, é por processo).
+Alternativa sem processo extra: WHATSAPP_DESPACHANTE_EMBUTIDO=1 nos workers web.
+"""
+import argparse
+import time
+
+import app
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Envia as mensagens pendentes da outbox de WhatsApp.")
+    p.add_argument("--uma-vez", action="store_true", help="drena a outbox uma vez e sai")
+    p.add_argument("--lote", type=int, default=app.WHATSAPP_LOTE, help="mensagens reservadas por vez")
+    p.add_argument("--paralelo", type=int, default=app.WHATSAPP_MAX_PARALELO, help="envios simultâneos")
+    p.add_argument("--rps", type=float, default=app.WHATSAPP_RPS, help="envios por segundo (0 = sem limite)")
+    p.add_argument("--rajada", type=int, default=app.WHATSAPP_RAJADA)
+    p.add_argument("--poll", type=float, default=app.WHATSAPP_POLL_SEG, help="seg. entre varreduras")
+    args = p.parse_args(argv)
+
+    despachante = app.DespachanteWhatsApp(
+        args.lote, args.paralelo, args.rps, args.rajada,
+        args.poll, app.WHATSAPP_MAX_TENTATIVAS, app.WHATSAPP_RESERVA_EXPIRA_SEG,
+    )
+    app.metricas.iniciar_flush()
+
+    if args.uma_vez:
+        contagem = despachante.drenar()
+        print(f"[INFO] Outbox drenada: {contagem}")
+        return 0
+
+    print(f"[INFO] Despachante de WhatsApp (paralelo={args.paralelo}, rps={args.rps or 'sem limite'})")
+    while True:
+        try:
+            contagem = despachante.drenar()
+            if any(contagem.values()):
+                app.log.info("Outbox: %s", contagem)
+        except Exception as e:
+            app.log.exception("ERRO despachante de WhatsApp: %r", e)
+        time.sleep(args.poll)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,192 @@
+"""
+Reconciliação / backfill de PIX a partir de pix_cobrancas_geradas.
+
+Busca cobranças sem linha liquidada em pix_recebidos, consulta a TecnoSpeed
+(GET /api/v1/pix/{id}) em paralelo com limite de taxa e grava os liquidados
+com as mesmas regras de upsert_pix_recebido (insert pago=0, update sem tocar
+em pago). Não envia WhatsApp.
+
+Uso (mesmas variáveis de ambiente do app):
+    python reconciliar.py --concorrencia 16 --rps 30
+    python reconciliar.py --desde-id 0 --limite 5000     # ignora o checkpoint
+
+Retoma de onde parou pelo checkpoint: maior id_cobrancas até o qual todas as
+consultas deram certo. Uma falha (erro na TecnoSpeed, tenant sem token) segura
+o checkpoint logo antes dela; a próxima execução consulta de novo a partir dali
+(as já liquidadas não voltam, pelo LEFT JOIN em pix_recebidos).
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+def ler_checkpoint(caminho: str) -> int:
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            return int(json.load(f).get("ultimo_id_cobrancas") or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def gravar_checkpoint(caminho: str, ultimo_id: int):
+    tmp = caminho + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ultimo_id_cobrancas": ultimo_id, "atualizado_em": app.now_str()}, f)
+    os.replace(tmp, caminho)
+
+
+def buscar_pendentes(cursor, desde_id: int, pagina: int) -> list:
+    cursor.execute(
+        f"""
+        SELECT
+          c.id_cobrancas,
+          c.pix_id,
+          c.codigoparasistema,
+          c.codcadastro,
+          c.pedidovendaid
+        FROM {app.TBL_COBRANCAS} c
+        LEFT JOIN {app.TBL_RECEBIDOS} r
+          ON r.pix_id = c.pix_id
+         AND r.status = 'LIQUIDATED'
+         AND r.payment_date IS NOT NULL
+        WHERE c.id_cobrancas > %s
+          AND c.pix_id IS NOT NULL AND c.pix_id <> ''
+          AND r.id_recebido IS NULL
+        ORDER BY c.id_cobrancas
+        LIMIT %s
+        """,
+        (desde_id, pagina),
+    )
+    return cursor.fetchall()
+
+
+def tokens_por_tenant(conn, cobrancas: list) -> dict:
+    """garantir_token_company uma vez por (codigoparasistema, codcadastro) da página."""
+    tokens = {}
+    with conn.cursor() as cursor:
+        for c in cobrancas:
+            chave = (c.get("codigoparasistema"), c.get("codcadastro"))
+            if chave in tokens or not chave[0]:
+                continue
+            try:
+                tokens[chave] = app.garantir_token_company(cursor, *chave)
+            except Exception as e:
+                app.log.warning("Sem token para tenant %s: %r", chave, e)
+                tokens[chave] = None
+    conn.commit()
+    return tokens
+
+
+def consultar(limitador: app.LimitadorTaxa, cobranca: dict, token: str):
+    limitador.aguardar()
+    try:
+        return cobranca, app.tecnospeed_consultar_pix_por_id(cobranca["pix_id"], token), None
+    except Exception as e:
+        return cobranca, None, e
+
+
+def gravar_lote(conn, itens: list) -> int:
+    """Upsert dos liquidados numa transação. Retorna quantos ganharam payment_date agora."""
+    novos = 0
+    with conn.cursor() as cursor:
+        for cobranca, pix_full in itens:
+            info = app.upsert_pix_recebido(cursor, pix_full, cobranca)
+            if info.get("payment_date_definido_agora"):
+                novos += 1
+    conn.commit()
+    return novos
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Reconcilia pix_cobrancas_geradas com a TecnoSpeed.")
+    p.add_argument("--checkpoint", default=os.getenv("RECONCILIAR_CHECKPOINT", "reconciliar.checkpoint.json"))
+    p.add_argument("--desde-id", type=int, default=None, help="id_cobrancas inicial (ignora o checkpoint)")
+    p.add_argument("--limite", type=int, default=0, help="máximo de cobranças (0 = todas)")
+    p.add_argument("--pagina", type=int, default=1000, help="cobranças lidas por página")
+    p.add_argument("--lote", type=int, default=200, help="upserts por transação")
+    p.add_argument("--concorrencia", type=int, default=8, help="consultas simultâneas à TecnoSpeed")
+    p.add_argument("--rps", type=float, default=20.0, help="limite de consultas por segundo (0 = sem limite)")
+    args = p.parse_args(argv)
+
+    desde_id = args.desde_id if args.desde_id is not None else ler_checkpoint(args.checkpoint)
+    limitador = app.LimitadorTaxa(args.rps, rajada=max(1, args.concorrencia))
+    stats = {"lidas": 0, "liquidadas": 0, "novas": 0, "nao_liquidadas": 0, "sem_token": 0, "erros": 0}
+    inicio = time.monotonic()
+
+    checkpoint = desde_id
+    app.log.info("Reconciliação a partir de id_cobrancas>%s (concorrência=%s, rps=%s)",
+                 desde_id, args.concorrencia, args.rps or "sem limite")
+
+    conn = app.db_conn()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.concorrencia)) as executor:
+            while True:
+                pagina = args.pagina
+                if args.limite:
+                    pagina = min(pagina, args.limite - stats["lidas"])
+                    if pagina <= 0:
+                        break
+
+                with conn.cursor() as cursor:
+                    cobrancas = buscar_pendentes(cursor, desde_id, pagina)
+                conn.commit()
+                if not cobrancas:
+                    break
+
+                tokens = tokens_por_tenant(conn, cobrancas)
+                futuros = []
+                falhas = []  # id_cobrancas cuja consulta não aconteceu ou falhou
+                for c in cobrancas:
+                    token = tokens.get((c.get("codigoparasistema"), c.get("codcadastro")))
+                    if not token:
+                        stats["sem_token"] += 1
+                        falhas.append(c["id_cobrancas"])
+                        continue
+                    futuros.append(executor.submit(consultar, limitador, c, token))
+
+                liquidados = []
+                for fut in futuros:
+                    cobranca, pix_full, erro = fut.result()
+                    if erro is not None:
+                        stats["erros"] += 1
+                        falhas.append(cobranca["id_cobrancas"])
+                        app.log.warning("pix_id=%s: %r", cobranca["pix_id"], erro)
+                        continue
+                    status_pix = str(pix_full.get("status") or "").upper().strip()
+                    if status_pix == "LIQUIDATED" and pix_full.get("paymentDate"):
+                        liquidados.append((cobranca, pix_full))
+                    else:
+                        stats["nao_liquidadas"] += 1
+
+                    if len(liquidados) >= args.lote:
+                        stats["novas"] += gravar_lote(conn, liquidados)
+                        stats["liquidadas"] += len(liquidados)
+                        liquidados = []
+                if liquidados:
+                    stats["novas"] += gravar_lote(conn, liquidados)
+                    stats["liquidadas"] += len(liquidados)
+
+                stats["lidas"] += len(cobrancas)
+                # o checkpoint só avança enquanto não houve falha nesta execução
+                if checkpoint == desde_id:
+                    checkpoint = min(falhas) - 1 if falhas else cobrancas[-1]["id_cobrancas"]
+                    gravar_checkpoint(args.checkpoint, checkpoint)
+                desde_id = cobrancas[-1]["id_cobrancas"]
+
+                decorrido = time.monotonic() - inicio
+                app.log.info("Até id_cobrancas=%s (checkpoint=%s): %s (%.1f cobranças/s)",
+                             desde_id, checkpoint, stats, stats["lidas"] / decorrido)
+    finally:
+        conn.close()
+
+    decorrido = time.monotonic() - inicio
+    app.log.info("Reconciliação concluída em %.1fs (checkpoint=%s): %s", decorrido, checkpoint, stats)
+    return 0 if not (stats["erros"] or stats["sem_token"]) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
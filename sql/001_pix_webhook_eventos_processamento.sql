@@ -0,0 +1,12 @@
+-- Processamento assíncrono do webhook (WEBHOOK_ASYNC=1).
+-- status_processamento: NULL (legado / modo síncrono), pendente, processando, concluido, erro
+ALTER TABLE pix_webhook_eventos
+  ADD COLUMN status_processamento VARCHAR(20) NULL,
+  ADD COLUMN tentativas INT NOT NULL DEFAULT 0,
+  ADD COLUMN claim_token VARCHAR(32) NULL,
+  ADD COLUMN reservado_em DATETIME NULL,
+  ADD COLUMN processar_apos DATETIME NULL,
+  ADD COLUMN processado_em DATETIME NULL,
+  ADD COLUMN erro_processamento VARCHAR(1000) NULL,
+  ADD INDEX idx_eventos_status (status_processamento, id_evento),
+  ADD INDEX idx_eventos_claim (claim_token);
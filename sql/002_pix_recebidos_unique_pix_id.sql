@@ -0,0 +1,8 @@
+-- upsert_pix_recebido usa INSERT ... ON DUPLICATE KEY UPDATE e depende de pix_id único.
+-- Antes de criar a chave, conferir duplicados (deve retornar vazio):
+--   SELECT pix_id, COUNT(*) FROM pix_recebidos GROUP BY pix_id HAVING COUNT(*) > 1;
+-- Se houver, manter a linha mais recente de cada pix_id:
+--   DELETE r1 FROM pix_recebidos r1
+--   JOIN pix_recebidos r2 ON r2.pix_id = r1.pix_id AND r2.id_recebido > r1.id_recebido;
+ALTER TABLE pix_recebidos
+  ADD UNIQUE KEY uk_pix_recebidos_pix_id (pix_id);
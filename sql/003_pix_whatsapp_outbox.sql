@@ -0,0 +1,21 @@
+-- Outbox transacional das notificações de WhatsApp (WHATSAPP_OUTBOX=1).
+-- Gravada na mesma transação do upsert em pix_recebidos; drenada por despachante.py.
+-- status: pendente, processando, enviado, morto (esgotou tentativas ou erro permanente)
+CREATE TABLE IF NOT EXISTS pix_whatsapp_outbox (
+  id_outbox BIGINT NOT NULL AUTO_INCREMENT,
+  pix_id VARCHAR(64) NOT NULL,
+  telefone VARCHAR(20) NOT NULL,
+  mensagem TEXT NOT NULL,
+  status VARCHAR(20) NOT NULL DEFAULT 'pendente',
+  tentativas INT NOT NULL DEFAULT 0,
+  claim_token VARCHAR(32) NULL,
+  reservado_em DATETIME NULL,
+  processar_apos DATETIME NULL,
+  enviado_em DATETIME NULL,
+  erro VARCHAR(1000) NULL,
+  criado_em DATETIME NOT NULL,
+  PRIMARY KEY (id_outbox),
+  UNIQUE KEY uk_outbox_pix_telefone (pix_id, telefone),
+  KEY idx_outbox_status (status, id_outbox),
+  KEY idx_outbox_claim (claim_token)
+);
@@ -0,0 +1,15 @@
+-- Índices usados pelas consultas do webhook, do renovador de tokens e do monitor.
+-- Em bases antigas alguns já podem existir com outro nome: rode antes
+--   python verificar_banco.py
+-- e aplique só os que ele apontar como faltando (índice duplicado só custa escrita).
+ALTER TABLE pix_cobrancas_geradas
+  ADD INDEX idx_cobrancas_pix_id (pix_id);
+
+ALTER TABLE pix_webhook_eventos
+  ADD INDEX idx_eventos_pix_id (pix_id);
+
+-- sql_dadospix: (codigoparasistema, codcadastro) e (codcadastro) sozinho
+ALTER TABLE dadospix
+  ADD INDEX idx_dadospix_tenant (codigoparasistema, codcadastro),
+  ADD INDEX idx_dadospix_codcadastro (codcadastro),
+  ADD INDEX idx_dadospix_expira (token_company_expires_at);
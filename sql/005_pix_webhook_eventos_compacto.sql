@@ -0,0 +1,9 @@
+-- Armazenamento compacto e arquivamento de pix_webhook_eventos.
+-- headers_z / json_z: headers (só os de EVENTOS_HEADERS) e payload comprimidos no
+-- formato do COMPRESS() do MySQL (EVENTOS_COMPACTO=1); consultar com UNCOMPRESS(json_z).
+-- Linhas antigas continuam em headers_json / json_completo.
+-- idx_eventos_recebido: varredura do arquivador (recebido_em < corte), ver arquivar_eventos.py
+ALTER TABLE pix_webhook_eventos
+  ADD COLUMN headers_z MEDIUMBLOB NULL,
+  ADD COLUMN json_z MEDIUMBLOB NULL,
+  ADD INDEX idx_eventos_recebido (recebido_em);
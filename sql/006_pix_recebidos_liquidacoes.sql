@@ -0,0 +1,21 @@
+-- Registro de liquidações do feed (/feed/recebidos, FEED_RECEBIDOS=1).
+-- Uma linha gravada na mesma transação do upsert que definiu payment_date em
+-- pix_recebidos; o cursor do feed é id_liquidacao (ordem de liquidação, não a de
+-- criação da linha em pix_recebidos).
+CREATE TABLE IF NOT EXISTS pix_recebidos_liquidacoes (
+  id_liquidacao BIGINT NOT NULL AUTO_INCREMENT,
+  id_recebido INT NOT NULL,
+  pix_id VARCHAR(64) NOT NULL,
+  codigoparasistema INT NULL,
+  liquidado_em DATETIME NOT NULL,
+  PRIMARY KEY (id_liquidacao),
+  KEY idx_liquidacoes_tenant (codigoparasistema, id_liquidacao),
+  KEY idx_liquidacoes_em (liquidado_em)
+);
+
+-- liquidações já existentes, na ordem de id_recebido
+INSERT INTO pix_recebidos_liquidacoes (id_recebido, pix_id, codigoparasistema, liquidado_em)
+SELECT id_recebido, pix_id, codigoparasistema, COALESCE(recebido_em, NOW())
+FROM pix_recebidos
+WHERE payment_date IS NOT NULL
+ORDER BY id_recebido;
@@ -0,0 +1,113 @@
+"""
+Regressão de planos: EXPLAIN de cada consulta quente (app.consultas_quentes) numa base
+semeada pelo mesmo preparo do benchmark (bench/schema.sql + sql/*.sql); falha se alguma
+tabela cair em varredura completa (type=ALL) ou ficar sem índice escolhido.
+
+Precisa de um MySQL descartável (usuário que possa criar bancos):
+    docker run -d -p 3307:3306 -e MYSQL_ROOT_PASSWORD=teste mysql:8
+    PIX_TESTE_MYSQL=root:teste@127.0.0.1:3307 python -m pytest -q tests/
+Sem PIX_TESTE_MYSQL o módulo é pulado.
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+DSN = os.getenv("PIX_TESTE_MYSQL", "")
+if not DSN:
+    pytest.skip("PIX_TESTE_MYSQL não definido (user:senha@host:porta)", allow_module_level=True)
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BANCO = os.getenv("PIX_TESTE_BANCO", "pix_teste_planos")
+
+_credenciais, _, _endereco = DSN.rpartition("@")
+_usuario, _, _senha = _credenciais.partition(":")
+_host, _, _porta = _endereco.partition(":")
+
+# app.py lê a configuração do banco na importação
+os.environ.update({
+    "DB_HOST": _host or "127.0.0.1",
+    "DB_PORT": _porta or "3306",
+    "DB_USER": _usuario or "root",
+    "DB_PASS": _senha,
+    "DB_NAME": BANCO,
+    "VERIFICAR_BANCO_NA_SUBIDA": "0",
+})
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+
+import app  # noqa: E402
+import run as bench  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def exemplo():
+    """Recria e semeia a base; devolve (pix_id, codigoparasistema) existentes."""
+    args = argparse.Namespace(
+        db_host=os.environ["DB_HOST"], db_port=int(os.environ["DB_PORT"]), db_user=os.environ["DB_USER"],
+        db_pass=os.environ["DB_PASS"], db_name=BANCO, tenant=f"{BANCO}_tenant",
+        pix=5000, clientes=200, pedidos=500, telefones=1,
+    )
+    pix_ids = bench.preparar_banco(args)
+
+    conn = app.db_conn()
+    try:
+        with conn.cursor() as cursor:
+            # metade liquidada e um evento por cobrança: as tabelas do caminho quente não ficam vazias
+            cursor.execute(
+                f"""
+                INSERT INTO {app.TBL_RECEBIDOS}
+                  (pix_id, status, payment_date, recebido_em, codigoparasistema, codcadastro, id_cobrancas)
+                SELECT pix_id, 'LIQUIDATED', NOW(), NOW(), codigoparasistema, codcadastro, id_cobrancas
+                FROM {app.TBL_COBRANCAS}
+                WHERE MOD(id_cobrancas, 2) = 0
+                """
+            )
+            # outros tenants em dadospix: codigoparasistema deixa de ser constante na tabela
+            cursor.executemany(
+                f"INSERT INTO {app.TBL_DADOSPIX} (codigoparasistema, codcadastro, tecnospeed_client_id) VALUES (%s, %s, %s)",
+                [(tenant, cod, f"client{tenant}_{cod}") for tenant in range(2, 22) for cod in range(1, 101)],
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {app.TBL_EVENTOS} (event_name, pix_id, headers_json, json_completo, recebido_em)
+                SELECT 'PIX_SUCCESSFUL', pix_id, '{{}}', '{{}}', NOW()
+                FROM {app.TBL_COBRANCAS}
+                """
+            )
+            for tabela in (app.TBL_COBRANCAS, app.TBL_RECEBIDOS, app.TBL_EVENTOS, app.TBL_DADOSPIX):
+                cursor.execute(f"ANALYZE TABLE {tabela}")
+                cursor.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    return pix_ids[1], bench.TENANT_EMPRESA
+
+
+@pytest.fixture()
+def cursor():
+    conn = app.db_conn()
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("nome", [nome for nome, _, _ in app.consultas_quentes()])
+def test_consulta_quente_usa_indice(exemplo, cursor, nome):
+    pix_id, codigo = exemplo
+    sql, params = next((s, p) for n, s, p in app.consultas_quentes(pix_id, codigo) if n == nome)
+    cursor.execute("EXPLAIN " + sql, params)
+    linhas = [linha for linha in cursor.fetchall() if linha.get("table")]
+
+    assert linhas, f"{nome}: EXPLAIN sem acesso a tabela"
+    for linha in linhas:
+        assert str(linha.get("type") or "").upper() != "ALL", f"{nome}: varredura completa em {linha}"
+        assert linha.get("key"), f"{nome}: nenhum índice escolhido em {linha}"
+
+
+def test_verificar_planos_sem_problemas(exemplo, cursor):
+    assert app.verificar_planos(cursor) == []
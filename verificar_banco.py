@@ -0,0 +1,43 @@
+"""
+Confere se o banco tem os índices que o app usa e se as consultas quentes
+(vínculo por pix_id, idempotência, dadospix, tenant) têm índice utilizável em
+cada tabela (EXPLAIN possible_keys; não depende do volume de dados da base).
+
+Uso (mesmas variáveis de ambiente do app):
+    python verificar_banco.py            # relatório; sai com 1 se algo faltar
+    python verificar_banco.py --json
+
+Serve de portão no deploy/CI depois de aplicar sql/*.sql. Na subida do app a
+mesma verificação roda em background e só loga (VERIFICAR_BANCO_NA_SUBIDA).
+"""
+import argparse
+import json
+
+import app
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Verifica índices e planos das consultas do webhook PIX.")
+    p.add_argument("--json", action="store_true", help="saída em JSON")
+    args = p.parse_args(argv)
+
+    resultado = app.verificar_banco()
+    faltando, sem_indice = resultado["indices_faltando"], resultado["sem_indice"]
+
+    if args.json:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2, default=str))
+    else:
+        for f in faltando:
+            print(f"[FALTA] {f['tabela']}({', '.join(f['colunas'])}){' único' if f['unico'] else ''}")
+            print(f"        {f['ddl']};")
+        for v in sem_indice:
+            print(f"[SCAN]  {v['consulta']}: nenhum índice utilizável em {v['tabela']} "
+                  f"(type={v['type']}, rows={v['rows']})")
+        if not faltando and not sem_indice:
+            print("[OK] Índices presentes e todas as consultas quentes com índice utilizável.")
+
+    return 1 if faltando or sem_indice else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())